@@ -1,19 +1,51 @@
-from importlib.metadata import version, PackageNotFoundError
-try:
-    __version__ = version('aurl-aurl')
-except PackageNotFoundError:
-    __version__ = 'dev'
-
+from typing import TYPE_CHECKING
 import asyncio
+import os
+
+if TYPE_CHECKING:
+    from .exceptions import DownloadException
+    from .urls import URL
+    from .template import Template, TemplateFile
+    from .mirror import Mirror
+
+# Sub-modules are imported on first use, so that commands
+# which never download anything do not pay for aiohttp.
+_lazy = { "DownloadException": ".exceptions",
+          "URL":               ".urls",
+          "Template":          ".template",
+          "TemplateFile":      ".template",
+          "Mirror":            ".mirror",
+        }
 
-from .exceptions import DownloadException
-from .urls import URL
-from .template import Template, TemplateFile
-from .mirror import Mirror
+def __getattr__(name):
+    if name == "__version__": # importlib.metadata is slow to import
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            ans = version('aurl-aurl')
+        except PackageNotFoundError:
+            ans = 'dev'
+        globals()[name] = ans
+        return ans
+    if name in _lazy:
+        from importlib import import_module
+        ans = getattr(import_module(_lazy[name], __name__), name)
+        globals()[name] = ans
+        return ans
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def arun(f):
-    loop = asyncio.get_event_loop()
-    ans = loop.run_until_complete(f)
-    #loop.close()
-    return ans
+    """ Run the coroutine f to completion on a new event loop.
 
+        uvloop is used if it is installed
+        (unless the environment sets AURL_UVLOOP=0).
+    """
+    if os.environ.get("AURL_UVLOOP", "1") != "0":
+        try:
+            import uvloop # type: ignore[import-not-found]
+        except ImportError:
+            pass
+        else:
+            if hasattr(uvloop, "run"):
+                return uvloop.run(f)
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(f)
@@ -0,0 +1,307 @@
+"""
+Manifests and offline bundles of mirror entries.
+
+A manifest lists mirror entries as JSON records::
+
+    {"url": ..., "path": <relative to the mirror base>,
+     "type": "file" or "dir", "size": <bytes>, "sha256": ...}
+
+The digest of a file is the sha256 of its contents.  A directory
+entry (e.g. a git clone) is digested from the sorted lines
+
+    <sha256 of file, "-> target" of symlink, or "dir">  <relative path>
+
+describing everything below it.
+
+A bundle is an (uncompressed, streamable) tar archive holding each
+entry under `entries/<path>`, followed by the manifest of those
+entries as `aurl-manifest.json`.  Digests are computed as the entries
+are archived, so each file is read once.  Importing stages the new
+entries under the mirror's `.aurl/tmp`, and moves each into place only
+after its digest is verified against the manifest.  Entries already
+present in the destination mirror are skipped.
+"""
+from typing import Optional, Dict, Any, List, Tuple, Iterable, Iterator, BinaryIO
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+import asyncio
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import logging
+_logger = logging.getLogger(__name__)
+
+from .exceptions import DownloadException
+from .urls import URL
+from .mirror import Mirror
+from .deps import file_digest
+
+Record = Dict[str, Any]
+
+MANIFEST = "aurl-manifest.json"
+PREFIX = "entries/"
+
+def tree_digest(lines : Iterable[Tuple[str, str]]) -> str:
+    # Digest of a directory from its (relative path, item digest) pairs.
+    h = hashlib.sha256()
+    for rel, d in sorted(lines):
+        h.update(f"{d}  {rel}\n".encode())
+    return h.hexdigest()
+
+def walk(root : Path) -> Iterator[Tuple[str, Path]]:
+    # Everything below root (sorted, not following links),
+    # as (relative posix path, path) pairs.
+    for top, dirs, files in os.walk(root):
+        dirs.sort()
+        rtop = Path(top).relative_to(root)
+        for name in dirs + sorted(files):
+            p = Path(top) / name
+            yield (rtop / name).as_posix(), p
+
+def item_digest(p : Path) -> Tuple[str, int]:
+    # (digest line, size) of one item below a directory entry
+    if p.is_symlink():
+        return "-> " + os.readlink(p), 0
+    if p.is_dir():
+        return "dir", 0
+    return file_digest(p), p.stat().st_size
+
+def entry_record(M : Mirror, url : URL) -> Record:
+    """ Manifest record for the entry of url held by M.
+
+        raises DownloadException if M does not hold it.
+    """
+    p = M.encode(url)
+    rel = p.relative_to(M.base).as_posix()
+    if p.is_dir() and not p.is_symlink():
+        lines = []
+        size = 0
+        for r, q in walk(p):
+            d, n = item_digest(q)
+            lines.append((r, d))
+            size += n
+        return {"url": url.s, "path": rel, "type": "dir",
+                "size": size, "sha256": tree_digest(lines)}
+    if not p.is_file():
+        raise DownloadException(f"{url.s} is not held by the mirror at {M.base}")
+    return {"url": url.s, "path": rel, "type": "file",
+            "size": p.stat().st_size, "sha256": file_digest(p)}
+
+def local_urls(urls : Iterable[URL]) -> List[URL]:
+    # file:// URLs are not stored in the mirror.
+    ans = []
+    for url in urls:
+        if url.scheme == "file":
+            _logger.info("Skipping %s (not a mirror entry)", url)
+            continue
+        ans.append(url)
+    return ans
+
+def manifest(M : Mirror, urls : Iterable[URL], nthreads : int = 8) -> List[Record]:
+    """ Manifest records for the given urls (computed in parallel).
+
+        raises DownloadException if any are not held by M.
+    """
+    urls = sorted(set(local_urls(urls)), key=lambda u: u.s)
+    with ThreadPoolExecutor(nthreads) as pool:
+        futures = [pool.submit(entry_record, M, u) for u in urls]
+    errors = []
+    ans = []
+    for f in futures:
+        try:
+            ans.append(f.result())
+        except DownloadException as e:
+            errors.append(str(e))
+    if len(errors) > 0:
+        raise DownloadException("Missing entries:\n  - " + "\n  - ".join(errors))
+    return ans
+
+class HashingReader:
+    # File wrapper updating a digest with everything read.
+    def __init__(self, f : BinaryIO):
+        self.f = f
+        self.h = hashlib.sha256()
+
+    def read(self, n : int = -1) -> bytes:
+        b = self.f.read(n)
+        self.h.update(b)
+        return b
+
+def add_item(tar : tarfile.TarFile, p : Path, arcname : str) -> Tuple[str, int]:
+    # Archive one file, directory or symlink; returns its (digest line, size).
+    info = tar.gettarinfo(str(p), arcname)
+    if info.isreg():
+        with open(p, "rb") as f:
+            r = HashingReader(f)
+            tar.addfile(info, r) # type: ignore[arg-type]
+        return r.h.hexdigest(), info.size
+    tar.addfile(info)
+    if info.issym():
+        return "-> " + info.linkname, 0
+    return "dir", 0
+
+def export_bundle(M : Mirror, urls : Iterable[URL], out : BinaryIO) -> List[Record]:
+    """ Write a bundle of the entries for urls to the stream `out`.
+
+        Returns the manifest (which is also the bundle's last member).
+
+        raises DownloadException if any are not held by M.
+    """
+    urls = sorted(set(local_urls(urls)), key=lambda u: u.s)
+    missing = [u.s for u in urls if not M.encode(u).exists()]
+    if len(missing) > 0:
+        raise DownloadException("Missing entries:\n  - " + "\n  - ".join(missing))
+
+    records = []
+    with tarfile.open(fileobj=out, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for url in urls:
+            p = M.encode(url)
+            rel = p.relative_to(M.base).as_posix()
+            d, size = add_item(tar, p, PREFIX + rel)
+            rec : Record = {"url": url.s, "path": rel}
+            if p.is_dir() and not p.is_symlink():
+                lines = []
+                for r, q in walk(p):
+                    d, n = add_item(tar, q, f"{PREFIX}{rel}/{r}")
+                    lines.append((r, d))
+                    size += n
+                rec.update(type="dir", size=size, sha256=tree_digest(lines))
+            else:
+                rec.update(type="file", size=size, sha256=d)
+            records.append(rec)
+
+        data = json.dumps(records, indent=1).encode()
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(data)
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+    return records
+
+def member_path(name : str) -> Optional[PurePosixPath]:
+    # Mirror-relative path of an archive member (None if not an entry).
+    if not name.startswith(PREFIX):
+        return None
+    rel = PurePosixPath(name[len(PREFIX):])
+    if rel.is_absolute() or ".." in rel.parts or len(rel.parts) == 0:
+        raise DownloadException(f"Invalid bundle member: {name}")
+    return rel
+
+def extract(tar : tarfile.TarFile, info : tarfile.TarInfo, dest : Path) -> str:
+    # Write one member to dest, returning its digest line.
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if info.isdir():
+        dest.mkdir(exist_ok=True)
+        return "dir"
+    if info.issym():
+        target = PurePosixPath(info.linkname)
+        if target.is_absolute() or ".." in target.parts:
+            # git checkouts may hold such links, but they could
+            # point anywhere once imported
+            raise DownloadException(f"Unsafe symlink in bundle: {info.name} -> {info.linkname}")
+        os.symlink(info.linkname, dest)
+        return "-> " + info.linkname
+    if not info.isreg():
+        raise DownloadException(f"Unsupported bundle member: {info.name}")
+    f = tar.extractfile(info)
+    assert f is not None
+    h = hashlib.sha256()
+    with open(dest, "wb") as out:
+        for blk in iter(lambda: f.read(1024**2), b''):
+            h.update(blk)
+            out.write(blk)
+    os.chmod(dest, info.mode & 0o755 | 0o644)
+    os.utime(dest, (info.mtime, info.mtime))
+    return h.hexdigest()
+
+def stage(M : Mirror, stream : BinaryIO, work : Path
+         ) -> Tuple[Optional[List[Record]], Dict[str, str]]:
+    # Extract the entries M does not hold from a bundle into work
+    # (blocking), returning the manifest and the digest line
+    # of each staged path.
+    digests : Dict[str, str] = {}
+    records : Optional[List[Record]] = None
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for info in tar:
+            if info.name == MANIFEST:
+                f = tar.extractfile(info)
+                assert f is not None
+                records = json.loads(f.read())
+                continue
+            rel = member_path(info.name)
+            if rel is None:
+                _logger.warning("Ignoring bundle member %s", info.name)
+                continue
+            if (M.base / rel).exists() or (M.base / rel).is_symlink():
+                continue # already held
+            digests[rel.as_posix()] = extract(tar, info, work / rel)
+    return records, digests
+
+async def import_bundle(M : Mirror, stream : BinaryIO) -> Dict[str, str]:
+    """ Import a bundle read from `stream` into M.
+
+        Returns a mapping from each url in the bundle
+        to "imported" or "present" (if M already held it).
+
+        raises DownloadException if the bundle is incomplete,
+        or any entry fails verification (entries which passed
+        verification are still imported).
+    """
+    tmp = M.state / "tmp"
+    tmp.mkdir(parents=True, exist_ok=True)
+    work = Path(tempfile.mkdtemp(dir=tmp, prefix=f"{M.hostname}.{os.getpid()}.import."))
+    # reading, hashing and writing run off the event loop
+    loop = asyncio.get_running_loop()
+    try:
+        records, digests = await loop.run_in_executor(None, stage, M, stream, work)
+        if records is None:
+            raise DownloadException("Bundle has no manifest (truncated?)")
+        return await install(M, work, records, digests)
+    finally:
+        await loop.run_in_executor(None, shutil.rmtree, work, True)
+
+def place(staged : Path, out : Path) -> None:
+    # Move a verified entry into the mirror (blocking).
+    out.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(staged, out)
+
+def staged_digest(rec : Record, digests : Dict[str, str]) -> Optional[str]:
+    # Digest of the staged copy of a manifest entry.
+    path = rec["path"]
+    if rec["type"] == "file":
+        return digests.get(path)
+    prefix = path + "/"
+    return tree_digest((k[len(prefix):], v) for k, v in digests.items()
+                       if k.startswith(prefix))
+
+async def install(M : Mirror, work : Path, records : List[Record],
+                  digests : Dict[str, str]) -> Dict[str, str]:
+    # Verify staged entries and move them into the mirror.
+    loop = asyncio.get_running_loop()
+    status : Dict[str, str] = {}
+    errors : List[str] = []
+    for rec in records:
+        url = URL(rec["url"])
+        out = M.encode(url)
+        if out.relative_to(M.base).as_posix() != rec["path"]:
+            errors.append(f"{url.s}: path {rec['path']} does not match this mirror's layout")
+            continue
+        staged = work / rec["path"]
+        async with M.locks.lock(rec["path"]):
+            if out.exists():
+                status[url.s] = "present"
+                continue
+            if not (staged.exists() or staged.is_symlink()):
+                errors.append(f"{url.s}: missing from bundle")
+                continue
+            if staged_digest(rec, digests) != rec["sha256"]:
+                errors.append(f"{url.s}: digest mismatch")
+                continue
+            await loop.run_in_executor(None, place, staged, out)
+            status[url.s] = "imported"
+    if len(errors) > 0:
+        raise DownloadException("Bundle import errors:\n  - " + "\n  - ".join(errors))
+    return status
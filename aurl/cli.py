@@ -0,0 +1,175 @@
+"""Mirror maintenance commands.
+"""
+
+__author__ = "David M. Rogers"
+__copyright__ = "UT-Battelle LLC"
+__license__ = "BSD3"
+
+from typing import Optional, Dict, Any, List, TYPE_CHECKING
+from pathlib import Path
+import logging
+import sys
+_logger = logging.getLogger(__name__)
+
+import typer
+import json
+
+from .mirror import Mirror
+if TYPE_CHECKING:
+    from .urls import URL
+
+app = typer.Typer()
+
+@app.callback()
+def main():
+    """Inspect and maintain an aurl mirror."""
+
+def set_logging(v : bool, vv : bool) -> None:
+    if vv:
+        logging.basicConfig(level=logging.DEBUG)
+    elif v:
+        logging.basicConfig(level=logging.INFO)
+
+@app.command(help="List the URLs held by a mirror.")
+def ls(mirror  : Optional[Path] = typer.Option(None, help="directory holding downloaded files"),
+       size    : bool = typer.Option(False, help="include file sizes"),
+       ndjson  : bool = typer.Option(False, help="print one JSON object per entry"),
+       summary : bool = typer.Option(False, help="print only per-host entry and byte counts"),
+       threads : int = typer.Option(8, help="number of directory-listing threads"),
+       v    : bool = typer.Option(False, "-v", help="show info-level logs"),
+       vv   : bool = typer.Option(False, "-vv", help="show debug-level logs")):
+    set_logging(v, vv)
+    if mirror is None:
+        mirror = Path()
+    M = Mirror( mirror )
+
+    entries = M.scan(sizes = size or summary, nthreads = threads)
+    if summary:
+        hosts : Dict[str, Dict[str, int]] = {}
+        total = {"entries": 0, "bytes": 0}
+        for e in entries:
+            h = hosts.setdefault(f"{e.url.scheme}://{e.url.netloc}",
+                                 {"entries": 0, "bytes": 0})
+            for d in (h, total):
+                d["entries"] += 1
+                d["bytes"] += e.size or 0
+        ans : Dict[str, Any] = dict(total)
+        ans["hosts"] = hosts
+        print(json.dumps(ans, indent=4))
+        return
+
+    out = sys.stdout
+    for e in entries:
+        if ndjson:
+            rec : Dict[str, Any] = {"url": e.url.s, "path": str(e.path)}
+            if size:
+                rec["size"] = e.size
+            out.write(json.dumps(rec) + "\n")
+        elif size:
+            out.write(f"{e.url.s}\t{e.path}\t{e.size}\n")
+        else:
+            out.write(f"{e.url.s}\t{e.path}\n")
+
+def select(M : Mirror, urls : Optional[List[str]],
+           template : Optional[List[Path]]) -> List["URL"]:
+    # URLs named directly or used by templates -- or else all entries.
+    from .urls import URL
+    from .template import TemplateFile
+    ans = [URL(u) for u in urls or []]
+    for t in template or []:
+        ans.extend(TemplateFile(t).uris)
+    if len(ans) == 0 and not template:
+        ans = [e.url for e in M.scan()]
+    return ans
+
+@app.command(help="Print a manifest (url, path, size, sha256) of mirror entries.")
+def manifest(urls     : Optional[List[str]] = typer.Argument(None, help="urls to include (default: all entries)"),
+             template : Optional[List[Path]] = typer.Option(None, help="include the urls used by this template"),
+             mirror   : Optional[Path] = typer.Option(None, help="directory holding downloaded files"),
+             threads  : int = typer.Option(8, help="number of hashing threads"),
+             v    : bool = typer.Option(False, "-v", help="show info-level logs"),
+             vv   : bool = typer.Option(False, "-vv", help="show debug-level logs")):
+    from .exceptions import DownloadException
+    set_logging(v, vv)
+    if mirror is None:
+        mirror = Path()
+    M = Mirror( mirror )
+    try:
+        records = M.manifest(select(M, urls, template), threads)
+    except DownloadException as e:
+        print(e, file=sys.stderr)
+        raise typer.Exit(1)
+    print(json.dumps(records, indent=1))
+
+@app.command(help="Write a tar bundle of mirror entries (for `aurl import`).")
+def export(urls     : Optional[List[str]] = typer.Argument(None, help="urls to include (default: all entries)"),
+           template : Optional[List[Path]] = typer.Option(None, help="include the urls used by this template"),
+           mirror   : Optional[Path] = typer.Option(None, help="directory holding downloaded files"),
+           output   : Path = typer.Option(Path("-"), "--output", "-o", help="bundle file (- for stdout)"),
+           fetch    : bool = typer.Option(False, help="fetch missing entries first"),
+           v    : bool = typer.Option(False, "-v", help="show info-level logs"),
+           vv   : bool = typer.Option(False, "-vv", help="show debug-level logs")):
+    from .exceptions import DownloadException
+    from . import arun
+    set_logging(v, vv)
+    if mirror is None:
+        mirror = Path()
+    M = Mirror( mirror )
+    selected = select(M, urls, template)
+    try:
+        if fetch:
+            arun(M.fetch_all(selected))
+        if str(output) == "-":
+            records = M.export_bundle(selected, sys.stdout.buffer)
+        else:
+            with open(output, "wb") as f:
+                records = M.export_bundle(selected, f)
+    except DownloadException as e:
+        print(e, file=sys.stderr)
+        raise typer.Exit(1)
+    print(f"Exported {len(records)} entries", file=sys.stderr)
+
+@app.command("import", help="Import a bundle written by `aurl export`.")
+def import_(bundle : Path = typer.Argument(..., help="bundle file (- for stdin)"),
+            mirror : Optional[Path] = typer.Option(None, help="directory holding downloaded files"),
+            v    : bool = typer.Option(False, "-v", help="show info-level logs"),
+            vv   : bool = typer.Option(False, "-vv", help="show debug-level logs")):
+    from .exceptions import DownloadException
+    from . import arun
+    set_logging(v, vv)
+    if mirror is None:
+        mirror = Path()
+    M = Mirror( mirror )
+    try:
+        if str(bundle) == "-":
+            status = arun(M.import_bundle(sys.stdin.buffer))
+        else:
+            with open(bundle, "rb") as f:
+                status = arun(M.import_bundle(f))
+    except DownloadException as e:
+        print(e, file=sys.stderr)
+        raise typer.Exit(1)
+    print(json.dumps(status, indent=4))
+
+@app.command(help="Serve fetch requests for a mirror over a local socket.")
+def daemon(mirror : Optional[Path] = typer.Option(None, help="directory holding downloaded files"),
+           peer   : Optional[List[str]] = typer.Option(None, help="peer mirror (aurl.serve) to try before the origin, nearest first"),
+           nparallel : int = typer.Option(10, help="number of simultaneous downloads"),
+           v    : bool = typer.Option(False, "-v", help="show info-level logs"),
+           vv   : bool = typer.Option(False, "-vv", help="show debug-level logs")):
+    from .daemon import Daemon, socket_path
+    from .exceptions import DownloadException
+    from . import arun
+    set_logging(v, vv)
+    if mirror is None:
+        mirror = Path()
+    M = Mirror( mirror, nparallel=nparallel, peers=peer )
+    print(f"Listening on {socket_path(M)}", file=sys.stderr)
+    try:
+        arun(Daemon(M).run())
+    except DownloadException as e:
+        print(e, file=sys.stderr)
+        raise typer.Exit(1)
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,261 @@
+"""
+Cooperative fetching by processes sharing a mirror.
+
+When many processes (e.g. one per node of a batch job) need the
+same URLs, each can join a named work queue in the mirror,
+`base/.aurl/queues/<name>/`, instead of fetching the whole list
+itself.  A participant
+
+ 1. publishes its URL list there (`urls.<host>.<pid>.<id>`, kept
+    alive by touching it every `lease/3` seconds),
+ 2. claims and downloads missing URLs of the shared set (the union
+    of all live lists), skipping those another process is fetching,
+ 3. and waits until every URL of the shared set is present or
+    has failed, re-claiming any whose holder has stopped renewing
+    its lease.
+
+Claims are the mirror's own per-entry lock files, created
+atomically with O_CREAT|O_EXCL and broken once their lease
+expires (see `aurl.lock`), so cooperating processes also never
+duplicate the downloads of plain `Mirror.fetch` calls.  Each
+participant starts claiming at a different point of the shared
+set, so they rarely contend for the same entries.  A URL that fails
+is recorded under `failed/`, and is not retried by the others while
+the participant that failed it is live (or for `failed_ttl` seconds).
+"""
+from typing import Optional, Dict, List, Iterable, Set
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import os
+import random
+import shutil
+import time
+import uuid
+import logging
+_logger = logging.getLogger(__name__)
+
+from .exceptions import DownloadException
+from .urls import URL
+from .mirror import Mirror
+from .lock import Busy
+from .taskmgr import ResourceContext
+
+#: seconds a failure is remembered after its participant has left
+failed_ttl = 600.0
+
+class WorkQueue:
+    """ One participant in the queue `name` of mirror M.
+
+        Args:
+           poll: seconds between checks while waiting
+                 for other participants' downloads
+           window: most claims pending at once
+                   (default 2*M.nparallel)
+    """
+    def __init__(self, M : Mirror, name : str, poll : float = 1.0,
+                 window : Optional[int] = None):
+        if len(name) == 0 or "/" in name or name.startswith("."):
+            raise DownloadException(f"Invalid queue name: {name!r}")
+        self.M = M
+        self.path = M.state / "queues" / name
+        self.poll = poll
+        self.window = window or 2*M.nparallel
+        self.lease = M.locks.lease
+        self.token = f"{M.hostname}.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+        self.mine = self.path / f"urls.{self.token}"
+        self.claimed = 0 #: entries downloaded by this participant
+        self.urls : List[URL] = []
+
+    def publish(self, urls : Iterable[URL]) -> None:
+        text = "".join(u.s + "\n" for u in urls)
+        while True: # the last one out may be removing the queue
+            (self.path / "failed").mkdir(parents=True, exist_ok=True)
+            tmp = self.path / f".tmp.{self.token}"
+            try:
+                tmp.write_text(text)
+                os.replace(tmp, self.mine)
+                return
+            except FileNotFoundError:
+                pass
+
+    def withdraw(self) -> None:
+        self.mine.unlink(missing_ok=True)
+        if len(self.lists()) > 0:
+            return
+        # The last one out cleans up, after moving the queue aside
+        # and checking nobody joined meanwhile.
+        gone = self.path.with_name(f".{self.path.name}.{self.token}")
+        try:
+            os.rename(self.path, gone)
+        except OSError:
+            return
+        if len(self.lists(gone)) > 0:
+            try:
+                os.rename(gone, self.path)
+                return
+            except OSError: # re-created meanwhile: join the two
+                for p in list(gone.glob("urls.*")) + list(gone.glob("failed/*")):
+                    dst = self.path / p.relative_to(gone)
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(p, dst)
+        shutil.rmtree(gone, ignore_errors=True)
+
+    def lists(self, path : Optional[Path] = None) -> List[Path]:
+        # URL lists of live participants.
+        ans = []
+        now = time.time()
+        for p in (path or self.path).glob("urls.*"):
+            try:
+                if now - p.stat().st_mtime <= self.lease:
+                    ans.append(p)
+            except FileNotFoundError:
+                pass
+        return ans
+
+    def shared(self) -> List[URL]:
+        # The union of all live participants' URLs (and our own).
+        urls : Set[str] = set(u.s for u in self.urls)
+        for p in self.lists():
+            try:
+                urls.update(p.read_text().split())
+            except FileNotFoundError:
+                pass
+        return [URL(u) for u in sorted(urls)]
+
+    def failed_path(self, url : URL) -> Path:
+        return self.path / "failed" / hashlib.sha1(url.s.encode()).hexdigest()
+
+    def mark_failed(self, url : URL, err : str) -> None:
+        p = self.failed_path(url)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        tmp = p.with_name(f".tmp.{self.token}")
+        tmp.write_text(json.dumps({"url": url.s, "error": err, "by": self.token,
+                                   "time": time.time()}))
+        os.replace(tmp, p)
+
+    def failure(self, url : URL) -> Optional[str]:
+        # The error recorded for url, while its participant
+        # is live, or for failed_ttl seconds.
+        try:
+            rec = json.loads(self.failed_path(url).read_text())
+            if time.time() - rec["time"] < failed_ttl:
+                return rec["error"]
+            st = (self.path / f"urls.{rec['by']}").stat()
+            if time.time() - st.st_mtime <= self.lease:
+                return rec["error"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    async def heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                os.utime(self.mine)
+            except FileNotFoundError:
+                _logger.warning("Queue entry %s was lost, re-publishing", self.mine)
+                self.publish(self.urls)
+
+    async def run(self, urls : Iterable[URL]) -> Dict[URL, Path]:
+        """ Fetch the shared set cooperatively, returning
+            the local paths of `urls`.
+
+            raises DownloadException listing any of `urls` which failed.
+        """
+        urls = self.urls = list(set(urls))
+        self.publish(urls)
+        beat = asyncio.ensure_future(self.heartbeat())
+        try:
+            done : Dict[URL, Path] = {}
+            errors : Dict[URL, str] = {}
+            while True:
+                todo = [u for u in self.shared()
+                        if u not in done and u not in errors]
+                if len(todo) == 0:
+                    break
+                busy = await self.claim_all(todo, done, errors)
+                if busy > 0:
+                    await asyncio.sleep(self.poll * random.uniform(0.5, 1.5))
+        finally:
+            beat.cancel()
+            try:
+                await beat
+            except asyncio.CancelledError:
+                pass
+            self.withdraw()
+
+        failed = [f"{u}: {errors[u]}" for u in urls if u in errors]
+        if len(failed) > 0:
+            raise DownloadException("Download errors:\n  - "
+                                    + "\n  - ".join(failed))
+        return dict((u, done[u]) for u in urls)
+
+    async def claim(self, url : URL) -> Optional[Path]:
+        # Download url, unless another process holds it (returning None).
+        # Failures are recorded before the entry is released.
+        M = self.M
+        out = M.encode(url)
+        if out.exists():
+            return out
+        if url.scheme == "file":
+            return await M.fetch(url)
+        rel = out.relative_to(M.base).as_posix()
+        # Take a download slot first, so that entries are
+        # not held while waiting for one.
+        async with ResourceContext(M.slots(url)):
+            try:
+                async with M.locks.lock(rel, wait=False):
+                    if out.exists():
+                        return out
+                    err = self.failure(url)
+                    if err is not None:
+                        raise DownloadException(err)
+                    try:
+                        with M.track(url):
+                            ans = await M._download(url, out)
+                    except DownloadException as e:
+                        self.mark_failed(url, str(e))
+                        raise
+                    self.claimed += 1
+                    return ans
+            except Busy:
+                return None
+
+    async def claim_all(self, todo : List[URL], done : Dict[URL, Path],
+                        errors : Dict[URL, str]) -> int:
+        # One pass over todo, starting at a point particular to
+        # this participant.  Returns the number held elsewhere.
+        k = int(hashlib.sha1(self.token.encode()).hexdigest(), 16) % len(todo)
+        busy = 0
+
+        async def claim(url : URL) -> None:
+            nonlocal busy
+            err = self.failure(url)
+            if err is not None:
+                errors[url] = err
+                return
+            try:
+                p = await self.claim(url)
+            except DownloadException as e:
+                _logger.error("%s: %s", url, e)
+                errors[url] = str(e)
+                return
+            if p is None:
+                busy += 1
+            else:
+                done[url] = p
+
+        order = iter(todo[k:] + todo[:k])
+        async def worker() -> None:
+            for url in order:
+                await claim(url)
+        await asyncio.gather(*[worker() for _ in range(min(self.window, len(todo)))])
+        return busy
+
+async def cooperate(M : Mirror, name : str, urls : Iterable[URL]) -> Dict[URL, Path]:
+    """ Fetch urls with the other participants in M's queue `name`
+        (see WorkQueue.run).
+    """
+    return await WorkQueue(M, name).run(urls)
@@ -0,0 +1,235 @@
+"""
+A long-running process owning a mirror.
+
+`aurl daemon` listens on the Unix socket `base/.aurl/daemon.sock`
+and fetches URLs on behalf of short-lived clients, so that the
+mirror's configuration, HTTP connections and in-flight downloads
+are shared between them.  Concurrent requests for the same URL
+are coalesced into one download.
+
+Clients send one JSON object per line, and receive one
+JSON object per line in reply (echoing any "id" given)::
+
+    {"op": "fetch", "urls": [...], "alternates": {url: [...]}}
+        -> {"paths": {url: path}, "errors": {url: message}}
+    {"op": "resolve", "urls": [...]}
+        -> {"paths": {url: path or null}} (local copies only)
+    {"op": "ping"}
+        -> {"pid": ..., "requests": ..., "coalesced": ..., "inflight": ...}
+
+Malformed requests are answered with {"error": message}.
+A `Mirror` created with `use_daemon=True` sends its fetches
+to the daemon when one is listening, and fetches them itself
+otherwise.
+"""
+from typing import Optional, Dict, Any, List, Iterable
+from pathlib import Path
+import asyncio
+import json
+import os
+import signal
+import logging
+_logger = logging.getLogger(__name__)
+
+from .exceptions import DownloadException
+from .urls import URL
+from .mirror import Mirror
+
+#: longest request or reply line (bytes)
+line_limit = 1 << 26
+
+def socket_path(M : Mirror) -> Path:
+    return M.state / "daemon.sock"
+
+class Daemon:
+    """ Serve fetch requests for the mirror M.
+    """
+    def __init__(self, M : Mirror):
+        self.M = M
+        self.inflight : Dict[URL, asyncio.Future] = {}
+        self.requests = 0
+        self.coalesced = 0
+        self._stopped : Optional[asyncio.Event] = None
+
+    @property
+    def stopped(self) -> asyncio.Event:
+        # created on first use, so it belongs to the running loop
+        if self._stopped is None:
+            self._stopped = asyncio.Event()
+        return self._stopped
+
+    def fetch(self, url : URL) -> asyncio.Future:
+        # The (shared) download of url.
+        t = self.inflight.get(url)
+        if t is not None:
+            self.coalesced += 1
+            return t
+        t = asyncio.ensure_future(self.M.fetch(url))
+        self.inflight[url] = t
+        t.add_done_callback(lambda _: self.inflight.pop(url, None))
+        return t
+
+    async def do_fetch(self, req : Dict[str, Any]) -> Dict[str, Any]:
+        urls = [URL(u) for u in req["urls"]]
+        for k, v in req.get("alternates", {}).items():
+            self.M.add_alternates(URL(k), [URL(x) for x in v])
+        # shielded: a client hanging up does not cancel shared downloads
+        results = await asyncio.gather(*[asyncio.shield(self.fetch(u))
+                                         for u in urls],
+                                       return_exceptions=True)
+        paths : Dict[str, str] = {}
+        errors : Dict[str, str] = {}
+        for u, r in zip(urls, results):
+            if isinstance(r, Path):
+                paths[u.s] = str(r)
+            elif isinstance(r, DownloadException):
+                errors[u.s] = str(r)
+            elif r is None:
+                errors[u.s] = "unable to fetch"
+            else:
+                _logger.error("%s: %r", u, r)
+                errors[u.s] = f"{type(r).__name__}: {r}"
+        return {"paths": paths, "errors": errors}
+
+    def do_resolve(self, req : Dict[str, Any]) -> Dict[str, Any]:
+        paths : Dict[str, Optional[str]] = {}
+        for u in req["urls"]:
+            p = self.M.encode(URL(u))
+            paths[u] = str(p) if p.exists() else None
+        return {"paths": paths}
+
+    async def handle(self, req : Dict[str, Any]) -> Dict[str, Any]:
+        self.requests += 1
+        op = req.get("op")
+        if op == "fetch":
+            return await self.do_fetch(req)
+        if op == "resolve":
+            return self.do_resolve(req)
+        if op == "ping":
+            return {"pid": os.getpid(), "requests": self.requests,
+                    "coalesced": self.coalesced,
+                    "inflight": len(self.inflight)}
+        return {"error": f"unknown op: {op!r}"}
+
+    async def reply(self, line : bytes, writer : asyncio.StreamWriter) -> None:
+        req : Dict[str, Any] = {}
+        try:
+            req = json.loads(line)
+            ans = await self.handle(req)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            ans = {"error": f"bad request: {e}"}
+        if isinstance(req, dict) and "id" in req:
+            ans["id"] = req["id"]
+        writer.write(json.dumps(ans).encode() + b"\n")
+        await writer.drain()
+
+    async def client(self, reader : asyncio.StreamReader,
+                     writer : asyncio.StreamWriter) -> None:
+        # Answer each request line from one connection (concurrently).
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                t = asyncio.ensure_future(self.reply(line, writer))
+                tasks.add(t)
+                t.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            _logger.info("client connection lost: %s", e)
+        finally:
+            writer.close()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    async def run(self, path : Optional[Path] = None) -> None:
+        """ Serve requests until SIGINT/SIGTERM (or `stop()`).
+        """
+        from .fetch import SessionPool, sessions
+        if path is None:
+            path = socket_path(self.M)
+        if await ping(path) is not None:
+            raise DownloadException(f"A daemon is already listening on {path}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.unlink(missing_ok=True) # left by a dead daemon
+
+        pool = SessionPool()
+        tok = sessions.set(pool)
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        server = await asyncio.start_unix_server(self.client, path=str(path),
+                                                 limit=line_limit)
+        _logger.info("Serving %s on %s", self.M.base, path)
+        try:
+            await self.stopped.wait()
+        finally:
+            server.close()
+            path.unlink(missing_ok=True)
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(sig)
+            await server.wait_closed()
+            await pool.close()
+            sessions.reset(tok)
+
+async def request(path : Path, req : Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """ Send one request to the daemon at path.
+
+        Returns None if no daemon is listening there.
+    """
+    try:
+        reader, writer = await asyncio.open_unix_connection(str(path),
+                                                            limit=line_limit)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    try:
+        writer.write(json.dumps(req).encode() + b"\n")
+        await writer.drain()
+        line = await reader.readline()
+    finally:
+        writer.close()
+    if not line:
+        raise DownloadException(f"{path}: daemon closed the connection")
+    ans = json.loads(line)
+    if "error" in ans:
+        raise DownloadException(f"{path}: {ans['error']}")
+    return ans
+
+async def ping(path : Path) -> Optional[Dict[str, Any]]:
+    try:
+        return await request(path, {"op": "ping"})
+    except (OSError, ValueError, DownloadException):
+        return None
+
+async def remote_fetch(M : Mirror, urls : Iterable[URL]
+                      ) -> Optional[Dict[URL, Path]]:
+    """ Fetch urls through the daemon serving M.
+
+        Returns None if no daemon is listening.
+
+        raises DownloadException on error.
+    """
+    path = socket_path(M)
+    if not path.exists():
+        return None
+    urls = list(urls)
+    alts = dict((u.s, [a.s for a in M.alternates[u]])
+                for u in urls if u in M.alternates)
+    req : Dict[str, Any] = {"op": "fetch", "urls": [u.s for u in urls]}
+    if alts:
+        req["alternates"] = alts
+    try:
+        ans = await request(path, req)
+    except OSError as e:
+        _logger.warning("%s: daemon unreachable (%s)", path, e)
+        return None
+    if ans is None:
+        return None
+    errors : List[str] = [f"{u}: {e}" for u, e in ans["errors"].items()]
+    if len(errors) > 0:
+        raise DownloadException("Download errors:\n  - "
+                                + "\n  - ".join(errors))
+    return dict((URL(u), Path(p)) for u, p in ans["paths"].items())
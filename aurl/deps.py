@@ -0,0 +1,101 @@
+"""
+Dependency records for incremental template substitution.
+
+Every output written by `subst` is accompanied by a small
+JSON record (stored beside it as `.<name>.deps.json`) holding
+the hash of the template it was rendered from and the local
+path and signature of every URL substituted into it.
+
+An output is up-to-date when its template hash matches and
+every URL still resolves to the same, unmodified path.
+"""
+from typing import Optional, Dict, Tuple, Callable, Mapping, Iterable
+from dataclasses import dataclass, field
+from pathlib import Path
+import hashlib
+import json
+import os
+import logging
+_logger = logging.getLogger(__name__)
+
+from .urls import URL
+
+Resolver = Callable[[URL], Optional[Path]]
+
+def file_digest(fname : Path) -> str:
+    # sha256 hex-digest of a file's contents
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for blk in iter(lambda: f.read(1024**2), b''):
+            h.update(blk)
+    return h.hexdigest()
+
+def signature(p : Path) -> Optional[str]:
+    """ Cheap change-detection signature for a resolved path.
+
+        Uses the size and modification time (ns),
+        so re-downloads and in-place edits are both noticed
+        without reading the contents.
+
+        Returns None if the path does not exist.
+    """
+    try:
+        st = p.stat()
+    except OSError:
+        return None
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+def dep_path(out : Path) -> Path:
+    # location of the dependency record for an output file
+    return out.parent / f".{out.name}.deps.json"
+
+@dataclass
+class DepRecord:
+    template: str #: sha256 of the template text
+    urls: Dict[str, Tuple[str, Optional[str]]] = field(default_factory=dict)
+    #: url -> (resolved path, signature)
+
+    @classmethod
+    def build(cls, template : str, uris : Iterable[URL],
+              lookup : Mapping[URL, Path]) -> "DepRecord":
+        urls : Dict[str, Tuple[str, Optional[str]]] = {}
+        for u in uris:
+            p = lookup[u]
+            urls[u.s] = (str(p), signature(p))
+        return cls(template, urls)
+
+    @classmethod
+    def load(cls, out : Path) -> Optional["DepRecord"]:
+        try:
+            with open(dep_path(out), encoding='utf-8') as f:
+                rec = json.load(f)
+            return cls(rec["template"],
+                       dict((k, (v[0], v[1])) for k, v in rec["urls"].items()))
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            return None
+
+    def save(self, out : Path) -> None:
+        # write-then-rename so readers never see a partial record
+        dst = dep_path(out)
+        tmp = dst.with_name(f"{dst.name}.{os.getpid()}")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"template": self.template, "urls": self.urls}, f)
+        os.replace(tmp, dst)
+
+    def up_to_date(self, out : Path, template : str,
+                   resolve : Resolver) -> bool:
+        """ True if `out` exists and was rendered from a template
+            with hash `template` using the URL paths that
+            `resolve` would return now.
+        """
+        if self.template != template or not out.exists():
+            return False
+        for u, (path, sig) in self.urls.items():
+            try:
+                p = resolve(URL(u))
+            except AssertionError:
+                return False
+            if p is None or str(p) != path or signature(p) != sig:
+                _logger.debug("%s: dependency %s changed", out, u)
+                return False
+        return True
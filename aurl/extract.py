@@ -0,0 +1,363 @@
+"""
+Unpacking archives into the mirror as they download.
+
+An http(s) URL of an archive with the fragment `#extract`
+(or `#extract=keep`) names the unpacked tree, stored as a
+directory at its own `Mirror.encode` path::
+
+    https://example.org/src/pkg-1.0.tar.gz#extract
+
+Tar archives (plain, gz, bz2, xz, and zst if the `zstandard`
+package or Python's `compression.zstd` is available) are
+extracted on a worker thread while their bytes stream in, so
+the compressed file is never written (or re-read) unless
+`=keep` asks for it to be stored as the mirror entry of the
+URL without the fragment.  Zip files cannot be read as a stream,
+so they are downloaded first, then extracted.  An archive the
+mirror already holds is extracted from there.
+
+Like every mirror download, the tree is built in the mirror's
+`.aurl/tmp` and only moved into place once complete.
+"""
+from typing import Optional, BinaryIO, List, Callable, Any
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+import asyncio
+import os
+import queue
+import tarfile
+import zipfile
+import logging
+_logger = logging.getLogger(__name__)
+
+from .exceptions import DownloadException
+from .urls import URL
+from .mirror import Mirror
+from . import progress
+
+#: fragments marking a URL to be extracted
+extract_fragments = ("extract", "extract=keep")
+
+#: archive suffixes -> kind of archive
+archive_suffixes = {
+    ".tar": "tar", ".tar.gz": "tar", ".tgz": "tar",
+    ".tar.bz2": "tar", ".tbz2": "tar", ".tar.xz": "tar", ".txz": "tar",
+    ".tar.zst": "zst", ".tzst": "zst",
+    ".zip": "zip",
+}
+
+#: chunks buffered between the download and the extracting thread
+pipe_depth = 16
+#: threads extracting archives
+extract_threads = 8
+_pool : Optional[ThreadPoolExecutor] = None
+
+def extract_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(extract_threads,
+                                   thread_name_prefix="aurl-extract")
+    return _pool
+
+def is_extract(url : URL) -> bool:
+    return url.fragment in extract_fragments
+
+def keep_archive(url : URL) -> bool:
+    return url.fragment == "extract=keep"
+
+def archive_url(url : URL) -> URL:
+    # The archive itself (url without its fragment).
+    return URL(url.s.split("#", 1)[0])
+
+def archive_kind(url : URL) -> str:
+    for suffix, kind in archive_suffixes.items():
+        if url.path.endswith(suffix):
+            return kind
+    raise DownloadException(f"{url.s}: unknown archive type")
+
+class Pipe:
+    """ Bytes handed from the event loop to a reading thread, in order.
+
+        The thread reads it as a file.  Everything read
+        is also appended to `keep` (if given).
+    """
+    def __init__(self, keep : Optional[BinaryIO] = None, depth : int = pipe_depth):
+        self.q : "queue.Queue[Optional[bytes]]" = queue.Queue(depth)
+        self.keep = keep
+        self.buf = memoryview(b"")
+        self.eof = False
+        self.aborted = False
+        self.loop = asyncio.get_running_loop()
+        self.space = asyncio.Event() # set when the reader takes a chunk
+        self.started = asyncio.Event() # set when a thread starts reading
+
+    async def put(self, data : Optional[bytes]) -> None:
+        # Queue data (None for end of stream), waiting while the pipe is full.
+        while True:
+            if self.aborted:
+                raise DownloadException("extraction stopped")
+            try:
+                self.q.put_nowait(data)
+                return
+            except queue.Full:
+                self.space.clear()
+                if self.q.full() and not self.aborted:
+                    await self.space.wait()
+
+    def abort(self) -> None:
+        # Stop both ends.
+        self.aborted = True
+        try:
+            while True:
+                self.q.get_nowait()
+        except queue.Empty:
+            pass
+        self.q.put_nowait(None)
+        self.wake()
+
+    def wake(self) -> None:
+        # (thread-safe) wake a waiting put
+        self.loop.call_soon_threadsafe(self.space.set)
+
+    def _fill(self) -> None:
+        while len(self.buf) == 0 and not self.eof:
+            b = self.q.get()
+            self.wake()
+            if self.aborted:
+                raise DownloadException("download stopped")
+            if b is None:
+                self.eof = True
+            else:
+                self.buf = memoryview(b)
+                if self.keep is not None:
+                    self.keep.write(b)
+
+    def read(self, n : int = -1) -> bytes:
+        out : List[bytes] = []
+        while n != 0:
+            self._fill()
+            if self.eof:
+                break
+            k = len(self.buf) if n < 0 else min(n, len(self.buf))
+            out.append(bytes(self.buf[:k]))
+            self.buf = self.buf[k:]
+            if n > 0:
+                n -= k
+        return b"".join(out)
+
+    def drain(self) -> None:
+        # Read to the end of the stream (so the download completes).
+        while not self.eof:
+            self.buf = memoryview(b"")
+            self._fill()
+
+def zstd_reader(f : BinaryIO) -> BinaryIO:
+    try:
+        from compression import zstd # type: ignore[import-not-found]
+        return zstd.ZstdFile(f) # type: ignore[no-any-return]
+    except ImportError:
+        pass
+    try:
+        import zstandard # type: ignore[import-not-found]
+    except ImportError:
+        raise DownloadException("zstd archives need the zstandard package")
+    return zstandard.ZstdDecompressor().stream_reader(f) # type: ignore[no-any-return]
+
+def check_member(info : tarfile.TarInfo) -> None:
+    # For Pythons without tarfile's extraction filters.
+    name = PurePosixPath(info.name)
+    if name.is_absolute() or ".." in name.parts:
+        raise DownloadException(f"Unsafe archive member: {info.name}")
+    if info.issym() or info.islnk():
+        target = PurePosixPath(info.linkname)
+        if target.is_absolute() or ".." in target.parts:
+            raise DownloadException(f"Unsafe link in archive: {info.name} -> {info.linkname}")
+    if not (info.isreg() or info.isdir() or info.issym() or info.islnk()):
+        raise DownloadException(f"Unsupported archive member: {info.name}")
+
+def extract_tar(tar : tarfile.TarFile, dest : Path) -> None:
+    # Extract members in archive order (works on streams).
+    dest.mkdir(parents=True, exist_ok=True)
+    if hasattr(tarfile, "data_filter"):
+        tar.extractall(dest, filter="data")
+        return
+    for info in tar:
+        check_member(info)
+        tar.extract(info, dest, set_attrs=not info.isdir())
+
+def unpack_stream(pipe : Pipe, kind : str, dest : Path) -> None:
+    # Extract the archive arriving through pipe (run on a thread).
+    pipe.loop.call_soon_threadsafe(pipe.started.set)
+    try:
+        src : BinaryIO = pipe # type: ignore[assignment]
+        if kind == "zst":
+            src = zstd_reader(src)
+        with tarfile.open(fileobj=src, mode="r|*") as tar:
+            extract_tar(tar, dest)
+        pipe.drain()
+    except BaseException:
+        pipe.aborted = True # stop the download
+        pipe.wake()
+        raise
+
+def unpack_file(path : Path, kind : str, dest : Path) -> None:
+    # Extract an archive held locally (run on a thread).
+    if kind == "zip":
+        with zipfile.ZipFile(path) as z:
+            z.extractall(dest) # sanitizes names
+        return
+    with open(path, "rb") as f:
+        src : BinaryIO = f
+        if kind == "zst":
+            src = zstd_reader(f)
+        with tarfile.open(fileobj=src, mode="r|*") as tar:
+            extract_tar(tar, dest)
+
+async def pump(url : URL, pipe : Pipe, retry, chunk_size : int = 1024**2) -> int:
+    # Stream url into pipe, resuming with a Range request after
+    # transient errors.  Returns the number of bytes sent.
+    #
+    # Attempts are counted afresh whenever one makes progress, and
+    # transfer errors outlasting the retries raise a TransferError.
+    from .fetch import split_url, open_session, StatusError, retry_after, \
+                       TransferError, transfer_errors
+    base, rel = split_url(url)
+    fp = progress.current.get()
+    pos = 0
+    attempt = 0
+    async with open_session(base) as session:
+        while True:
+            start = pos
+            headers = {"Range": f"bytes={pos}-"} if pos > 0 else {}
+            try:
+                async with session.get(rel, allow_redirects=True,
+                                       headers=headers) as response:
+                    if response.status not in (200, 206):
+                        raise StatusError("Download error on %s: received status %d"%
+                                          (url, response.status),
+                                          response.status, retry_after(response))
+                    if pos > 0 and response.status != 206:
+                        raise DownloadException(f"{url.s}: cannot resume at byte {pos}")
+                    if pos == 0 and fp is not None:
+                        fp.expect(response.content_length)
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        await pipe.put(chunk)
+                        pos += len(chunk)
+                        if fp is not None:
+                            fp.add(len(chunk))
+                break
+            except (StatusError,) + transfer_errors as e:
+                if pos > start:
+                    attempt = 0
+                attempt += 1
+                try:
+                    await retry.pause(e, attempt, f"Streaming {url.s}")
+                except transfer_errors as err:
+                    raise TransferError("Download error on %s: %s: %s"%(
+                                        url.s, type(err).__name__, err), err) from err
+    await pipe.put(None)
+    return pos
+
+async def unpack(fn : Callable[..., None], *args : Any) -> None:
+    # Run fn on the extraction pool, reporting its failures
+    # as DownloadExceptions.
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(extract_pool(), fn, *args)
+    except DownloadException:
+        raise
+    except Exception as e: # tarfile, zipfile, decompressor or OS errors
+        raise DownloadException(f"Unable to extract: {type(e).__name__}: {e}")
+
+async def stream_extract(url : URL, kind : str, dest : Path,
+                         keep : Optional[Path], retry) -> int:
+    """ Download the archive at url, extracting it into dest
+        as it arrives (and writing it to `keep`, if given).
+
+        Returns the archive's size.
+
+        raises DownloadException on error.
+    """
+    f = open(keep, "wb") if keep is not None else None
+    try:
+        pipe = Pipe(f)
+        job = asyncio.ensure_future(unpack(unpack_stream, pipe, kind, dest))
+        try:
+            # Only open the stream once a thread is reading it,
+            # so queued extractions do not hold stalled connections.
+            started = asyncio.ensure_future(pipe.started.wait())
+            try:
+                await asyncio.wait([started, job],
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                started.cancel()
+            if job.done():
+                await job # failed before reading
+            size = await pump(url, pipe, retry)
+        except BaseException:
+            extract_failed = pipe.aborted
+            pipe.abort()
+            try:
+                await job
+            except DownloadException as e:
+                if extract_failed: # report why
+                    raise e from None
+            raise
+        await job
+    finally:
+        if f is not None:
+            f.close()
+    return size
+
+async def fetch_extracted(M : Mirror, url : URL, dest : Path) -> Path:
+    """ Fetch the archive for url into M's temporary
+        location `dest`, unpacked as a directory.
+
+        Called by Mirror, which moves dest into place.
+    """
+    from .fetch import default_retry
+    src = archive_url(url)
+    kind = archive_kind(src)
+    held = M.encode(src)
+    if held.is_file():
+        _logger.info("Extracting %s", held)
+        await unpack(unpack_file, held, kind, dest)
+        return dest
+
+    keep = dest.with_name(dest.name + ".archive") if keep_archive(url) else None
+    sources = [archive_url(s) for s in [src] + M.alternates.get(src, [])
+                                         + M.alternates.get(url, [])]
+    sources = [s for s in sources if s.scheme in ("http", "https")]
+    if kind == "zip" or len(sources) == 0:
+        # not streamable: download, then extract
+        arch = dest.with_name(dest.name + ".archive")
+        got = await M._fetch_to(src, held, arch)
+        await unpack(unpack_file, got, kind, dest)
+        keep = arch if keep is not None and got == arch else None
+    else:
+        errors : List[str] = []
+        for s in sources:
+            try:
+                await stream_extract(s, kind, dest, keep, M.retry or default_retry)
+                break
+            except DownloadException as e:
+                _logger.info("%s: %s", s, e)
+                errors.append(f"{s.s}: {e}")
+                clear(dest)
+        else:
+            raise DownloadException("Extract errors:\n  - " + "\n  - ".join(errors))
+
+    if keep is not None:
+        rel = held.relative_to(M.base).as_posix()
+        async with M.locks.lock(rel):
+            if not held.exists():
+                held.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(keep, held)
+    return dest
+
+def clear(p : Path) -> None:
+    import shutil
+    if p.is_dir():
+        shutil.rmtree(p)
+    elif p.exists():
+        p.unlink()
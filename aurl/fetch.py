@@ -1,19 +1,28 @@
-from typing import Optional, Dict, Tuple, Union
+from typing import Optional, Dict, Tuple, Union, FrozenSet, AsyncIterator
 import logging
 _logger = logging.getLogger(__name__)
 import time
+import random
+import re
+import shutil
+from collections import Counter
+from dataclasses import dataclass, field
+from functools import cache
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from urllib.parse import urlsplit, urlunsplit
 
 from pathlib import Path
 import asyncio
 
 import aiohttp
-import aiofiles
 
 from .exceptions import DownloadException
+from .writer import FileWriter, RangeWriter, check_space
 from .urls import URL
 from .search import which, lookup_local
-from .runcmd import runcmd
+from .runcmd import runcmd_stream
+from . import progress
 from .aftp import download_ftp
 
 Pstr = Union[str, Path]
@@ -21,34 +30,157 @@ Pstr = Union[str, Path]
 class UnsupportedOperation(Exception):
     pass
 
-async def download_part(session: aiohttp.ClientSession, url: str, dest: Pstr,
-                        start: int, end: int, chunk_size: int):
-    """ Download part of this URL using a Range header request
-        between start and end (slice-like, 0-indexed, non-inclusive).
+class StatusError(DownloadException):
+    # An HTTP error status, which may be worth retrying.
+    def __init__(self, msg : str, status : int,
+                 retry_after : Optional[float] = None):
+        super().__init__(msg)
+        self.status = status
+        self.retry_after = retry_after
 
-        Write the result to the destination file at the starting offset.
+class TransferError(DownloadException):
+    # A connection-level failure (refused, reset, timed out...),
+    # which may be worth retrying.
+    def __init__(self, msg : str, cause : BaseException):
+        super().__init__(msg)
+        self.why = type(cause).__name__
 
-        Raises UnsupportedOperation if the download should be re-tried in serial.
+#: errors from aiohttp meaning the transfer failed
+transfer_errors = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
 
-        Raises DownloadException on other responses.
+@dataclass
+class RetryStats:
+    """ Running counts of retries, for monitoring.
     """
-    assert start >= 0 and end > start, "Invalid range"
+    retries: int = 0  #: attempts repeated after a transient error
+    failures: int = 0 #: ranges given up on after all attempts
+    reasons: Counter = field(default_factory=Counter) #: retries by cause
+
+@dataclass
+class RetryPolicy:
+    """ When and how often to retry a failed byte range.
+
+        Attempt n (counting from 1) that fails with a retryable
+        error is followed by a delay of
+        `min(max_backoff, backoff * 2**(n-1))`,
+        scaled by a random factor in `[1-jitter, 1+jitter]`
+        (and at least the server's Retry-After, if given).
+        Only the bytes not yet written are requested again.
+    """
+    attempts: int = 5          #: total tries per range
+    backoff: float = 0.5       #: first delay (seconds)
+    max_backoff: float = 30.0  #: longest delay (seconds)
+    jitter: float = 0.5
+    statuses: FrozenSet[int] = frozenset({408, 425, 429, 500, 502, 503, 504})
+    stats: RetryStats = field(default_factory=RetryStats)
+
+    def delay(self, attempt : int, retry_after : Optional[float] = None) -> float:
+        d = min(self.max_backoff, self.backoff * 2**(attempt-1))
+        d *= random.uniform(1-self.jitter, 1+self.jitter)
+        if retry_after is not None:
+            d = max(d, retry_after)
+        return d
+
+    def reason(self, e : BaseException) -> Optional[str]:
+        # Name the cause of a retryable error, or None if e is fatal.
+        if isinstance(e, StatusError):
+            return f"status {e.status}" if e.status in self.statuses else None
+        if isinstance(e, TransferError):
+            return e.why
+        if isinstance(e, transfer_errors):
+            return type(e).__name__
+        return None
+
+    async def pause(self, e : Exception, attempt : int, what : str) -> None:
+        # Sleep before retrying after attempt number `attempt`
+        # failed with e -- or re-raise e if it should not be retried.
+        why = self.reason(e)
+        if why is None or attempt >= self.attempts:
+            if why is not None:
+                self.stats.failures += 1
+            raise e
+        d = self.delay(attempt, getattr(e, "retry_after", None))
+        self.stats.retries += 1
+        self.stats.reasons[why] += 1
+        _logger.info("%s failed (%s), retry %d in %.1fs", what, why, attempt, d)
+        await asyncio.sleep(d)
+
+#: policy used when none is given (its stats count all such downloads)
+default_retry = RetryPolicy()
+
+def retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError): # missing, or an HTTP-date
+        return None
+
+async def get_range(session: aiohttp.ClientSession, url: str, f: RangeWriter,
+                    end: int, chunk_size: int) -> None:
+    # Request bytes [f.pos, end) once, writing them through f.
+    start = f.pos
     headers = {"Range": f"bytes={start}-{end-1}"}
     async with session.get(url, allow_redirects=True, headers=headers) as response:
         if response.status == 206:  # Partial Content
-            async with aiofiles.open(dest, mode="r+b") as f:
-                await f.seek(start)
+            try:
                 async for chunk in response.content.iter_chunked(chunk_size):
-                    await f.write(chunk)
+                    await f.write(chunk[:end-f.pos])
+            finally: # keep what was received
+                await f.flush()
+            if f.pos < end:
+                raise aiohttp.ClientPayloadError("%s: short read (%d of %d-%d)"%
+                                                 (url, f.pos, start, end))
         elif response.status in [200, 501]: # ignored / not implemented
             _logger.info("%s: GET with Range failed with %d", url, response.status)
             raise UnsupportedOperation()
         else:
-            raise DownloadException("Download error on %s (%d-%d): received status %d"%
-                                    (url, start, end, response.status))
+            raise StatusError("Download error on %s (%d-%d): received status %d"%
+                              (url, start, end, response.status),
+                              response.status, retry_after(response))
+
+async def download_part(session: aiohttp.ClientSession, url: str, dest: FileWriter,
+                        start: int, end: int, chunk_size: int,
+                        retry: Optional[RetryPolicy] = None):
+    """ Download part of this URL using a Range header request
+        between start and end (slice-like, 0-indexed, non-inclusive).
 
-async def download_full(session: aiohttp.ClientSession, url: str, dest: Pstr,
-                        chunk_size: int):
+        Write the result to the destination file at the starting offset.
+
+        Transient errors (see RetryPolicy) are retried, requesting
+        only the part of the range not yet written.  Attempts
+        are counted afresh whenever one makes progress.
+
+        Raises UnsupportedOperation if the download should be re-tried in serial.
+
+        Raises DownloadException on other responses.
+    """
+    assert start >= 0 and end > start, "Invalid range"
+    if retry is None:
+        retry = default_retry
+    f = dest.part(start)
+    attempt = 1
+    while True:
+        pos = f.pos
+        try:
+            return await get_range(session, url, f, end, chunk_size)
+        except Exception as e:
+            if f.pos > pos: # progress was made, so start counting again
+                attempt = 1
+            await retry.pause(e, attempt, "%s: range %d-%d at %d"%(
+                                          url, start, end, f.pos))
+        attempt += 1
+
+async def write_body(response: aiohttp.ClientResponse, dest: FileWriter,
+                     chunk_size: int) -> int:
+    # Write the whole response body to dest, returning its length.
+    f = dest.part(0)
+    async for chunk in response.content.iter_chunked(chunk_size):
+        await f.write(chunk)
+    await f.flush()
+    dest.truncate(f.written)
+    return f.written
+
+async def download_full(session: aiohttp.ClientSession, url: str, dest: FileWriter,
+                        chunk_size: int) -> int:
     """ Download the URL contents to file.
 
         Raises DownloadException on error.
@@ -57,39 +189,263 @@ async def download_full(session: aiohttp.ClientSession, url: str, dest: Pstr,
         if response.status != 200:
             raise DownloadException("Download error on %s: received status %d"%
                                     (url, response.status))
-        async with aiofiles.open(dest, mode="wb") as f:
-            async for chunk in response.content.iter_chunked(chunk_size):
-                await f.write(chunk)
-            return await f.tell()
+        dest.restart()
+        return await write_body(response, dest, chunk_size)
+
+def split_url(url1: Union[str, URL]) -> Tuple[str, str]:
+    """ Rewrite the URL so that the scheme and netloc appear in the base.
+
+        Returns (base, relative url)
+    """
+    (scheme, netloc, path, query, fragment) = urlsplit(str(url1))
+    base = urlunsplit((scheme, netloc,"","",""))
+    url  = urlunsplit(("","",path,query,fragment))
+    return base, url
+
+@cache
+def session_factory():
+    """ Return the ClientSession constructor to use.
+        Sessions are created by certified if it is installed.
+
+        The result is computed once per process.
+    """
+    try:
+        from certified import Certified # type: ignore[import-not-found]
+        return Certified().ClientSession
+    except ImportError:
+        return aiohttp.ClientSession
+
+#: longest wait to connect, and between reads of a response (seconds)
+connect_timeout = 60.0
+read_timeout = 300.0
+
+def session_timeout() -> aiohttp.ClientTimeout:
+    # No limit on a whole transfer (slow but steady downloads
+    # may take hours), only on each connect and read.
+    return aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout,
+                                 sock_read=read_timeout)
+
+def content_range_total(response: aiohttp.ClientResponse) -> Optional[int]:
+    # Total size from a "bytes a-b/total" or "bytes */total" Content-Range.
+    try:
+        total = response.headers["Content-Range"].rsplit("/", 1)[1]
+        return int(total)
+    except (KeyError, IndexError, ValueError): # missing, or "*"
+        return None
+
+async def download_ranges(session: aiohttp.ClientSession, url: str,
+                          dest: FileWriter, start: int, end: int,
+                          chunk_size: int, max_connections: int,
+                          retry: Optional[RetryPolicy] = None) -> None:
+    """ Download bytes [start, end) of url into dest, split into
+        (at most) max_connections parallel range requests.
+
+        Raises UnsupportedOperation if the server does not honor ranges.
+    """
+    chunks = (end-start+chunk_size-1)//chunk_size
+    connections = min(chunks, max_connections)
+
+    # note we always have chunks >= connections
+    data_per_task = ( chunks // connections ) * chunk_size
+
+    tasks = []
+    for i in range(connections):
+        a = start + i * data_per_task
+        b = a + data_per_task
+        if i == connections-1:
+            b = end  # Ensure the last part goes to the end
+        tasks.append(asyncio.create_task(download_part(session, url, dest,
+                                                       a, b, chunk_size,
+                                                       retry)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # no writes may be outstanding when dest is closed
+        await cancel_all(tasks)
+
+async def first_chunk(session: aiohttp.ClientSession, url: str,
+                      chunk_size: int) -> aiohttp.ClientResponse:
+    # Request the first chunk of url (see download_probed).
+    #
+    # Raises TransferError if the request could not be made, or
+    # StatusError for an unexpected status.
+    headers = {"Range": f"bytes=0-{chunk_size-1}"}
+    try:
+        response = await session.get(url, allow_redirects=True,
+                                     headers=headers)
+    except transfer_errors as e:
+        raise TransferError("Download error on %s: %s: %s"%(
+                            url, type(e).__name__, e), e) from e
+    if response.status not in (200, 206, 416, 501):
+        response.release()
+        raise StatusError("Download error on %s: received status %d"%
+                          (url, response.status),
+                          response.status, retry_after(response))
+    return response
+
+async def download_probed(session: aiohttp.ClientSession, url: str,
+                          dest: Path, chunk_size: int, max_connections: int,
+                          use_mmap: bool, retry: RetryPolicy) -> int:
+    """ Download url, learning its size from the first response.
+
+        The first request asks for the first chunk only
+        (`Range: bytes=0-{chunk_size-1}`).  The total size is read
+        from its Content-Range, and the rest of the file (if any)
+        is requested in parallel while the first chunk streams in.
+        A server ignoring the Range header sends the whole file,
+        which is written as-is, and one refusing it (501, or a 206
+        without a size) is asked for the whole file instead.
+
+        Only the first request is retried here (according to
+        `retry`); the other ranges retry on their own.
+    """
+    attempt = 1
+    while True:
+        try:
+            first_response = await first_chunk(session, url, chunk_size)
+            break
+        except (StatusError, TransferError) as e: # before any data was received
+            await retry.pause(e, attempt, "%s: first chunk"%url)
+        attempt += 1
+    async with first_response as response:
+        if response.status == 200: # Range ignored
+            size = response.content_length
+            if size is not None:
+                check_space(dest, size)
+            with FileWriter(dest, size) as w:
+                return await write_body(response, w, chunk_size)
+        total = content_range_total(response)
+        if response.status == 416 and total == 0: # empty file
+            FileWriter(dest).close()
+            return 0
+        if response.status == 501 or (response.status == 206 and total is None):
+            _logger.info("%s: GET with Range failed (%d)", url, response.status)
+            response.release()
+            with FileWriter(dest) as w:
+                return await download_full(session, url, w, chunk_size)
+        if response.status != 206 or total is None:
+            raise StatusError("Download error on %s: received status %d"%
+                              (url, response.status),
+                              response.status, retry_after(response))
+
+        first = min(chunk_size, total)
+        check_space(dest, total)
+        with FileWriter(dest, total, use_mmap) as w:
+            rest = None
+            if total > first:
+                rest = asyncio.create_task(download_ranges(
+                            session, url, w, first, total, chunk_size,
+                            max(1, max_connections-1), retry))
+            try:
+                f = w.part(0)
+                try:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        await f.write(chunk[:first-f.pos])
+                        if f.pos >= first:
+                            break
+                except Exception as e:
+                    if retry.reason(e) is None:
+                        raise
+                    _logger.info("%s: first chunk failed at %d (%s)", url, f.pos, e)
+                finally:
+                    await f.flush()
+                if f.pos < first: # finish the first chunk
+                    await download_part(session, url, w, f.pos, first,
+                                        chunk_size, retry)
+                if rest is not None:
+                    await rest
+            except UnsupportedOperation:
+                if rest is not None:
+                    await cancel_all([rest])
+                return await download_full(session, url, w, chunk_size)
+            finally:
+                if rest is not None:
+                    await cancel_all([rest])
+    return total
+
+class SessionPool:
+    """ Client sessions kept open for re-use, one per base URL.
+
+        Long-running processes (e.g. the mirror daemon) install
+        one with `sessions.set(SessionPool())`, so that downloads
+        re-use warm connections.
+    """
+    def __init__(self):
+        self.sessions : Dict[str, aiohttp.ClientSession] = {}
+
+    def get(self, base : str) -> aiohttp.ClientSession:
+        s = self.sessions.get(base)
+        if s is None or s.closed:
+            s = self.sessions[base] = session_factory()(
+                                            base, timeout=session_timeout())
+        return s
+
+    async def close(self) -> None:
+        for s in self.sessions.values():
+            await s.close()
+        self.sessions.clear()
+
+#: sessions shared by downloads in the current context (if any)
+sessions : ContextVar[Optional[SessionPool]] = ContextVar("aurl_sessions",
+                                                          default=None)
+
+@asynccontextmanager
+async def open_session(base : str) -> AsyncIterator[aiohttp.ClientSession]:
+    # A session for base -- pooled, if a SessionPool is installed.
+    pool = sessions.get()
+    if pool is not None:
+        yield pool.get(base)
+        return
+    async with session_factory()(base, timeout=session_timeout()) as session:
+        yield session
 
 # try 1024**2 or 8192...
 async def download_url(outfile: Pstr,
                        url1: Union[str, URL],
                        chunk_size: int = 1024**2,
-                       max_connections: int = 4) -> int:
+                       max_connections: int = 4,
+                       use_mmap: bool = False,
+                       retry: Optional[RetryPolicy] = None,
+                       probe: bool = True) -> int:
     """ Download the url to the given output file.
 
-        Raises a DownloadException on error.
+        The file is preallocated (after checking for free space)
+        and all ranges are written through one FileWriter.
+        Each range is retried according to `retry`.
+
+        With `probe` (the default), the first request fetches the
+        first chunk and learns the file size from its Content-Range,
+        so small files take a single round-trip (see download_probed).
+        Otherwise, the size is found with a HEAD request first.
+
+        Raises a DownloadException on error (a TransferError
+        for connection failures that outlast the retries).
 
         Returns the downloaded file size (in bytes) on success.
     """
     assert chunk_size > 0 and max_connections > 0
-    dest = Path(outfile)
-    dest.parent.mkdir(exist_ok=True, parents=True)
+    try:
+        return await _download_url(Path(outfile), url1, chunk_size,
+                                   max_connections, use_mmap, retry, probe)
+    except transfer_errors as e:
+        raise TransferError("Download error on %s: %s: %s"%(
+                            url1, type(e).__name__, e), e) from e
 
-    # Rewrite the URL so that the scheme and netloc appear in the base.
-    (scheme, netloc, path, query, fragment) = urlsplit(str(url1))
-    base = urlunsplit((scheme, netloc,"","",""))
-    url  = urlunsplit(("","",path,query,fragment))
+async def _download_url(dest: Path, url1: Union[str, URL], chunk_size: int,
+                        max_connections: int, use_mmap: bool,
+                        retry: Optional[RetryPolicy], probe: bool) -> int:
+    dest.parent.mkdir(exist_ok=True, parents=True)
+    if retry is None:
+        retry = default_retry
 
-    try:
-        from certified import Certified # type: ignore[import-not-found]
-        mk_session = Certified().ClientSession
-    except ImportError:
-        mk_session = aiohttp.ClientSession # type: ignore[assignment]
+    base, url = split_url(url1)
 
     file_size: Optional[int] = None
-    async with mk_session(base) as session:
+    async with open_session(base) as session:
+        if probe:
+            return await download_probed(session, url, dest, chunk_size,
+                                         max_connections, use_mmap, retry)
+
         async with session.head(url, allow_redirects=True) as response:
             if response.status == 200:
                 if 'Content-Length' in response.headers:
@@ -99,55 +455,101 @@ async def download_url(outfile: Pstr,
             async with session.get(url, allow_redirects=True) as response:
                 if response.status != 200:
                     raise DownloadException("%s: Error getting size (%d): %s"%(
-                                            url1, response.status, response.text()))
+                                            url1, response.status, await response.text()))
                 if 'Content-Length' in response.headers:
                     file_size = int(response.headers.get('Content-Length', 0))
                 else: # just download the file
-                    async with aiofiles.open(dest, mode="wb") as f:
-                        async for chunk in response.content.iter_chunked(chunk_size):
-                            await f.write(chunk)
-                        return await f.tell()
+                    with FileWriter(dest) as w:
+                        return await write_body(response, w, chunk_size)
+
+        check_space(dest, file_size)
+        with FileWriter(dest, file_size, use_mmap) as w:
+            if file_size == 0:
+                return 0
+            try:
+                await download_ranges(session, url, w, 0, file_size,
+                                      chunk_size, max_connections, retry)
+            except UnsupportedOperation:
+                return await download_full(session, url, w, chunk_size)
+    return file_size
 
-        if file_size == 0:
-            async with aiofiles.open(dest, mode="wb") as f:
+async def cancel_all(tasks) -> None:
+    # run the complicated cleanup from partially complete gather.
+    [t.cancel() for t in tasks if not t.done()]
+    for t in tasks:
+        if not t.done():
+            try:
+                await t
+            except (asyncio.CancelledError, Exception):
                 pass
-            return 0
-        # Create an empty file with the total size
-        async with aiofiles.open(dest, mode="wb") as f:
-            await f.seek(file_size - 1)
-            await f.write(b'\0')
-
-        chunks = (file_size+chunk_size-1)//chunk_size
-        connections = min(chunks, max_connections)
-
-        # note we always have chunks >= connections
-        data_per_task = ( chunks // connections ) * chunk_size
-
-        tasks = []
-        for i in range(connections):
-            start =   i * data_per_task
-            end = start + data_per_task
-            if i == connections-1:
-                end = file_size  # Ensure the last part goes to the end
-            task = asyncio.create_task(download_part(session, url, dest,
-                                                     start, end, chunk_size))
-            tasks.append(task)
 
-        try:
-            await asyncio.gather(*tasks)
-        except UnsupportedOperation:
-            # run the complicated cleanup from partially complete gather.
-            [t.cancel() for t in tasks if not t.done()]
-            for t in tasks:
-                if not t.done():
-                    try:
-                        await t
-                    except (asyncio.CancelledError, UnsupportedOperation):
-                        pass
-            return await download_full(session, url, dest, chunk_size)
-    return file_size
+#: longest a git clone may run (seconds, None for no limit)
+git_timeout : Optional[float] = 6*3600.0
+#: longest a git clone may go without reporting progress (seconds)
+git_stall : Optional[float] = 600.0
+
+_units = {"B": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3, "TiB": 1024**4}
+_received = re.compile(r"Receiving objects:.*?([0-9.]+) (B|KiB|MiB|GiB|TiB)\b")
+
+def git_received(line : str) -> Optional[int]:
+    # Bytes received so far, from a `git clone --progress` line, e.g.
+    # "Receiving objects:  45% (450/1000), 1.20 MiB | 2.00 MiB/s"
+    m = _received.match(line)
+    if m is None:
+        return None
+    return int(float(m[1]) * _units[m[2]])
+
+async def git_clone(url : URL, base : Path) -> None:
+    """ Clone the repository at a git URL into base,
+        counting the bytes git reports receiving in the
+        current download's progress (if tracked).
+
+        Clones running longer than `git_timeout`, or silent
+        for `git_stall` seconds, are killed.  A failed clone
+        leaves nothing at base.
+
+        raises DownloadException on error.
+    """
+    base.parent.mkdir(exist_ok=True, parents=True)
+    gurl = url.s
+    if gurl.startswith("git+"):
+        gurl = gurl[4:]
+    if gurl.startswith("file:/") and not gurl.startswith("file://"):
+        gurl = "file://" + gurl[5:] # URL normalizes away the empty netloc
+    args = ["clone", "--progress"]
+    if '@' in url.s:
+        gurl, commit = gurl.split('@', 1)
+        args += ["--branch", commit]
+    args += [gurl, str(base)]
+
+    fp = progress.current.get()
+    if fp is not None:
+        fp.expect(None)
+    done = 0
+    def on_line(line : str) -> None:
+        nonlocal done
+        n = git_received(line)
+        if n is not None and n > done:
+            if fp is not None:
+                fp.add(n - done)
+            done = n
+        _logger.debug("git: %s", line)
+
+    try:
+        ret, err = await runcmd_stream("git", *args, on_line=on_line,
+                                       timeout=git_timeout, stall=git_stall)
+    except asyncio.TimeoutError:
+        err = f"git clone of {url.s} timed out"
+        ret = -1
+    except BaseException:
+        shutil.rmtree(base, ignore_errors=True)
+        raise
+    if ret != 0:
+        shutil.rmtree(base, ignore_errors=True)
+        raise DownloadException(err)
 
-async def lookup_or_fetch(url : URL, hostname : str, base : Path) -> Path:
+async def lookup_or_fetch(url : URL, hostname : str, base : Path,
+                          retry : Optional[RetryPolicy] = None) -> Path:
     # Resolve URL and download.
     #
     # Base is the location to store the final result
@@ -163,7 +565,7 @@ async def lookup_or_fetch(url : URL, hostname : str, base : Path) -> Path:
     #    - git://* - run git clone
     #    - git+(http|https|ssh)://* - run git clone
     #    - file://* TODO - check multiple filesystems
-    #    - result://* TODO - escalate to higher-level servers
+    #    - result://* - only available from a Mirror's peers
     #
     #
     # May throw a DownloadException
@@ -179,23 +581,12 @@ async def lookup_or_fetch(url : URL, hostname : str, base : Path) -> Path:
         return base
     elif url.scheme == "http" or url.scheme == "https":
         t0 = time.time()
-        sz = await download_url(base, url.s)
+        sz = await download_url(base, url.s, retry=retry)
         dt = time.time() - t0
         _logger.info("%s: %d bytes at %f Mbps", url, sz, sz*8/1024**2/dt)
         return base
     elif url.scheme.startswith("git"):
-        base.parent.mkdir(exist_ok=True, parents=True)
-        gurl = url.s
-        if gurl.startswith("git+"):
-            gurl = gurl[4:]
-        if '@' in url.s:
-            gurl, commit = gurl.split('@', 1)
-            ret, out, err = await runcmd("git", "clone", "--branch",
-                                         commit, gurl, str(base))
-        else:
-            ret, out, err = await runcmd("git", "clone", gurl, str(base))
-        if ret != 0:
-            raise DownloadException(err)
+        await git_clone(url, base)
         return base
     elif url.scheme == "file":
         if url.netloc == hostname or len(url.netloc) == 0:
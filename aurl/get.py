@@ -5,10 +5,11 @@ __author__ = "David M. Rogers"
 __copyright__ = "UT-Battelle LLC"
 __license__ = "BSD3"
 
-from typing import List, Optional
+from typing import List, Optional, Dict, TextIO, BinaryIO, AsyncIterator
 from pathlib import Path
 import asyncio
 import logging
+import sys
 _logger = logging.getLogger(__name__)
 
 import typer
@@ -16,13 +17,71 @@ import json
 
 from .mirror import Mirror
 from .urls import URL
+from .progress import Progress, Display, with_progress
 from . import arun
 
 app = typer.Typer()
 
+async def read_lines(f : BinaryIO, size : int = 1<<16) -> AsyncIterator[str]:
+    # Non-blank lines of f, as they become available
+    # (read on a thread, so a slow stdin does not block the event loop).
+    loop = asyncio.get_running_loop()
+    rest = b""
+    while True:
+        data = await loop.run_in_executor(None, f.read1, size) # type: ignore[attr-defined]
+        if len(data) == 0:
+            break
+        lines = (rest + data).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0:
+                yield line.decode("utf-8")
+    if len(rest.strip()) > 0:
+        yield rest.strip().decode("utf-8")
+
+async def fetch_stream(M : Mirror, lines : AsyncIterator[str],
+                       out : Optional[TextIO] = None) -> int:
+    """ Fetch the url on each line, printing one JSON object
+        per url as it completes::
+
+            {"url": ..., "path": ...} or {"url": ..., "error": ...}
+
+        Returns the number of failures.
+    """
+    failed = 0
+    def emit(rec : Dict[str, str]) -> None:
+        f = sys.stdout if out is None else out
+        f.write(json.dumps(rec) + "\n")
+        f.flush()
+
+    async def parse() -> AsyncIterator[URL]:
+        nonlocal failed
+        async for line in lines:
+            try:
+                yield URL(line)
+            except (AssertionError, ValueError) as e:
+                failed += 1
+                emit({"url": line, "error": str(e)})
+
+    async for url, path, err in M.fetch_each(parse()):
+        if path is None:
+            failed += 1
+            emit({"url": url.s, "error": str(err)})
+        else:
+            emit({"url": url.s, "path": str(path)})
+    return failed
+
 @app.command(help="Download a list of URLs.")
-def get(urls   : List[str] = typer.Argument(..., help="urls to download"),
+def get(urls   : Optional[List[str]] = typer.Argument(None, help="urls to download"),
+        input  : Optional[Path] = typer.Option(None, "--input", "-i", help="also read urls (one per line) from this file, or - for stdin; implies --ndjson"),
+        ndjson : bool = typer.Option(False, help="print one JSON object per url as each completes (using bounded memory)"),
         mirror : Optional[Path] = typer.Option(None, help="directory holding downloaded files"),
+        peer   : Optional[List[str]] = typer.Option(None, help="peer mirror (aurl.serve) to try before the origin, nearest first"),
+        progress : Display = typer.Option(Display.none, help="show download progress on stderr"),
+        daemon   : bool = typer.Option(True, help="use a running `aurl daemon` for this mirror"),
+        plan     : bool = typer.Option(False, help="only report what would be downloaded (sizes, hosts, estimated time)"),
+        coop     : Optional[str] = typer.Option(None, help="share the downloads with other processes joining this named queue in the mirror"),
           v    : bool = typer.Option(False, "-v", help="show info-level logs"),
           vv   : bool = typer.Option(False, "-vv", help="show debug-level logs")):
     if vv:
@@ -31,11 +90,47 @@ def get(urls   : List[str] = typer.Argument(..., help="urls to download"),
         logging.basicConfig(level=logging.INFO)
     if mirror is None:
         mirror = Path()
+    if coop is not None and (ndjson or input is not None):
+        # a queue needs the whole list up-front
+        raise typer.BadParameter("cannot be combined with --input or --ndjson",
+                                 param_hint="--coop")
+
+    M = Mirror( mirror, peers=peer,
+                progress=None if progress == Display.none else Progress(),
+                use_daemon=daemon )
+
+    async def lines() -> AsyncIterator[str]:
+        for u in urls or []:
+            yield u
+        if input is None:
+            return
+        if str(input) == "-":
+            async for u in read_lines(sys.stdin.buffer):
+                yield u
+            return
+        with open(input, "rb") as f:
+            async for u in read_lines(f):
+                yield u
 
-    M = Mirror( mirror )
-    urls1 = [URL(u) for u in urls]
-    paths = arun(M.fetch_all(urls1))
+    if plan:
+        from .plan import show_plan
+        async def plan_all():
+            return await show_plan(M, [URL(u) async for u in lines()])
+        arun(plan_all())
+        return
+    if ndjson or input is not None:
+        failed = arun(with_progress(fetch_stream(M, lines()), M.progress, progress))
+        if failed > 0:
+            raise typer.Exit(1)
+        return
+    urls1 = [URL(u) for u in urls or []]
+    if coop is not None:
+        from .coop import cooperate
+        fetch = cooperate(M, coop, urls1)
+    else:
+        fetch = M.fetch_all(urls1)
+    paths = arun(with_progress(fetch, M.progress, progress))
     print(json.dumps(dict((k.s, str(v)) for k, v in paths.items()), indent=4))
 
 if __name__=="__main__":
-    get()
+    app()
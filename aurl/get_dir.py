@@ -2,7 +2,7 @@ __author__ = "David M. Rogers"
 __copyright__ = "UT-Battelle LLC"
 __license__ = "BSD3"
 
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, AsyncIterator
 from pathlib import Path
 import asyncio
 import logging
@@ -12,8 +12,10 @@ _logger = logging.getLogger(__name__)
 import typer
 import json
 
+from .exceptions import DownloadException
 from .mirror import Mirror
 from .urls import URL
+from .progress import Progress, Display, with_progress
 from . import arun
 
 app = typer.Typer()
@@ -49,9 +51,112 @@ async def get_list(url: str, M: Mirror, max_depth: int = 3,
     await add_tree(url, tree, urls)
     return urls
 
+async def stream_list(url: str, M: Mirror, max_depth: int = -1,
+                      ignore_hidden: bool = True) -> AsyncIterator[URL]:
+    """ Yield the URLs of files below url as its
+        (ndjson) listing arrives from aurl.serve.
+
+        Each page of the listing is requested after the last
+        path received, so a listing interrupted by a transient
+        error (or cut off mid-line) resumes where it stopped
+        (retried by M.retry, counting attempts afresh after
+        any progress).
+        Directories the server did not walk are listed in turn.
+        Servers answering with a JSON document instead are
+        read with get_list.
+
+        raises DownloadException (a TransferError for connection
+        failures) once the retries are used up.
+    """
+    import aiohttp
+    from .fetch import (split_url, open_session, StatusError,
+                        retry_after, default_retry,
+                        TransferError, transfer_errors)
+    retry = M.retry or default_retry
+    base, _ = split_url(url)
+    todo = [url.rstrip("/")]
+    async with open_session(base) as session:
+        while todo:
+            root = todo.pop()
+            _, rel = split_url(root)
+            after = ""
+            attempt = 0
+            legacy = False
+            while True:
+                params = {"format": "ndjson", "max_depth": str(max_depth),
+                          "hidden": "false" if ignore_hidden else "true"}
+                if after:
+                    params["after"] = after
+                cursor = None
+                start = after
+                try:
+                    async with session.get(rel, params=params) as response:
+                        if response.status != 200:
+                            raise StatusError(f"Listing {root} failed with status {response.status}",
+                                              response.status, retry_after(response))
+                        if response.content_type != "application/x-ndjson":
+                            legacy = True # an older server
+                            break
+                        async for line in response.content:
+                            try:
+                                rec = json.loads(line)
+                            except ValueError: # cut off mid-line
+                                raise aiohttp.ClientPayloadError(
+                                        f"Listing {root}: bad line {line[:80]!r}")
+                            if "cursor" in rec:
+                                cursor = rec["cursor"]
+                                continue
+                            after = rec["path"]
+                            if rec.get("more"):
+                                todo.append(f"{root}/{after}")
+                            elif not rec.get("dir"):
+                                yield URL(f"{root}/{after}")
+                except (StatusError,) + transfer_errors as e:
+                    if after != start:
+                        attempt = 0
+                    attempt += 1
+                    try:
+                        await retry.pause(e, attempt, f"Listing {root}")
+                    except transfer_errors as err:
+                        raise TransferError(f"Listing {root} failed: "
+                                            f"{type(err).__name__}: {err}", err) from err
+                    continue
+                if cursor is None:
+                    break
+                after = cursor
+                attempt = 0
+            if legacy:
+                for u in await get_list(root, M, ignore_hidden=ignore_hidden):
+                    yield u
+
+async def fetch_listed(M: Mirror, urls: AsyncIterator[URL],
+                       window: Optional[int] = None) -> Dict[URL, Path]:
+    """ Fetch urls as they are produced (see Mirror.fetch_each).
+
+        Returns a mapping from url to its local path.
+
+        raises DownloadException listing every failure.
+    """
+    location : Dict[URL, Path] = {}
+    errors : List[str] = []
+    async for url, path, err in M.fetch_each(urls, window):
+        if path is not None:
+            location[url] = path
+        else:
+            errors.append(f"{url}: {err}")
+    if len(errors) > 0:
+        raise DownloadException("Download errors:\n  - "
+                                + "\n  - ".join(errors))
+    return location
+
 @app.command(help="Get a directory structure served by aurl.serve.")
 def get_dir(url    : str = typer.Argument(..., help="directory tree root"),
             mirror : Optional[Path] = typer.Option(None, help="directory holding downloaded files"),
+            peer   : Optional[List[str]] = typer.Option(None, help="peer mirror (aurl.serve) to try before the origin, nearest first"),
+            progress : Display = typer.Option(Display.none, help="show download progress on stderr"),
+            daemon   : bool = typer.Option(True, help="use a running `aurl daemon` for this mirror"),
+            plan     : bool = typer.Option(False, help="only report what would be downloaded (sizes, hosts, estimated time)"),
+            stream   : bool = typer.Option(True, help="stream the listing (ndjson), starting downloads as entries arrive"),
             v    : bool = typer.Option(False, "-v", help="show info-level logs"),
             vv   : bool = typer.Option(False, "-vv", help="show debug-level logs")):
     if vv:
@@ -61,10 +166,25 @@ def get_dir(url    : str = typer.Argument(..., help="directory tree root"),
     if mirror is None:
         mirror = Path()
 
-    M = Mirror( mirror )
+    M = Mirror( mirror, peers=peer,
+                progress=None if progress == Display.none else Progress(),
+                use_daemon=daemon )
+
+    async def get_all():
+        if plan:
+            from .plan import show_plan
+            if stream:
+                urls = [u async for u in stream_list(url, M)]
+            else:
+                urls = await get_list(url, M)
+            return await show_plan(M, urls)
+        if stream:
+            return await fetch_listed(M, stream_list(url, M))
+        return await M.fetch_all(await get_list(url, M))
 
-    urls = arun( get_list(url, M) )
-    paths = arun( M.fetch_all(urls) )
+    paths = arun( with_progress(get_all(), M.progress, progress) )
+    if plan:
+        sys.exit(0)
     print(json.dumps(dict((k.s, str(v)) for k, v in paths.items()), indent=4))
     sys.exit(0)
 
@@ -0,0 +1,260 @@
+"""
+Lock files for coordinating processes that share a mirror.
+
+Locks are plain files created with O_CREAT|O_EXCL, which is
+atomic on local and (modern) network/parallel filesystems.
+The holder keeps its lease alive by touching the lock file;
+a lock whose mtime is older than the lease, or whose holder
+is a dead process on this host, is stale and may be broken.
+
+Clock skew between hosts sharing the filesystem should be
+much smaller than the lease time.
+"""
+from typing import Optional, Dict, Tuple
+from pathlib import Path
+import asyncio
+import hashlib
+import os
+import random
+import socket
+import time
+import uuid
+import logging
+_logger = logging.getLogger(__name__)
+
+class Busy(Exception):
+    # Raised on entering a non-waiting lock held elsewhere.
+    pass
+
+def pid_alive(pid : int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class LockFile:
+    """A lease-based lock held through the file at `path`.
+
+    Usage::
+
+        async with LockFile(path):
+            ... # exclusive across processes
+
+    Args:
+       path: the lock file
+       lease: seconds after the last heartbeat at which
+              the lock is considered stale
+       poll: seconds between attempts while waiting
+    """
+    def __init__(self, path : Path, lease : float = 60.0,
+                 poll : float = 0.5):
+        assert lease > 0 and poll > 0
+        self.path = path
+        self.lease = lease
+        self.poll = poll
+        self.token = f"{socket.gethostname()} {os.getpid()} {uuid.uuid4().hex}"
+        self._beat : Optional[asyncio.Task] = None
+
+    def try_acquire(self) -> bool:
+        # One non-blocking attempt to create the lock file.
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        try:
+            os.write(fd, self.token.encode())
+        finally:
+            os.close(fd)
+        return True
+
+    def holder(self) -> Optional[str]:
+        try:
+            return self.path.read_text()
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    def observe(self, path : Optional[Path] = None
+               ) -> Optional[Tuple[Optional[str], int]]:
+        # (holder, mtime in ns) of the lock file, if it exists.
+        if path is None:
+            path = self.path
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError: # missing, or unreadable (e.g. ESTALE)
+            return None
+        try:
+            return path.read_text(), mtime
+        except FileNotFoundError:
+            return None
+        except (OSError, UnicodeDecodeError):
+            return None, mtime
+
+    def is_stale(self) -> bool:
+        return self.stale() is not None
+
+    def stale(self) -> Optional[Tuple[Optional[str], int]]:
+        # The observed state of the lock file, if it is stale.
+        seen = self.observe()
+        if seen is None:
+            return None
+        if time.time() - seen[1]/1e9 > self.lease:
+            return seen
+        # holder is a dead process on this host?
+        h = (seen[0] or "").split()
+        if len(h) == 3 and h[0] == socket.gethostname():
+            try:
+                if not pid_alive(int(h[1])):
+                    return seen
+            except ValueError:
+                pass
+        return None
+
+    def break_stale(self, seen : Tuple[Optional[str], int]) -> bool:
+        # Remove the stale lock observed as `seen`.
+        #
+        # Breakers take turns through `<lock>.break` (created with
+        # O_EXCL), and re-check the lock while holding it, so none
+        # can remove a lock another has just broken and re-taken.
+        # (A holder whose lease has expired could still release
+        # its lock meanwhile -- leases must be long enough that
+        # live holders renew them.)
+        guard = self.path.with_name(self.path.name + ".break")
+        try:
+            fd = os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            try: # left by a breaker that died?
+                if time.time() - guard.stat().st_mtime > self.lease:
+                    guard.unlink()
+            except FileNotFoundError:
+                pass
+            return False
+        os.close(fd)
+        try:
+            if self.observe() != seen:
+                return False
+            self.path.unlink(missing_ok=True)
+        finally:
+            guard.unlink(missing_ok=True)
+        _logger.warning("Broke stale lock %s (held by %s)",
+                        self.path, (seen[0] or "").strip())
+        return True
+
+    async def acquire(self) -> None:
+        # Wait until the lock is ours.
+        while not self.claim():
+            await asyncio.sleep(self.poll * random.uniform(0.5, 1.5))
+
+    def claim(self) -> bool:
+        # Take the lock if it is free (or stale), without waiting.
+        while not self.try_acquire():
+            seen = self.stale()
+            if seen is None or not self.break_stale(seen):
+                return False
+        self._beat = asyncio.ensure_future(self._heartbeat())
+        return True
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            # only renew the lock while it is still ours
+            if self.holder() != self.token:
+                _logger.error("Lock %s was lost", self.path)
+                return
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                _logger.error("Lock %s was lost", self.path)
+                return
+
+    async def release(self) -> None:
+        if self._beat is not None:
+            self._beat.cancel()
+            try:
+                await self._beat
+            except asyncio.CancelledError:
+                pass
+            self._beat = None
+        if self.holder() == self.token:
+            self.path.unlink(missing_ok=True)
+        else:
+            _logger.error("Lock %s was taken over before release", self.path)
+
+    async def __aenter__(self) -> "LockFile":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.release()
+        return False # continue to raise the exception
+
+class LockDir:
+    """Directory of per-entry lock files.
+
+    Lock keys are hashed to file names.  Within one process,
+    waiters for the same key queue on an asyncio.Lock first,
+    so only one coroutine per process polls the lock file.
+    """
+    def __init__(self, path : Path, lease : float = 60.0,
+                 poll : float = 0.5):
+        self.path = path
+        self.lease = lease
+        self.poll = poll
+        self._local : Dict[str, asyncio.Lock] = {}
+        self._users : Dict[str, int] = {}
+
+    def lock_path(self, key : str) -> Path:
+        return self.path / (hashlib.sha1(key.encode()).hexdigest() + ".lock")
+
+    def lock(self, key : str, wait : bool = True) -> "KeyLock":
+        """ Lock for key.  If not `wait`, entering it
+            raises Busy when the key is already locked.
+        """
+        return KeyLock(self, key, wait)
+
+class KeyLock:
+    # Async context manager returned by LockDir.lock
+    def __init__(self, d : LockDir, key : str, wait : bool = True):
+        self.d = d
+        self.key = key
+        self.wait = wait
+        self.f = LockFile(d.lock_path(key), d.lease, d.poll)
+
+    async def __aenter__(self) -> "KeyLock":
+        d = self.d
+        lk = d._local.setdefault(self.key, asyncio.Lock())
+        d._users[self.key] = d._users.get(self.key, 0) + 1
+        try:
+            if not self.wait and lk.locked():
+                raise Busy(self.key)
+            await lk.acquire()
+            try:
+                d.path.mkdir(parents=True, exist_ok=True)
+                if self.wait:
+                    await self.f.acquire()
+                elif not self.f.claim():
+                    raise Busy(self.key)
+            except BaseException:
+                lk.release()
+                raise
+        except BaseException:
+            self._drop()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        try:
+            await self.f.release()
+        finally:
+            self.d._local[self.key].release()
+            self._drop()
+        return False # continue to raise the exception
+
+    def _drop(self) -> None:
+        d = self.d
+        d._users[self.key] -= 1
+        if d._users[self.key] == 0:
+            del d._users[self.key]
+            del d._local[self.key]
@@ -1,14 +1,69 @@
-from typing import Optional, Union, Dict
-from collections.abc import Iterable
+from typing import Optional, Union, Dict, List, Set, Tuple, NamedTuple, TYPE_CHECKING
+from typing import ContextManager, BinaryIO
+from contextlib import nullcontext
+from collections.abc import (Iterable, Iterator, Mapping, Sequence,
+                             AsyncIterable, AsyncIterator)
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 from pathlib import Path
+import asyncio
+import os
+import json
+import shutil
 import socket
+import tempfile
+import time
 import logging
 _logger = logging.getLogger(__name__)
 
 from .exceptions import DownloadException
 from .urls import URL
-from .fetch import lookup_or_fetch
+from .lock import LockDir
+from .progress import Progress
 from .taskmgr import ResourceQueue, ResourceContext, TaskMgr
+# Downloaders (and aiohttp) are imported when first needed.
+if TYPE_CHECKING:
+    from .fetch import RetryPolicy
+
+async def _aiter(items : Iterable) -> AsyncIterator:
+    for x in items:
+        yield x
+
+class Entry(NamedTuple):
+    url  : URL
+    path : Path
+    size : Optional[int] #: file size in bytes (if requested)
+
+def _is_extracted(path : str) -> bool:
+    # Is path a tree unpacked by aurl.extract?  These are stored
+    # under the archive's name, below a `<netloc>#extract` directory.
+    if "#extract" not in path:
+        return False
+    from .extract import archive_suffixes
+    return path.endswith(tuple(archive_suffixes))
+
+def _scan_dir(path : str, sizes : bool
+             ) -> Tuple[str, bool, List[Tuple[str, Optional[int]]], List[str]]:
+    # List one directory of the mirror.
+    #
+    # Returns (path, is_entry, files, subdirs), where is_entry
+    # indicates a directory holding a git clone (which is
+    # reported as a single entry and not descended into).
+    # Extracted archives are also listed as single entries.
+    files : List[Tuple[str, Optional[int]]] = []
+    dirs : List[str] = []
+    with os.scandir(path) as it:
+        for e in it:
+            if e.name == ".git":
+                return path, True, [], []
+            if e.is_dir(follow_symlinks=False):
+                if _is_extracted(e.path):
+                    files.append((e.path, None))
+                else:
+                    dirs.append(e.path)
+            else:
+                sz = e.stat(follow_symlinks=False).st_size if sizes else None
+                files.append((e.path, sz))
+    return path, False, files, dirs
 
 def gethostname():
     #fqdn = socket.getfqdn(socket.gethostname())
@@ -54,20 +109,106 @@ class Mirror:
 
     >>> C.decode(base / 'http/nevada?tango=alpha/user')
     URL('http://nevada/user?tango=alpha')
+
+    Mirror-wide settings are read from `base/.aurl/config.json`
+    (if present).  Its "alternates" key maps a URL to a list of
+    equivalent URLs it may also be downloaded from, and its "peers"
+    key lists peer mirrors (nearest first)::
+
+        {"alternates": {"https://a.org/x.h5": ["https://b.org/x.h5"]},
+         "peers": ["https://dtn.my.org:4433"]}
+
+    A peer is an `aurl.serve` instance running inside another mirror's
+    base directory.  Entries missing locally are requested from each
+    peer in turn (at the `encode`-d path) before going to the origin.
+
+    Several processes (on one or many hosts) may share a mirror.
+    Each download holds a lock file under `base/.aurl/locks`
+    (renewed every `lease/3` seconds, and broken if older than `lease`),
+    and is written to `base/.aurl/tmp` before being moved into place.
+    A process finding an entry locked waits for it to be completed.
+
+    At most `nparallel` downloads run at once, and, separately,
+    at most `nsubprocess` git clones.
+
+    With `use_daemon`, fetches are sent to an `aurl daemon` serving
+    the same base directory (if one is running), which shares its
+    connections and in-flight downloads between all of its clients.
     """
-    def __init__(self, base : Union[str, Path], nparallel : int = 10):
+    def __init__(self, base : Union[str, Path], nparallel : int = 10,
+                 alternates : Optional[Mapping[URL, Sequence[URL]]] = None,
+                 peers : Optional[Sequence[str]] = None,
+                 lease : float = 60.0,
+                 retry : Optional["RetryPolicy"] = None,
+                 progress : Optional[Progress] = None,
+                 use_daemon : bool = False,
+                 nsubprocess : int = 4):
         self.hostname = gethostname()
         self.base = Path(base).resolve()
         assert self.base.is_dir()
+        self.state = self.base / ".aurl" #: internal state (not entries)
+
+        self.nparallel = nparallel
+        self._cq : Optional[ResourceQueue] = None
+        #: slots for downloads run as subprocesses (git clones),
+        #: kept apart so slow clones do not hold up HTTP downloads
+        self.nsubprocess = nsubprocess
+        self._sq : Optional[ResourceQueue] = None
+        self.locks = LockDir(self.state / "locks", lease)
+        #: retry policy for HTTP downloads (None for aurl.fetch.default_retry)
+        self.retry = retry
+        #: where downloads report their progress (if anywhere)
+        self.progress = progress
+        #: send fetches to an `aurl daemon` serving this mirror, if running
+        self.use_daemon = use_daemon
+
+        #: Mapping from url to alternate sources for it
+        self.alternates : Dict[URL, List[URL]] = {}
+        config = self.load_config()
+        for k, v in config.get("alternates", {}).items():
+            self.add_alternates(URL(k), [URL(x) for x in v])
+        if alternates is not None:
+            for url, alts in alternates.items():
+                self.add_alternates(url, alts)
+        #: Base URLs of peer mirrors, nearest first
+        self.peers : List[str] = list(peers or []) \
+                                 + list(config.get("peers", []))
+
+    @property
+    def cq(self) -> ResourceQueue:
+        # Download slots, created on first use
+        # (inside the event loop running the fetches).
+        if self._cq is None:
+            self._cq = ResourceQueue(list(range(self.nparallel)))
+        return self._cq
+
+    @property
+    def sq(self) -> ResourceQueue:
+        # Subprocess slots, created on first use.
+        if self._sq is None:
+            self._sq = ResourceQueue(list(range(self.nsubprocess)))
+        return self._sq
 
-        self.cq = ResourceQueue(list(range(nparallel)))
+    def slots(self, url : URL) -> ResourceQueue:
+        # The slots a download of url runs in.
+        return self.sq if url.scheme.startswith("git") else self.cq
 
-        #self.db = {} #: Mapping from url to local path
-        ## scan for initial database contents
-        #for x in self.base.iterdir():
-        #    if not x.is_dir(): continue
-        #    url = self.decode(x)
-        #    self.db[url] = x
+    def load_config(self) -> Dict:
+        # read base/.aurl/config.json
+        cfg = self.state / "config.json"
+        try:
+            with open(cfg, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def add_alternates(self, url : URL, alts : Iterable[URL]) -> None:
+        """Declare equivalent sources for url.
+        """
+        known = self.alternates.setdefault(url, [])
+        for a in alts:
+            if a != url and a not in known:
+                known.append(a)
 
     def encode(self, url : URL) -> Path:
         # write the path where the given URL would be stored
@@ -100,6 +241,117 @@ class Mirror:
             return None
         return ans
 
+    def lookup(self, url : URL) -> Optional[Path]:
+        """Resolve url to a local path without fetching.
+
+        Returns:
+           The path of the cached (or local file://) copy,
+           or None if the resource is not available locally.
+        """
+        if url.scheme == "file" and (url.netloc == self.hostname
+                                     or len(url.netloc) == 0):
+            p = Path(url.path)
+        else:
+            p = self.encode(url)
+        if p.exists():
+            return p
+        return None
+
+    def encode_many(self, urls : Iterable[URL]) -> List[Path]:
+        """Vectorized `encode`.
+
+        Shares the scheme/netloc prefix between URLs
+        so that only the final path is formatted per URL.
+        """
+        prefix : Dict[Tuple[str, str], str] = {}
+        ans = []
+        for url in urls:
+            key = (url.scheme, url.netloc+url.meta)
+            pre = prefix.get(key)
+            if pre is None:
+                pre = prefix[key] = str(self.base / key[0] / key[1])
+            path = url.path
+            if len(path) > 0 and path[0] == '/':
+                path = path[1:]
+            ans.append(Path(f"{pre}/{path}") if len(path) > 0 else Path(pre))
+        return ans
+
+    def decode_many(self, paths : Iterable[Union[str, Path]]
+                   ) -> List[Optional[URL]]:
+        """Vectorized `decode`.
+
+        Works on path strings and parses each
+        scheme/netloc directory name only once.
+        """
+        base = str(self.base) + os.sep
+        nb = len(base)
+        locs : Dict[str, URL] = {}
+        ans : List[Optional[URL]] = []
+        for path in paths:
+            s = str(path)
+            if not s.startswith(base):
+                ans.append(None)
+                continue
+            p = s[nb:].split(os.sep)
+            if len(p) < 2:
+                ans.append(None)
+                continue
+            loc = locs.get(p[1])
+            if loc is None:
+                loc = locs[p[1]] = URL(p[1], False)
+            try:
+                ans.append(URL(f"{p[0]}://{loc.path}/"
+                               + '/'.join(p[2:]) + loc.meta))
+            except (AssertionError, ValueError): # validation error
+                ans.append(None)
+        return ans
+
+    def scan(self, sizes : bool = False,
+             nthreads : int = 8) -> Iterator[Entry]:
+        """Enumerate the entries held by this mirror.
+
+        Each file (or git clone, or extracted archive,
+        directory) is one entry.
+        Directories are listed with `os.scandir` on a pool of
+        `nthreads` threads, so separate scheme/netloc subtrees
+        (and their subdirectories) are walked in parallel.
+        Top-level names starting with '.' are skipped.
+
+        Args:
+           sizes: also report the size of each file
+                  (costs one stat per file).
+           nthreads: number of directory-listing threads.
+
+        Yields:
+           Entry(url, path, size) tuples in no particular order.
+           Paths which do not decode to a valid URL are skipped.
+        """
+        def emit(found : List[Tuple[str, Optional[int]]]) -> Iterator[Entry]:
+            urls = self.decode_many(p for p, sz in found)
+            for (p, sz), url in zip(found, urls):
+                if url is None:
+                    _logger.debug("Skipping undecodable path %s", p)
+                    continue
+                yield Entry(url, Path(p), sz)
+
+        with ThreadPoolExecutor(nthreads) as pool:
+            pending : "set[Future]" = set()
+            with os.scandir(self.base) as schemes:
+                for scheme in schemes:
+                    if scheme.name.startswith(".") \
+                            or not scheme.is_dir(follow_symlinks=False):
+                        continue
+                    pending.add(pool.submit(_scan_dir, scheme.path, sizes))
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    path, is_entry, files, dirs = f.result()
+                    for d in dirs:
+                        pending.add(pool.submit(_scan_dir, d, sizes))
+                    if is_entry:
+                        files = [(path, None)]
+                    yield from emit(files)
+
     async def fetch(self, url : URL) -> Optional[Path]:
         """Handles url downloads.
 
@@ -117,10 +369,78 @@ class Mirror:
         out = self.encode(url)
         if out.exists():
             return out
+        if url.scheme == "file":
+            ans = self.lookup(url)
+            if ans is not None:
+                return ans
+            if url.netloc == self.hostname or len(url.netloc) == 0:
+                raise DownloadException(f"{url.s} does not exist locally")
+            from .fetch import lookup_or_fetch
+            async with ResourceContext(self.cq) as r:
+                with self.track(url):
+                    return await lookup_or_fetch(url, self.hostname, out)
+
+        if self.use_daemon:
+            from .daemon import remote_fetch
+            remote = await remote_fetch(self, [url])
+            if remote is not None:
+                return remote[url]
+
+        rel = out.relative_to(self.base).as_posix()
+        async with self.locks.lock(rel):
+            if out.exists(): # completed by another process
+                return out
+            _logger.info("No local copy of %s exists, attempting fetch.", url)
+            async with ResourceContext(self.slots(url)) as r:
+                with self.track(url):
+                    return await self._download(url, out)
+
+    def track(self, url : URL) -> ContextManager:
+        # Report the progress of downloading url.
+        if self.progress is None:
+            return nullcontext()
+        return self.progress.track(url.s)
+
+    async def _download(self, url : URL, out : Path) -> Path:
+        # Download url to a private temporary location,
+        # then move the result into place at `out`.
+        tmp = self.state / "tmp"
+        tmp.mkdir(parents=True, exist_ok=True)
+        work = Path(tempfile.mkdtemp(dir=tmp,
+                             prefix=f"{self.hostname}.{os.getpid()}."))
+        try:
+            dest = work / out.name
+            t0 = time.monotonic()
+            ans = await self._fetch_to(url, out, dest)
+            if ans != dest:
+                return ans
+            if dest.is_file():
+                from .plan import record_throughput
+                record_throughput(self, url, dest.stat().st_size,
+                                  time.monotonic() - t0)
+            out.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(dest, out)
+            return out
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
 
-        _logger.info("No local copy of %s exists, attempting fetch.", url)
-        async with ResourceContext(self.cq) as r:
-            return await lookup_or_fetch(url, self.hostname, out)
+    async def _fetch_to(self, url : URL, out : Path, dest : Path) -> Path:
+        # Fetch url into dest, trying peers, then all sources.
+        from .fetch import lookup_or_fetch
+        from .multisource import fetch_sources
+        from .peers import fetch_from_peers
+        from .extract import is_extract, fetch_extracted
+        if len(self.peers) > 0:
+            rel = out.relative_to(self.base).as_posix()
+            if await fetch_from_peers(self.peers, rel, dest, self.retry):
+                return dest
+        if is_extract(url):
+            return await fetch_extracted(self, url, dest)
+        alts = self.alternates.get(url, [])
+        if len(alts) > 0:
+            return await fetch_sources([url] + alts, self.hostname, dest,
+                                       self.retry)
+        return await lookup_or_fetch(url, self.hostname, dest, self.retry)
 
     async def fetch_all(self, urls : Iterable[URL]) -> Dict[URL, Path]:
         """ Fetch all urls from the given mirror.
@@ -130,6 +450,21 @@ class Mirror:
             raises DownloadException on error.
         """
         location : Dict[URL, Path] = {}
+        if self.use_daemon:
+            from .daemon import remote_fetch
+            missing = []
+            for url in set(urls):
+                out = self.encode(url)
+                if out.exists():
+                    location[url] = out
+                else:
+                    missing.append(url)
+            ans = await remote_fetch(self, missing) if missing else {}
+            if ans is not None:
+                location.update(ans)
+                return location
+            urls = missing
+
         errors = []
         with TaskMgr() as T:
             for url in set(urls):
@@ -138,6 +473,7 @@ class Mirror:
                 try:
                     location[url] = await t
                 except DownloadException as e:
+                    _logger.error("%s: %s", url, e)
                     errors.append(str(url)+": "+str(e))
         if len(errors) > 0:
             raise DownloadException("Download errors:\n  - "
@@ -145,6 +481,82 @@ class Mirror:
 
         return location
 
+    async def fetch_each(self, urls : Union[Iterable[URL], AsyncIterable[URL]],
+                         window : Optional[int] = None
+                        ) -> AsyncIterator[Tuple[URL, Optional[Path], Optional[str]]]:
+        """ Fetch urls as they are read, yielding
+            (url, path, error) for each as it completes
+            (error is None on success, else path is None).
+
+            At most `window` (default 4*nparallel) fetches are
+            pending at once, and urls are only read as earlier
+            ones finish, so memory use does not grow with
+            the number of urls.  Repeated urls are fetched
+            again (finding the entry in place).
+        """
+        if window is None:
+            window = 4*self.nparallel
+
+        async def fetch1(url : URL) -> Tuple[URL, Optional[Path], Optional[str]]:
+            try:
+                return url, await self.fetch(url), None
+            except DownloadException as e:
+                _logger.error("%s: %s", url, e)
+                return url, None, str(e)
+
+        source : Optional[AsyncIterator[URL]]
+        if isinstance(urls, AsyncIterable):
+            source = urls.__aiter__()
+        else:
+            source = _aiter(urls)
+        reading : Optional[asyncio.Future] = None # next url
+        pending : Set[asyncio.Future] = set()
+        try:
+            while True:
+                if reading is None and source is not None and len(pending) < window:
+                    reading = asyncio.ensure_future(source.__anext__())
+                waiting = pending if reading is None else pending | {reading}
+                if len(waiting) == 0:
+                    break
+                done, _ = await asyncio.wait(waiting,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t is reading:
+                        reading = None
+                        try:
+                            url = t.result()
+                        except StopAsyncIteration:
+                            source = None
+                            continue
+                        pending.add(asyncio.ensure_future(fetch1(url)))
+                    else:
+                        pending.discard(t)
+                        yield t.result()
+        finally:
+            for job in pending | ({reading} if reading is not None else set()):
+                job.cancel()
+
+    def manifest(self, urls : Iterable[URL], nthreads : int = 8) -> List[Dict]:
+        """ Manifest records (url, path, type, size, sha256)
+            for the entries of urls.  See `aurl.bundle`.
+        """
+        from .bundle import manifest
+        return manifest(self, urls, nthreads)
+
+    def export_bundle(self, urls : Iterable[URL], out : BinaryIO) -> List[Dict]:
+        """ Stream a tar bundle of the entries for urls to `out`,
+            returning its manifest.  See `aurl.bundle`.
+        """
+        from .bundle import export_bundle
+        return export_bundle(self, urls, out)
+
+    async def import_bundle(self, stream : BinaryIO) -> Dict[str, str]:
+        """ Import the entries of a bundle read from `stream`,
+            verifying their digests.  See `aurl.bundle`.
+        """
+        from .bundle import import_bundle
+        return await import_bundle(self, stream)
+
     def to_url(self, fname : Path) -> str:
         """Returns a URL representation of a local path.
         """
@@ -0,0 +1,302 @@
+"""
+Multi-source downloads.
+
+A resource published at several equivalent URLs is fetched
+by spreading byte ranges across all sources that support them
+(in the style of Metalink).  Sources pull ranges from a shared
+work list, sized according to their measured throughput, so faster
+sources carry more of the transfer.  A source that fails or
+stalls is dropped, and the unwritten remainder of its range is
+handed to the others.
+"""
+from typing import Optional, List, Tuple, Sequence, Deque
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+import asyncio
+import time
+import logging
+_logger = logging.getLogger(__name__)
+
+import aiohttp
+
+from .exceptions import DownloadException
+from .urls import URL
+from .fetch import (UnsupportedOperation, Pstr, split_url, RetryPolicy,
+                    StatusError, retry_after, default_retry, session_factory, download_url,
+                    lookup_or_fetch)
+from .writer import FileWriter, check_space
+
+@dataclass
+class Source:
+    url: URL
+    size: Optional[int] = None
+    ranges: bool = False #: advertised Accept-Ranges: bytes
+    nbytes: int = 0      #: bytes received
+    busy: float = 0.0    #: seconds spent receiving
+    errors: int = 0
+    failed: bool = False
+    base: str = field(init=False) #: scheme://netloc
+    rel: str = field(init=False)  #: path?query
+
+    def __post_init__(self):
+        self.base, self.rel = split_url(self.url)
+
+    @property
+    def rate(self) -> Optional[float]:
+        # measured throughput (bytes/sec)
+        if self.busy <= 0.0 or self.nbytes == 0:
+            return None
+        return self.nbytes / self.busy
+
+class Ranges:
+    """Shared list of byte ranges still to be downloaded.
+
+    Workers call `get` to claim the next range (split to
+    the size they ask for) and `put` to return whatever part
+    of it they did not write.
+    """
+    def __init__(self, size : int):
+        self.todo : Deque[Tuple[int, int]] = deque([(0, size)])
+        self.inflight = 0
+        self.cond = asyncio.Condition()
+
+    async def get(self, want : int) -> Optional[Tuple[int, int]]:
+        # Returns None once all ranges are complete.
+        async with self.cond:
+            while len(self.todo) == 0 and self.inflight > 0:
+                await self.cond.wait()
+            if len(self.todo) == 0:
+                return None
+            start, end = self.todo.popleft()
+            if end - start > want:
+                self.todo.appendleft((start+want, end))
+                end = start + want
+            self.inflight += 1
+            return start, end
+
+    async def put(self, rest : Optional[Tuple[int, int]]) -> None:
+        async with self.cond:
+            self.inflight -= 1
+            if rest is not None and rest[1] > rest[0]:
+                self.todo.appendleft(rest)
+            self.cond.notify_all()
+
+async def probe(session : aiohttp.ClientSession, src : Source) -> None:
+    try:
+        async with session.head(src.rel, allow_redirects=True) as response:
+            if response.status != 200:
+                _logger.info("%s: HEAD returned %d", src.url, response.status)
+                src.failed = True
+                return
+            if 'Content-Length' in response.headers:
+                src.size = int(response.headers['Content-Length'])
+            src.ranges = response.headers.get('Accept-Ranges', '') == 'bytes'
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _logger.info("%s: HEAD failed: %s", src.url, e)
+        src.failed = True
+
+async def fetch_range(session : aiohttp.ClientSession, src : Source,
+                      dest : FileWriter, start : int, end : int,
+                      chunk_size : int) -> int:
+    """ Download bytes [start, end) from one source into dest.
+
+        Returns the offset reached, which is less than `end`
+        only if an exception is raised part-way
+        (in which case the offset is attached to the
+        exception as `.offset`).
+    """
+    f = dest.part(start)
+    headers = {"Range": f"bytes={start}-{end-1}"}
+    t0 = time.monotonic()
+    try:
+        async with session.get(src.rel, allow_redirects=True,
+                               headers=headers) as response:
+            if response.status in [200, 501]:
+                raise UnsupportedOperation()
+            if response.status != 206:
+                raise StatusError("Download error on %s (%d-%d): received status %d"%
+                                  (src.url, start, end, response.status),
+                                  response.status, retry_after(response))
+            try:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    chunk = chunk[:end-f.pos]
+                    await f.write(chunk)
+                    if f.pos >= end:
+                        break
+            finally:
+                await f.flush()
+        if f.pos < end:
+            raise DownloadException("%s: short read (%d-%d)"%(src.url, f.pos, end))
+    except Exception as e:
+        e.offset = start + f.written # type: ignore[attr-defined]
+        raise
+    finally:
+        src.nbytes += f.written
+        src.busy += time.monotonic() - t0
+    return f.pos
+
+async def download_multi(outfile : Pstr,
+                         urls : Sequence[URL],
+                         chunk_size : int = 1024**2,
+                         max_connections : int = 4,
+                         max_errors : int = 2,
+                         stall_timeout : float = 60.0,
+                         retry : Optional[RetryPolicy] = None) -> int:
+    """ Download one resource from several equivalent http(s) URLs.
+
+        Byte ranges are spread across all sources reporting
+        the same size and `Accept-Ranges: bytes`, with up to
+        `max_connections` connections per source.
+        Each connection asks for a range proportional to its
+        source's measured throughput.  A source is dropped after
+        `max_errors` failures (or a read stalling for `stall_timeout`
+        seconds), and its unwritten bytes are re-queued.
+        Between errors, a source backs off as set by `retry`.
+
+        Falls back to a single-source download (trying each
+        URL in turn) if ranged downloads are not possible.
+
+        Raises a DownloadException if no source succeeds.
+
+        Returns the downloaded file size (in bytes) on success.
+    """
+    assert chunk_size > 0 and max_connections > 0 and len(urls) > 0
+    if retry is None:
+        retry = default_retry
+    dest = Path(outfile)
+    dest.parent.mkdir(exist_ok=True, parents=True)
+
+    mk_session = session_factory()
+    timeout = aiohttp.ClientTimeout(sock_read=stall_timeout)
+    srcs = [Source(u) for u in urls]
+    sessions = {}
+    try:
+        for src in srcs:
+            if src.base not in sessions:
+                sessions[src.base] = mk_session(src.base, timeout=timeout)
+        await asyncio.gather(*[probe(sessions[s.base], s) for s in srcs])
+
+        # The first source to report a size defines the resource.
+        sizes = [s.size for s in srcs if s.size is not None and not s.failed]
+        file_size = sizes[0] if len(sizes) > 0 else None
+        usable = [s for s in srcs if not s.failed and s.ranges
+                                     and s.size == file_size]
+        for s in srcs:
+            if s.size is not None and s.size != file_size:
+                _logger.warning("%s: size %d differs from %d, ignoring source",
+                                s.url, s.size, file_size)
+
+        if file_size is None or file_size == 0 or len(usable) < 2:
+            return await download_any(dest, [s.url for s in srcs],
+                                      chunk_size, max_connections, retry)
+
+        check_space(dest, file_size)
+        out = FileWriter(dest, file_size)
+        ranges = Ranges(file_size)
+        nworkers = len(usable) * max_connections
+        piece = max(chunk_size,
+                    (file_size // (4*nworkers)) // chunk_size * chunk_size)
+
+        async def worker(src : Source) -> None:
+            session = sessions[src.base]
+            while not src.failed:
+                # ask for more when this source is faster than average
+                rates = [r for r in (s.rate for s in usable
+                                     if not s.failed) if r is not None]
+                want = piece
+                if src.rate is not None and len(rates) > 0:
+                    w = src.rate * len(rates) / sum(rates)
+                    want = int(piece * min(4.0, max(0.25, w)))
+                    want = max(chunk_size, want // chunk_size * chunk_size)
+                r = await ranges.get(want)
+                if r is None:
+                    return
+                if src.failed: # while waiting
+                    await ranges.put(r)
+                    return
+                start, end = r
+                try:
+                    await fetch_range(session, src, out, start, end,
+                                      chunk_size)
+                    await ranges.put(None)
+                except asyncio.CancelledError:
+                    await ranges.put(r)
+                    raise
+                except Exception as e:
+                    pos = getattr(e, "offset", start)
+                    src.errors += 1
+                    if isinstance(e, UnsupportedOperation) \
+                            or src.errors >= max_errors:
+                        src.failed = True
+                    _logger.info("%s: range %d-%d failed at %d (%s: %s)",
+                                 src.url, start, end, pos,
+                                 type(e).__name__, e)
+                    await ranges.put((pos, end))
+                    why = retry.reason(e)
+                    if why is not None:
+                        retry.stats.retries += 1
+                        retry.stats.reasons[why] += 1
+                    if not src.failed:
+                        await asyncio.sleep(retry.delay(src.errors,
+                                            getattr(e, "retry_after", None)))
+
+        try:
+            await asyncio.gather(*[worker(s) for s in usable
+                                             for i in range(max_connections)])
+        finally:
+            out.close()
+        if len(ranges.todo) > 0:
+            raise DownloadException("%s: all sources failed"%urls[0])
+        for s in usable:
+            _logger.info("%s: %d bytes at %s Mbps", s.url, s.nbytes,
+                         "%.3f"%(s.rate*8/1024**2) if s.rate else "-")
+        return file_size
+    finally:
+        for session in sessions.values():
+            await session.close()
+
+async def download_any(dest : Path, urls : Sequence[URL],
+                       chunk_size : int, max_connections : int,
+                       retry : Optional[RetryPolicy] = None) -> int:
+    # Whole-file failover: try each source in turn.
+    errors = []
+    for u in urls:
+        try:
+            return await download_url(dest, u, chunk_size, max_connections,
+                                      retry=retry)
+        except (DownloadException, aiohttp.ClientError,
+                asyncio.TimeoutError) as e:
+            _logger.info("%s: download failed: %s", u, e)
+            errors.append(f"{u}: {e}")
+    raise DownloadException("All sources failed:\n  - " + "\n  - ".join(errors))
+
+def is_http(url : URL) -> bool:
+    return url.scheme == "http" or url.scheme == "https"
+
+async def fetch_sources(urls : Sequence[URL], hostname : str,
+                        base : Path, retry : Optional[RetryPolicy] = None) -> Path:
+    """ Fetch a resource available from any of several URLs.
+
+        All http(s) sources are used together through
+        `download_multi`.  If that fails, any remaining sources
+        (e.g. ftp or git) are tried one at a time.
+
+        May throw a DownloadException
+    """
+    errors = []
+    http = [u for u in urls if is_http(u)]
+    if len(http) > 0:
+        try:
+            await download_multi(base, http, retry=retry)
+            return base
+        except DownloadException as e:
+            errors.append(str(e))
+    for u in urls:
+        if is_http(u):
+            continue
+        try:
+            return await lookup_or_fetch(u, hostname, base, retry)
+        except DownloadException as e:
+            errors.append(f"{u}: {e}")
+    raise DownloadException("\n".join(errors))
@@ -0,0 +1,102 @@
+"""
+Lookups against peer mirrors.
+
+A peer is an `aurl.serve` instance run from inside another
+mirror's base directory, so that every mirror entry is served
+at `{peer}/{relative path of Mirror.encode(url)}`.
+Files are downloaded directly, and directory entries (e.g. git
+clones) are copied file-by-file using the server's JSON listings.
+"""
+from typing import Optional, Sequence, Dict, Any, List, Awaitable
+from pathlib import Path
+from urllib.parse import quote
+import asyncio
+import shutil
+import logging
+_logger = logging.getLogger(__name__)
+
+import aiohttp
+
+from .exceptions import DownloadException
+from .fetch import download_url, split_url, open_session, RetryPolicy
+
+def peer_url(peer : str, rel : str) -> str:
+    # URL of the mirror entry at relative path `rel` on `peer`
+    return peer.rstrip('/') + '/' + quote(rel)
+
+async def fetch_tree(session : aiohttp.ClientSession, base : str, url : str,
+                     dest : Path, tree : Optional[Dict[str, Any]] = None,
+                     max_depth : int = 3,
+                     retry : Optional[RetryPolicy] = None) -> None:
+    # Copy the directory served at base+url into dest
+    # (session is connected to base).
+    # `tree` is the listing of url, if already known.
+    if tree is None:
+        async with session.get(url, params={"max_depth": max_depth}) as response:
+            if response.status != 200:
+                raise DownloadException("%s: listing failed (%d)"%(
+                                        url, response.status))
+            tree = await response.json()
+    dest.mkdir(parents=True, exist_ok=True)
+
+    jobs : List[Awaitable[Any]] = []
+    for name, entry in tree.items():
+        child = f"{url}/{quote(name)}"
+        sub = entry.get('children', False)
+        if sub is True:
+            jobs.append(fetch_tree(session, base, child, dest/name,
+                                   max_depth=max_depth, retry=retry))
+        elif isinstance(sub, dict): # listing
+            jobs.append(fetch_tree(session, base, child, dest/name, sub,
+                                   max_depth=max_depth, retry=retry))
+        else:
+            jobs.append(download_url(dest/name, base+child, retry=retry))
+    await asyncio.gather(*jobs)
+
+async def fetch_peer(peer : str, rel : str, dest : Path,
+                     retry : Optional[RetryPolicy] = None) -> bool:
+    """ Fetch the mirror entry `rel` from `peer` into dest.
+
+        Returns False if the peer does not hold the entry.
+
+        May raise a DownloadException or aiohttp.ClientError.
+    """
+    base, url = split_url(peer_url(peer, rel))
+    async with open_session(base) as session:
+        async with session.head(url, allow_redirects=True) as response:
+            if response.status == 404:
+                return False
+            if response.status != 200:
+                raise DownloadException("%s: HEAD returned %d"%(
+                                        peer, response.status))
+            kind = response.headers.get('x-aurl-type', 'file')
+        if kind == 'directory':
+            await fetch_tree(session, base, url, dest, retry=retry)
+            return True
+    await download_url(dest, base+url, retry=retry)
+    return True
+
+def remove(dest : Path) -> None:
+    # clean up a partial copy
+    if dest.is_dir() and not dest.is_symlink():
+        shutil.rmtree(dest, ignore_errors=True)
+    else:
+        dest.unlink(missing_ok=True)
+
+async def fetch_from_peers(peers : Sequence[str], rel : str, dest : Path,
+                           retry : Optional[RetryPolicy] = None) -> Optional[str]:
+    """ Try each peer (nearest first) for the entry at mirror-relative
+        path `rel`, storing it at dest.
+
+        Returns the peer that supplied it, or None if no peer could.
+    """
+    for peer in peers:
+        try:
+            if await fetch_peer(peer, rel, dest, retry):
+                _logger.info("%s: fetched from peer %s", rel, peer)
+                return peer
+        except (DownloadException, aiohttp.ClientError,
+                asyncio.TimeoutError, ValueError) as e:
+            _logger.info("%s: peer %s failed: %s", rel, peer, e)
+            remove(dest)
+    return None
@@ -0,0 +1,213 @@
+"""
+Dry-run planning of mirror fetches.
+
+`make_plan` resolves each URL against a mirror without
+downloading anything.  URLs already held are "cached";
+http(s) URLs that are missing are probed with concurrent
+HEAD requests (falling back to a one-byte ranged GET) to learn
+their size, or that they are "unavailable".  Other missing URLs
+(git, ftp, ...) are counted with unknown size.
+
+Durations are estimated per host from the throughput of
+recent downloads into the same mirror, which `Mirror` records in
+`base/.aurl/throughput.json` (for downloads of at least
+`min_sample` bytes).
+"""
+from typing import Optional, Dict, Any, List, Iterable
+from dataclasses import dataclass, field
+from pathlib import Path
+import asyncio
+import json
+import os
+import logging
+_logger = logging.getLogger(__name__)
+
+from .urls import URL
+from .mirror import Mirror
+
+#: smallest download used to estimate throughput
+min_sample = 1 << 20
+#: samples kept per host
+max_samples = 20
+
+def host_of(url : URL) -> str:
+    return f"{url.scheme}://{url.netloc}"
+
+def throughput_path(M : Mirror) -> Path:
+    return M.state / "throughput.json"
+
+def load_throughput(M : Mirror) -> Dict[str, List[List[float]]]:
+    # host -> recent [bytes, seconds] samples
+    try:
+        return json.loads(throughput_path(M).read_text())
+    except (OSError, ValueError):
+        return {}
+
+def record_throughput(M : Mirror, url : URL, nbytes : int,
+                      seconds : float) -> None:
+    """ Remember the throughput of a completed download.
+
+        Concurrent writers may lose each other's samples,
+        which only makes the estimate slightly less recent.
+    """
+    if nbytes < min_sample or seconds <= 0:
+        return
+    samples = load_throughput(M)
+    h = samples.setdefault(host_of(url), [])
+    h.append([nbytes, round(seconds, 3)])
+    del h[:-max_samples]
+    path = throughput_path(M)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}")
+    try:
+        M.state.mkdir(parents=True, exist_ok=True)
+        tmp.write_text(json.dumps(samples))
+        os.replace(tmp, path)
+    except OSError as e:
+        _logger.debug("Unable to record throughput: %s", e)
+
+def recent_rates(M : Mirror) -> Dict[str, float]:
+    # host -> bytes/second over its recent downloads
+    ans = {}
+    for host, samples in load_throughput(M).items():
+        b = sum(s[0] for s in samples)
+        t = sum(s[1] for s in samples)
+        if t > 0:
+            ans[host] = b / t
+    return ans
+
+@dataclass
+class PlanItem:
+    url    : URL
+    state  : str           #: cached, local, missing or unavailable
+    size   : Optional[int] #: bytes (None if unknown)
+    reason : Optional[str] = None #: why it is unavailable
+
+@dataclass
+class Plan:
+    items : List[PlanItem] = field(default_factory=list)
+    rates : Dict[str, float] = field(default_factory=dict) #: host -> bytes/sec
+
+    def summary(self, rate : Optional[float] = None) -> Dict[str, Any]:
+        """ Counts and byte totals, overall and per host.
+
+            Each host's download time is estimated from its
+            recent throughput (or `rate`, for hosts without any),
+            and the overall duration assumes hosts are fetched
+            in parallel.
+        """
+        ans : Dict[str, Any] = {"urls": len(self.items), "cached": 0,
+               "local": 0, "missing": 0, "unavailable": 0,
+               "bytes_cached": 0, "bytes_missing": 0, "unknown_size": 0}
+        hosts : Dict[str, Dict[str, Any]] = {}
+        unavailable = {}
+        for it in self.items:
+            ans[it.state] += 1
+            if it.state == "unavailable":
+                unavailable[it.url.s] = it.reason
+                continue
+            if it.state != "missing":
+                ans["bytes_cached"] += it.size or 0
+                continue
+            h = hosts.setdefault(host_of(it.url), {"missing": 0, "bytes": 0,
+                                                   "unknown_size": 0})
+            h["missing"] += 1
+            if it.size is None:
+                h["unknown_size"] += 1
+                ans["unknown_size"] += 1
+            else:
+                h["bytes"] += it.size
+                ans["bytes_missing"] += it.size
+
+        seconds : Optional[float] = 0.0
+        for name, h in hosts.items():
+            r = self.rates.get(name, rate)
+            h["rate"] = None if r is None else round(r, 1)
+            h["seconds"] = None if r is None else round(h["bytes"] / r, 1)
+            if h["seconds"] is None:
+                seconds = None
+            elif seconds is not None:
+                seconds = max(seconds, h["seconds"])
+        ans["seconds"] = seconds
+        ans["hosts"] = hosts
+        ans["unavailable_urls"] = unavailable
+        return ans
+
+async def probe_size(url : URL) -> PlanItem:
+    # Find the size of a missing http(s) url.
+    import aiohttp
+    from .fetch import split_url, open_session, content_range_total
+    base, rel = split_url(url)
+    try:
+        async with open_session(base) as session:
+            async with session.head(rel, allow_redirects=True) as response:
+                if response.status == 200:
+                    return PlanItem(url, "missing", response.content_length)
+                status = response.status
+            if status in (403, 405, 501): # HEAD refused, try a GET
+                async with session.get(rel, allow_redirects=True,
+                                       headers={"Range": "bytes=0-0"}) as response:
+                    if response.status == 206:
+                        return PlanItem(url, "missing", content_range_total(response))
+                    if response.status == 200:
+                        return PlanItem(url, "missing", response.content_length)
+                    status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return PlanItem(url, "unavailable", None, f"{type(e).__name__}: {e}")
+    return PlanItem(url, "unavailable", None, f"status {status}")
+
+async def make_plan(M : Mirror, urls : Iterable[URL],
+                    concurrency : int = 32) -> Plan:
+    """ Resolve urls against M, probing missing ones
+        (at most `concurrency` at once).
+    """
+    sem = asyncio.Semaphore(concurrency)
+
+    async def probe(url : URL) -> PlanItem:
+        alts = M.alternates.get(url, [])
+        async with sem:
+            for u in [url] + alts:
+                it = await probe_size(u)
+                if it.state == "missing":
+                    break
+        it.url = url
+        return it
+
+    from .fetch import SessionPool, sessions
+    plan = Plan(rates = recent_rates(M))
+    jobs = []
+    for url in sorted(set(urls), key=lambda u: u.s):
+        out = M.encode(url)
+        if url.scheme == "file":
+            p = M.lookup(url)
+            if p is None:
+                plan.items.append(PlanItem(url, "unavailable", None,
+                                           "not found locally"))
+            else:
+                plan.items.append(PlanItem(url, "local", size_of(p)))
+        elif out.exists():
+            plan.items.append(PlanItem(url, "cached", size_of(out)))
+        elif url.scheme in ("http", "https"):
+            jobs.append(probe(url))
+        else:
+            plan.items.append(PlanItem(url, "missing", None))
+    pool = SessionPool() # one session per host
+    tok = sessions.set(pool)
+    try:
+        plan.items.extend(await asyncio.gather(*jobs))
+    finally:
+        sessions.reset(tok)
+        await pool.close()
+    return plan
+
+def size_of(p : Path) -> Optional[int]:
+    # file size (None for directories)
+    try:
+        return None if p.is_dir() else p.stat().st_size
+    except OSError:
+        return None
+
+async def show_plan(M : Mirror, urls : Iterable[URL]) -> Dict[str, Any]:
+    # Plan the fetch of urls, and print its summary (for the CLIs).
+    ans = (await make_plan(M, urls)).summary()
+    print(json.dumps(ans, indent=4))
+    return ans
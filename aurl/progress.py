@@ -0,0 +1,254 @@
+"""
+Progress reporting for downloads.
+
+A `Progress` object is shared by all downloads of a `Mirror`
+(`Mirror(..., progress=Progress())`).  Each download gets a
+`FileProgress`, made current (through a context variable) while
+it runs, so that every `FileWriter` opened by the download counts
+its bytes there.  Counting a chunk is one integer addition and a
+clock read -- rates, ETA and stalls are only computed when the
+progress is sampled (`Progress.sample`, or periodically by
+`Progress.report`).
+
+Listeners registered with `Progress.subscribe` receive events
+as JSON-ready dicts:
+
+    {"event": "start", "name": url}
+    {"event": "done",  "name": url, "bytes": n, "seconds": t}
+    {"event": "error", "name": url, "bytes": n, "seconds": t, "error": msg}
+    {"event": "progress", "files_done": ..., "files_failed": ...,
+     "files_active": ..., "bytes_done": ..., "bytes_total": ...,
+     "rate": bytes/sec, "eta": seconds or None,
+     "stalled": [names], "files": [{"name", "done", "total", "rate"}]}
+"""
+from typing import Optional, Dict, Any, List, Callable, Iterator, TextIO, Awaitable, TypeVar
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import Enum
+import asyncio
+import json
+import sys
+import time
+
+Event = Dict[str, Any]
+T = TypeVar("T")
+
+class FileProgress:
+    """ Bytes received for one download (which may write several files).
+    """
+    __slots__ = ("name", "done", "total", "sized", "t0", "t_last",
+                 "rate", "_sample")
+
+    def __init__(self, name : str):
+        self.name = name
+        self.done = 0     #: bytes received
+        self.total = 0    #: bytes expected (valid if sized)
+        self.sized = True #: whether all file sizes are known
+        self.t0 = self.t_last = time.monotonic()
+        self.rate = 0.0   #: smoothed bytes/sec (updated by sampling)
+        self._sample = (0, self.t0)
+
+    def expect(self, size : Optional[int]) -> None:
+        # Add a file of the given size (None if unknown).
+        if size is None:
+            self.sized = False
+        else:
+            self.total += size
+
+    def add(self, n : int) -> None:
+        self.done += n
+        self.t_last = time.monotonic()
+
+    def record(self) -> Event:
+        return {"name": self.name, "done": self.done,
+                "total": self.total if self.sized else None,
+                "rate": round(self.rate, 1)}
+
+#: progress of the download running in the current task (if tracked)
+current : ContextVar[Optional[FileProgress]] = ContextVar("aurl_progress",
+                                                          default=None)
+
+class Progress:
+    """ Aggregate progress of a set of downloads.
+
+        Args:
+           stall: seconds without data after which an
+                  active download is reported as stalled
+           smoothing: weight of the newest sample in the
+                      (exponentially averaged) rates
+    """
+    def __init__(self, stall : float = 30.0, smoothing : float = 0.3):
+        self.stall = stall
+        self.smoothing = smoothing
+        self.active : Dict[int, FileProgress] = {}
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_finished = 0  # bytes of downloads no longer active
+        self.total_finished = 0
+        self.rate = 0.0
+        self.listeners : List[Callable[[Event], None]] = []
+        self._sample = (0, time.monotonic())
+
+    def subscribe(self, fn : Callable[[Event], None]) -> None:
+        self.listeners.append(fn)
+
+    def emit(self, ev : Event) -> None:
+        for fn in self.listeners:
+            fn(ev)
+
+    @contextmanager
+    def track(self, name : str) -> Iterator[FileProgress]:
+        """ Count the bytes downloaded inside this context
+            (by the current task and tasks it starts) under `name`.
+        """
+        fp = FileProgress(name)
+        self.active[id(fp)] = fp
+        self.emit({"event": "start", "name": name})
+        tok = current.set(fp)
+        err : Optional[str] = None
+        try:
+            yield fp
+        except BaseException as e:
+            err = str(e) or type(e).__name__
+            raise
+        finally:
+            current.reset(tok)
+            self._finish(fp, err)
+
+    def _finish(self, fp : FileProgress, err : Optional[str]) -> None:
+        del self.active[id(fp)]
+        self.bytes_finished += fp.done
+        self.total_finished += fp.total if fp.sized else fp.done
+        ev = {"event": "done", "name": fp.name, "bytes": fp.done,
+              "seconds": round(time.monotonic() - fp.t0, 3)}
+        if err is None:
+            self.files_done += 1
+        else:
+            self.files_failed += 1
+            ev["event"] = "error"
+            ev["error"] = err
+        self.emit(ev)
+
+    def _rate(self, old : float, done : int, sample : tuple, now : float) -> float:
+        # update an averaged rate from the previous (done, time) sample
+        dt = now - sample[1]
+        if dt <= 0:
+            return old
+        r = (done - sample[0]) / dt
+        return r if old == 0 else old + self.smoothing*(r - old)
+
+    def sample(self) -> Event:
+        """ Compute rates and return a "progress" event.
+        """
+        now = time.monotonic()
+        done = self.bytes_finished
+        total = self.total_finished
+        sized = True
+        stalled = []
+        for fp in self.active.values():
+            fp.rate = self._rate(fp.rate, fp.done, fp._sample, now)
+            fp._sample = (fp.done, now)
+            done += fp.done
+            total += fp.total
+            sized = sized and fp.sized
+            if now - fp.t_last > self.stall:
+                stalled.append(fp.name)
+        self.rate = self._rate(self.rate, done, self._sample, now)
+        self._sample = (done, now)
+
+        eta : Optional[float] = None
+        if sized and self.rate > 0:
+            eta = round(max(total - done, 0) / self.rate, 1)
+        return {"event": "progress",
+                "files_done": self.files_done,
+                "files_failed": self.files_failed,
+                "files_active": len(self.active),
+                "bytes_done": done,
+                "bytes_total": total if sized else None,
+                "rate": round(self.rate, 1),
+                "eta": eta,
+                "stalled": stalled,
+                "files": [fp.record() for fp in self.active.values()]}
+
+    async def report(self, interval : float = 1.0) -> None:
+        # Emit a progress event every `interval` seconds (until cancelled).
+        while True:
+            await asyncio.sleep(interval)
+            self.emit(self.sample())
+
+class Display(str, Enum):
+    """ How the command-line tools show progress (on stderr).
+    """
+    none = "none"     #: not at all
+    bar = "bar"       #: a status line, redrawn in place
+    ndjson = "ndjson" #: one JSON object per event
+
+def human(n : float) -> str:
+    # 1536 -> "1.5 KiB"
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(n) < 1024 or unit == "TiB":
+            break
+        n /= 1024
+    return f"{n:.1f} {unit}" if unit != "B" else f"{int(n)} B"
+
+def status_line(ev : Event) -> str:
+    # One-line summary of a progress event.
+    line = f"{ev['files_done']} done, {ev['files_active']} active  {human(ev['bytes_done'])}"
+    if ev["bytes_total"] is not None:
+        line += f"/{human(ev['bytes_total'])}"
+    line += f"  {human(ev['rate'])}/s"
+    if ev["eta"] is not None:
+        m, s = divmod(int(ev["eta"]), 60)
+        line += f"  ETA {m//60}:{m%60:02d}:{s:02d}"
+    if ev["files_failed"]:
+        line += f"  {ev['files_failed']} failed"
+    if ev["stalled"]:
+        line += f"  {len(ev['stalled'])} stalled"
+    return line
+
+class Printer:
+    # Listener writing events to a stream in the given Display mode.
+    def __init__(self, mode : Display, out : TextIO = sys.stderr):
+        self.mode = mode
+        self.out = out
+        self.drawn = False
+
+    def __call__(self, ev : Event) -> None:
+        if self.mode == Display.ndjson:
+            self.out.write(json.dumps(ev) + "\n")
+            self.out.flush()
+        elif self.mode == Display.bar:
+            if ev["event"] == "error":
+                self.clear()
+                self.out.write(f"{ev['name']}: {ev['error']}\n")
+            elif ev["event"] == "progress":
+                self.out.write("\r" + status_line(ev) + "\x1b[K")
+                self.drawn = True
+            self.out.flush()
+
+    def clear(self) -> None:
+        if self.drawn:
+            self.out.write("\r\x1b[K")
+            self.drawn = False
+
+async def with_progress(coro : Awaitable[T], progress : Optional[Progress],
+                        mode : Display, interval : float = 1.0) -> T:
+    """ Await coro, displaying progress (if any) on stderr.
+    """
+    if progress is None or mode == Display.none:
+        return await coro
+    show = Printer(mode)
+    progress.subscribe(show)
+    task = asyncio.ensure_future(progress.report(interval))
+    try:
+        return await coro
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        progress.emit(progress.sample()) # final totals
+        if mode == Display.bar:
+            show.out.write("\n")
+            show.out.flush()
@@ -1,8 +1,10 @@
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Callable, Deque
 import logging
 _logger = logging.getLogger(__name__)
 
 import asyncio
+import re
+from collections import deque
 from pathlib import Path
 from time import time as timestamp
 
@@ -36,3 +38,66 @@ async def runcmd(prog : Union[Path,str], *args : str,
         _logger.info('%s returned %d', prog, ret)
 
     return ret, out, err
+
+async def runcmd_stream(prog : Union[Path,str], *args : str,
+                        cwd : Union[Path,str,None] = None,
+                        on_line : Optional[Callable[[str], None]] = None,
+                        timeout : Optional[float] = None,
+                        stall : Optional[float] = None,
+                        keep : int = 20) -> Tuple[int,str]:
+    """Run the given command, handing each line it writes to
+       stderr to `on_line` as it arrives (lines may end in
+       '\\r', as progress meters do).  Stdout is discarded.
+
+       The command is killed if it runs longer than `timeout`
+       seconds, or writes nothing for `stall` seconds,
+       raising asyncio.TimeoutError.
+
+       Returns (return code : int, last `keep` lines of stderr : str)
+    """
+    proc = await asyncio.create_subprocess_exec(
+                    str(prog), *args, cwd=cwd,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE)
+    assert proc.stderr is not None
+    tail : Deque[str] = deque(maxlen=keep)
+    deadline = None if timeout is None else timestamp() + timeout
+
+    async def read_lines() -> None:
+        assert proc.stderr is not None
+        buf = b""
+        while True:
+            wait = stall
+            if deadline is not None:
+                left = max(deadline - timestamp(), 0.0)
+                wait = left if wait is None else min(wait, left)
+            chunk = await asyncio.wait_for(proc.stderr.read(4096), wait)
+            if not chunk:
+                break
+            buf += chunk
+            *lines, buf = re.split(rb"[\r\n]", buf)
+            for b in lines:
+                line = b.decode('utf-8', 'replace')
+                if len(line) == 0:
+                    continue
+                tail.append(line)
+                if on_line is not None:
+                    on_line(line)
+        if buf:
+            tail.append(buf.decode('utf-8', 'replace'))
+
+    try:
+        await read_lines()
+        ret = await proc.wait()
+    except BaseException: # timed out, or cancelled
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        _logger.error('%s killed', prog)
+        raise
+    err = "\n".join(tail)
+    if ret != 0:
+        _logger.error('%s returned %d', prog, ret)
+        _logger.info('%s stderr: %s', prog, err)
+    return ret, err
@@ -4,10 +4,32 @@
 #
 # It supports HEAD queries and partial file downloads
 # as used by aurl's parallel download methods.
+#
+# Stat results are cached briefly (to route requests), but
+# each file sent is sized from an fstat of the opened file.
+# Small files are kept in memory (re-read when their size
+# or mtime changes).
+# Large files are streamed with posix_fadvise hints, so that
+# reading them once does not evict the page cache of hot data.
+#
+# File transfers are limited globally and per client
+# (answering 503 or 429 with Retry-After when exceeded), and
+# directory listings run on a small thread pool.
+#
+# Large trees can be listed as newline-delimited JSON
+# (`?format=ndjson`), generated incrementally and paged
+# with a cursor -- see `walk_dir`.
 
 import os, sys
-from typing import Union, Dict
-from pathlib import Path, PurePath
+import time
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Dict, List, Optional, Tuple, Any, AsyncIterator, Iterator
+from pathlib import Path, PurePath, PurePosixPath
+import itertools
+import json
+from stat import S_ISDIR, S_ISREG
 
 from dataclasses import dataclass
 @dataclass
@@ -35,11 +57,303 @@ def stat_dir(path: Path, max_depth=0) -> Dict[str, FileStat]:
                 ans[p.name].children = True
     return ans
 
+#: deepest ndjson listing (deeper directories are marked "more")
+listing_depth = 32
+#: most records in one page of an ndjson listing
+listing_page = 100000
+#: records stat-ed per trip to the listing pool
+listing_batch = 1000
+
+def walk_dir(path: Path, max_depth: int = -1, after: str = "",
+             hidden: bool = True) -> Iterator[Dict[str, Any]]:
+    """ Records for everything below path, one at a time.
+
+        Directories are walked depth-first with names sorted,
+        so the records are ordered by their relative paths'
+        components.  Each is::
+
+            {"path": <relative posix path>, "size": ..., "atime": ..,
+             "mtime": ..., "dir": true, "more": true}
+
+        where "dir" is present only for directories, and "more"
+        only for directories below `max_depth` (which are not
+        walked; negative means no limit).  Only records after
+        the path `after` are produced, so a listing can be
+        resumed from the last path received.
+
+        Only the names of one directory at a time are held
+        in memory.  As for stat_dir, path is not checked.
+    """
+    skip = PurePosixPath(after).parts if after else ()
+
+    def walk(d: Path, parts: Tuple[str, ...], depth: int):
+        try:
+            names = sorted(os.listdir(d))
+        except OSError:
+            return
+        for name in names:
+            if not hidden and name.startswith("."):
+                continue
+            rel = parts + (name,)
+            inside = rel == skip[:len(rel)] # holds (or is) the cursor
+            if rel <= skip and not inside:
+                continue
+            try:
+                st = (d / name).stat()
+            except OSError: # vanished
+                continue
+            isdir = S_ISDIR(st.st_mode)
+            if rel > skip:
+                rec: Dict[str, Any] = {"path": "/".join(rel),
+                                       "size": int(st.st_size),
+                                       "atime": int(st.st_atime),
+                                       "mtime": int(st.st_mtime)}
+                if isdir:
+                    rec["dir"] = True
+                    if depth == max_depth:
+                        rec["more"] = True
+                yield rec
+            if isdir and depth != max_depth:
+                yield from walk(d / name, rel, depth+1)
+
+    return walk(path, (), 0)
+
+async def ndjson_lines(p: Path, max_depth: int, after: str, limit: int,
+                       hidden: bool) -> AsyncIterator[bytes]:
+    # Up to `limit` records of walk_dir, a batch at a time from
+    # the listing pool, then {"cursor": path} if the page is full.
+    loop = asyncio.get_running_loop()
+    it = walk_dir(p, max_depth, after, hidden)
+    n = 0
+    last = None
+    while n < limit:
+        batch = await loop.run_in_executor(listing_pool(), list,
+                            itertools.islice(it, min(listing_batch, limit-n)))
+        if len(batch) == 0:
+            return
+        n += len(batch)
+        last = batch[-1]["path"]
+        yield b"".join(json.dumps(r).encode() + b"\n" for r in batch)
+    yield json.dumps({"cursor": last}).encode() + b"\n"
+
+class StatCache:
+    """ Recently seen stat results, re-checked after `ttl` seconds.
+
+        Holds at most `size` entries (least recently used are dropped).
+        Missing paths are cached as None.
+    """
+    def __init__(self, ttl: float = 1.0, size: int = 10000):
+        self.ttl = ttl
+        self.size = size
+        self.entries: OrderedDict[Path, Tuple[float, Optional[os.stat_result]]] = OrderedDict()
+
+    def stat(self, path: Path) -> Optional[os.stat_result]:
+        now = time.monotonic()
+        ent = self.entries.get(path)
+        if ent is not None and now - ent[0] < self.ttl:
+            self.entries.move_to_end(path)
+            return ent[1]
+        try:
+            st: Optional[os.stat_result] = path.stat()
+        except (FileNotFoundError, NotADirectoryError):
+            st = None
+        self.entries[path] = (now, st)
+        self.entries.move_to_end(path)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return st
+
+class HotFiles:
+    """ Contents of small files, kept while they are recently used.
+
+        Files up to `max_file` bytes are cached, and the least
+        recently used are dropped to keep the total under `max_bytes`.
+        An entry is valid while the file's (size, mtime) is unchanged.
+        Files are read on a thread, so misses do not stall the loop.
+    """
+    def __init__(self, max_file: int = 1<<20, max_bytes: int = 256<<20):
+        self.max_file = max_file
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[Path, Tuple[Tuple[int, int], bytes]] = OrderedDict()
+
+    async def get(self, path: Path, fd: int, st: os.stat_result) -> bytes:
+        # Contents of path, open as fd with fstat result st.
+        key = (st.st_size, st.st_mtime_ns)
+        ent = self.entries.get(path)
+        if ent is not None and ent[0] == key:
+            self.hits += 1
+            self.entries.move_to_end(path)
+            return ent[1]
+        self.misses += 1
+        data = await asyncio.to_thread(read_all, fd, st.st_size)
+        self.drop(path)
+        if len(data) == st.st_size: # else, changed while reading
+            self.entries[path] = (key, data)
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+        return data
+
+    def drop(self, path: Path) -> None:
+        ent = self.entries.pop(path, None)
+        if ent is not None:
+            self.nbytes -= len(ent[1])
+
+stat_cache = StatCache()
+hot_files = HotFiles()
+#: files at least this large are dropped from the page cache as they are sent
+dontneed_size = 64 << 20
+#: bytes read per chunk when streaming files
+read_size = 1 << 20
+
+def byte_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """ Parse a single-range "bytes=a-b" header into [start, end).
+
+        Returns None for a missing or multi-range header
+        (so the whole file is sent).  Raises ValueError
+        if the range is malformed or not satisfiable.
+    """
+    if header is None or "," in header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes":
+        return None
+    a, _, b = spec.strip().partition("-")
+    if a == "": # suffix: the last b bytes
+        n = int(b)
+        if n <= 0:
+            raise ValueError(header)
+        return max(size-n, 0), size
+    start = int(a)
+    end = size if b == "" else min(int(b)+1, size)
+    if start >= size or end <= start:
+        raise ValueError(header)
+    return start, end
+
+def advise(fd: int, offset: int, length: int, advice: str) -> None:
+    # posix_fadvise, where available
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, "POSIX_FADV_"+advice))
+        except OSError:
+            pass
+
+def open_file(path: Path) -> Tuple[int, os.stat_result]:
+    # Open path for reading, returning (fd, fstat of the open file).
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return fd, os.fstat(fd)
+    except BaseException:
+        os.close(fd)
+        raise
+
+def read_all(fd: int, size: int) -> bytes:
+    # Everything in an open file (expected to hold `size` bytes).
+    chunks: List[bytes] = []
+    pos = 0
+    while True:
+        chunk = os.pread(fd, max(size-pos, read_size), pos)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        pos += len(chunk)
+
+async def send_bytes(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+async def read_range(fd: int, start: int, end: int) -> AsyncIterator[bytes]:
+    """ Stream bytes [start, end) of an open file, reading in a thread.
+        The file is closed when done.
+
+        The kernel is told the range will be read sequentially,
+        and each chunk is prefetched while the previous one is sent.
+        For large files, chunks are dropped from the page cache
+        once sent.
+    """
+    try:
+        advise(fd, start, end-start, "SEQUENTIAL")
+        drop = os.fstat(fd).st_size >= dontneed_size
+        pos = start
+        while pos < end:
+            n = min(read_size, end-pos)
+            advise(fd, pos+n, min(read_size, end-pos-n), "WILLNEED")
+            chunk = await asyncio.to_thread(os.pread, fd, n, pos)
+            if not chunk: # truncated underneath us
+                break
+            yield chunk
+            if drop:
+                advise(fd, pos, len(chunk), "DONTNEED")
+            pos += len(chunk)
+    finally:
+        os.close(fd)
+
+class Limits:
+    """ Concurrent transfers allowed, in total and per client address.
+
+        `acquire` returns None if a transfer may start, or else
+        the HTTP status to refuse it with (503 if the server is
+        busy, 429 if the client has too many transfers open).
+    """
+    def __init__(self, total: int = 256, per_client: int = 16,
+                 listings: int = 32, retry_after: int = 1):
+        self.total = total
+        self.per_client = per_client
+        self.listings = listings #: concurrent directory listings
+        self.retry_after = retry_after #: seconds, sent when refusing
+        self.active = 0
+        self.listing = 0
+        self.clients: Dict[str, int] = {}
+
+    def acquire(self, client: str) -> Optional[int]:
+        if self.active >= self.total:
+            return 503
+        n = self.clients.get(client, 0)
+        if n >= self.per_client:
+            return 429
+        self.active += 1
+        self.clients[client] = n + 1
+        return None
+
+    def release(self, client: str) -> None:
+        self.active -= 1
+        n = self.clients[client] - 1
+        if n == 0:
+            del self.clients[client]
+        else:
+            self.clients[client] = n
+
+limits = Limits()
+#: threads running directory listings
+listing_threads = 4
+_listing_pool: Optional[ThreadPoolExecutor] = None
+
+def listing_pool() -> ThreadPoolExecutor:
+    global _listing_pool
+    if _listing_pool is None:
+        _listing_pool = ThreadPoolExecutor(listing_threads,
+                                           thread_name_prefix="aurl-listing")
+    return _listing_pool
+
 try: # fastapi is optional
-    from fastapi import FastAPI, HTTPException, Response # type: ignore[import-not-found]
-    from fastapi.responses import FileResponse # type: ignore[import-not-found]
+    from fastapi import FastAPI, HTTPException, Response, Request # type: ignore[import-not-found]
+    from fastapi.responses import StreamingResponse # type: ignore[import-not-found]
     app = FastAPI()
 
+    class LimitedResponse(StreamingResponse):
+        # A streamed transfer holding one of the client's slots in `limits`.
+        def __init__(self, content, client: str, **kws):
+            super().__init__(content, **kws)
+            self.client = client
+
+        async def __call__(self, scope, receive, send):
+            try:
+                await super().__call__(scope, receive, send)
+            finally:
+                limits.release(self.client)
+
     try: # improved logging is optional
         from certified.formatter import log_request # type: ignore[import-not-found]
         app.middleware("http")(log_request)
@@ -58,6 +372,7 @@ except ImportError: # These stubs will allow this module to load, but not work.
     class HTTPException(Exception): # type: ignore[assignment, no-redef]
         def __init__(self, status_code, detail):
             super().__init__(detail)
+    Request = Any # type: ignore[assignment, misc]
 
 file_root = Path().resolve()
 
@@ -72,24 +387,128 @@ def safe_path(base: Path, fname: Union[Path,str]) -> Path:
     if rel.is_absolute() or ".." in rel.parts:
         raise HTTPException(status_code=403, detail="invalid path")
 
-    if not base.is_dir():
+    st = stat_cache.stat(base)
+    if st is None or not S_ISDIR(st.st_mode):
         raise HTTPException(status_code=404, detail="base dir missing")
 
     # FIXME: check whether this path traverses a symlink
     # (https://stackoverflow.com/questions/41460434/getting-the-target-of-a-symbolic-link-with-pathlib)
     return base / rel
 
+def file_headers(p: Path, st: os.stat_result) -> Dict[str, str]:
+    return {
+        "content-length": str(st.st_size),
+        "content-type": "application/octet-stream",
+        "accept-ranges": "bytes",
+        "content-disposition": f"attachment; filename={p.name}",
+        "last-modified": time.strftime("%a, %d %b %Y %H:%M:%S GMT",
+                                       time.gmtime(st.st_mtime)),
+    }
+
+async def send_file(request: Request, p: Path):
+    # Response for (the requested range of) the file p.
+    # Cached and streamed files both take a transfer slot.
+    # Headers come from the opened file (not the stat cache),
+    # and cached files are sized by the data actually read.
+    try:
+        fd, st = await asyncio.to_thread(open_file, p)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="File not found")
+    if not S_ISREG(st.st_mode):
+        os.close(fd)
+        raise HTTPException(status_code=404, detail="File not found")
+    client = request.client.host if request.client else ""
+    refused = limits.acquire(client)
+    if refused is not None:
+        os.close(fd)
+        return Response(status_code=refused,
+                        headers={"retry-after": str(limits.retry_after)})
+    size = st.st_size
+    streamed = size > hot_files.max_file
+    owned = True # the slot (and a streamed fd) are released here on error
+    try:
+        data = b""
+        if not streamed:
+            try:
+                data = await hot_files.get(p, fd, st)
+            finally:
+                os.close(fd)
+            size = len(data)
+        try:
+            rng = byte_range(request.headers.get("range"), size)
+        except ValueError:
+            return Response(status_code=416,
+                            headers={"content-range": f"bytes */{size}"})
+        hdr = file_headers(p, st)
+        status = 200
+        start, end = 0, size
+        if rng is not None:
+            status = 206
+            start, end = rng
+            hdr["content-range"] = f"bytes {start}-{end-1}/{size}"
+        hdr["content-length"] = str(end-start)
+        if streamed:
+            content = read_range(fd, start, end)
+        else:
+            content = send_bytes(data[start:end])
+        owned = False
+        return LimitedResponse(content, client, status_code=status, headers=hdr)
+    finally:
+        if owned:
+            if streamed:
+                os.close(fd)
+            limits.release(client)
+
+async def list_dir(p: Path, max_depth: int):
+    # stat_dir, run on the listing pool.
+    if limits.listing >= limits.listings:
+        return Response(status_code=503,
+                        headers={"retry-after": str(limits.retry_after)})
+    limits.listing += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(listing_pool(), stat_dir, p, max_depth)
+    finally:
+        limits.listing -= 1
+
+def stream_dir(request: Request, p: Path, max_depth: Optional[int],
+               after: str, limit: int, hidden: bool):
+    # Streamed ndjson listing, holding one of the client's transfer slots.
+    if max_depth is None or max_depth < 0 or max_depth > listing_depth:
+        max_depth = listing_depth
+    if limit <= 0 or limit > listing_page:
+        limit = listing_page
+    client = request.client.host if request.client else ""
+    refused = limits.acquire(client)
+    if refused is not None:
+        return Response(status_code=refused,
+                        headers={"retry-after": str(limits.retry_after)})
+    return LimitedResponse(ndjson_lines(p, max_depth, after, limit, hidden),
+                           client, media_type="application/x-ndjson")
+
 @app.get("/{filename:path}")
-async def get_file(filename: str, max_depth: int = 0):
+async def get_file(request: Request, filename: str,
+                   max_depth: Optional[int] = None,
+                   format: str = "json", after: str = "", limit: int = 0,
+                   hidden: bool = True):
     """
     Serves a file from the working directory if it exists.
+
+    Directories are listed as one JSON document (see stat_dir),
+    or with `format=ndjson` as a stream of records (see walk_dir),
+    walked as deep as `listing_depth` unless max_depth is given.
     """
     file_path = safe_path(file_root, filename)
-    if file_path.is_file():
-        return FileResponse(file_path, filename=file_path.name)
-    elif file_path.is_dir():
-        max_depth = min(max_depth, 3) # truncate to at most 3
-        return stat_dir(file_path, max_depth)
+    st = stat_cache.stat(file_path)
+    if st is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    if S_ISREG(st.st_mode):
+        return await send_file(request, file_path)
+    elif S_ISDIR(st.st_mode):
+        if format == "ndjson":
+            return stream_dir(request, file_path, max_depth, after, limit, hidden)
+        max_depth = min(max_depth or 0, 3) # truncate to at most 3
+        return await list_dir(file_path, max_depth)
     else:
         raise HTTPException(status_code=404, detail="File not found")
 
@@ -100,15 +519,10 @@ async def head_file(filename: str):
     Returns headers without the file body.
     """
     p = safe_path(file_root, filename)
-    try:
-        stat = p.stat()
-    except FileNotFoundError:
+    stat = stat_cache.stat(p)
+    if stat is None:
         raise HTTPException(status_code=404, detail="File not found")
 
-    hdr = {
-        "content-length": str(stat.st_size),
-        "content-type": "application/octet-stream",
-        "accept-ranges": "bytes",
-        "content-disposition": f"attachment; filename={p.name}",
-    }
+    hdr = file_headers(p, stat)
+    hdr["x-aurl-type"] = "directory" if S_ISDIR(stat.st_mode) else "file"
     return Response(status_code=200, headers=hdr)
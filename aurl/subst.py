@@ -6,23 +6,252 @@ __copyright__ = "UT-Battelle LLC"
 __license__ = "BSD3"
 
 from pathlib import Path
-from typing import Optional, List, Set
+from typing import Optional, List, Set, FrozenSet, Dict, Tuple, Sequence, Iterable
+import asyncio
 import logging
 _logger = logging.getLogger(__name__)
 
 import typer
 
 from .mirror import Mirror
-from .template import TemplateFile
+from .template import TemplateFile, is_template, template_suffixes
+from .deps import DepRecord, Resolver, file_digest
+from .exceptions import DownloadException
 from .urls import URL
+from .progress import Progress, Display, with_progress
 from . import arun
 
 app = typer.Typer()
 
+def output_names(templates : Sequence[Path]) -> Dict[Path, Path]:
+    """ Map each output file to the template it is rendered from.
+
+        The output name is the template name with its last
+        suffix removed.  If two templates would write the
+        same output, the first one wins.
+    """
+    outputs : Dict[Path, Path] = {}
+    for fname in templates:
+        out = fname.parent / fname.stem
+        if out not in outputs:
+            outputs[out] = fname
+    return outputs
+
+def _load(fname : Path, out : Path, resolve : Resolver,
+          force : bool) -> Tuple[str, Optional[TemplateFile]]:
+    # Hash the template and parse it only if `out` is stale.
+    digest = file_digest(fname)
+    if not force:
+        rec = DepRecord.load(out)
+        if rec is not None and rec.up_to_date(out, digest, resolve):
+            return digest, None
+    return digest, TemplateFile(fname)
+
+def _render(tf : TemplateFile, out : Path, digest : str,
+            lookup : Dict[URL, Path]) -> bool:
+    changed = tf.write(out, lookup)
+    DepRecord.build(digest, tf.uris, lookup).save(out)
+    return changed
+
+async def load_stale(outputs : Dict[Path, Path], M : Mirror, force : bool = False,
+                     resolve : Optional[Resolver] = None
+                    ) -> Tuple[Dict[Path, Tuple[str, TemplateFile]], Set[URL]]:
+    """ Parse the templates of all out-of-date outputs (in parallel).
+
+        Alternates listed in the templates are added to M.
+        Dependencies are checked against `resolve` (default M.lookup).
+
+        Returns the stale outputs, mapped to their template's
+        (digest, TemplateFile), and the URLs they use.
+    """
+    loop = asyncio.get_running_loop()
+    if resolve is None:
+        resolve = M.lookup
+    loaded = await asyncio.gather(*[
+                    loop.run_in_executor(None, _load, fname, out, resolve, force)
+                    for out, fname in outputs.items() ])
+
+    stale : Dict[Path, Tuple[str, TemplateFile]] = {}
+    urls : Set[URL] = set()
+    for out, (digest, tf) in zip(outputs, loaded):
+        if tf is None:
+            _logger.info("%s is up-to-date", out)
+            continue
+        stale[out] = (digest, tf)
+        urls |= set(tf.uris)
+        for url, alts in tf.alternates.items():
+            M.add_alternates(url, alts)
+    return stale, urls
+
+class TemplateDAG:
+    """ Fetch URLs, rendering those naming nested templates.
+
+        A URL whose path ends in one of `suffixes` is fetched,
+        then rendered (with its own URLs resolved the same way)
+        to `base/.aurl/rendered/<entry path without suffix>`, and
+        that rendered file is what gets substituted for it.
+
+        Every URL is resolved by one memoized task, so each node
+        of the dependency graph is fetched and rendered once,
+        as soon as its inputs are ready.  A template which
+        (indirectly) includes itself raises a DownloadException.
+
+        Rendered templates get dependency records too, so
+        an edit anywhere below an output makes it stale.
+    """
+    def __init__(self, M : Mirror, suffixes : Sequence[str] = template_suffixes):
+        self.M = M
+        self.suffixes = suffixes
+        self.tasks : Dict[URL, asyncio.Task] = {}
+        self.deps : Dict[URL, Set[URL]] = {} #: edges found so far
+
+    def rendered(self, url : URL) -> Path:
+        # where the nested template at url is rendered
+        rel = self.M.encode(url).relative_to(self.M.base)
+        for s in self.suffixes:
+            if rel.name.endswith(s):
+                rel = rel.with_name(rel.name[:-len(s)])
+                break
+        return self.M.state / "rendered" / rel
+
+    def lookup(self, url : URL,
+               above : FrozenSet[URL] = frozenset()) -> Optional[Path]:
+        # Resolver for dependency records: the rendered path
+        # of a nested template (if it is up-to-date with its
+        # template and inputs), else M.lookup.
+        #
+        # `above` holds the templates being checked further up
+        # this lookup (which may run on several threads at once).
+        if not is_template(url, self.suffixes):
+            return self.M.lookup(url)
+        out = self.rendered(url)
+        src = self.M.lookup(url)
+        rec = DepRecord.load(out)
+        if src is None or rec is None or url in above:
+            return None
+        inner = above | {url}
+        ok = rec.up_to_date(out, file_digest(src),
+                            lambda u: self.lookup(u, inner))
+        return out if ok else None
+
+    def reaches(self, a : URL, b : URL) -> bool:
+        # Is there a path a -> ... -> b in the graph?
+        seen = set()
+        todo = [a]
+        while todo:
+            u = todo.pop()
+            if u == b:
+                return True
+            if u not in seen:
+                seen.add(u)
+                todo.extend(self.deps.get(u, ()))
+        return False
+
+    def resolve(self, url : URL) -> "asyncio.Task[Path]":
+        t = self.tasks.get(url)
+        if t is None:
+            t = self.tasks[url] = asyncio.ensure_future(self._resolve(url))
+        return t
+
+    async def _resolve(self, url : URL) -> Path:
+        p = await self.M.fetch(url)
+        if p is None:
+            raise DownloadException(f"Unable to fetch {url.s}")
+        if not is_template(url, self.suffixes):
+            return p
+        loop = asyncio.get_running_loop()
+        tf = await loop.run_in_executor(None, TemplateFile, p)
+        for u, alts in tf.alternates.items():
+            self.M.add_alternates(u, alts)
+
+        children = set(tf.uris)
+        self.deps[url] = children
+        for u in children:
+            if self.reaches(u, url):
+                raise DownloadException(f"Template cycle: {url.s} includes {u.s}")
+        lookup = await self.resolve_all(children)
+
+        out = self.rendered(url)
+        out.parent.mkdir(parents=True, exist_ok=True)
+        rel = out.relative_to(self.M.state).as_posix()
+        async with self.M.locks.lock(rel):
+            digest = await loop.run_in_executor(None, file_digest, p)
+            await loop.run_in_executor(None, _render, tf, out, digest, lookup)
+        return out
+
+    async def resolve_all(self, urls : Iterable[URL]) -> Dict[URL, Path]:
+        """ Resolve all urls, raising a DownloadException
+            listing every failure.
+        """
+        urls = list(urls)
+        ans = await asyncio.gather(*[self.resolve(u) for u in urls],
+                                   return_exceptions=True)
+        errors = []
+        for u, r in zip(urls, ans):
+            if isinstance(r, DownloadException):
+                errors.append(str(u)+": "+str(r))
+            elif isinstance(r, BaseException):
+                raise r
+        if len(errors) > 0:
+            raise DownloadException("Download errors:\n  - "
+                                    + "\n  - ".join(errors))
+        return dict(zip(urls, ans)) # type: ignore[arg-type]
+
+async def subst_all(templates : Sequence[Path], M : Mirror,
+                    force : bool = False,
+                    recursive : bool = False,
+                    coop : Optional[str] = None) -> Dict[Path, bool]:
+    """ Fetch and substitute URLs into all templates.
+
+        Outputs whose template and URL dependencies are
+        unchanged since the last run are skipped.  The remaining
+        templates are parsed and written in parallel.
+
+        If `recursive`, URLs naming templates are rendered
+        in turn (see TemplateDAG).
+
+        If `coop` names a queue, the URLs are first fetched
+        together with the other processes using it (see aurl.coop).
+
+        Returns a mapping from each output path to
+        whether it was (re-)written.
+
+        raises DownloadException on error.
+    """
+    loop = asyncio.get_running_loop()
+    outputs = output_names(templates)
+    dag = TemplateDAG(M) if recursive else None
+    stale, urls = await load_stale(outputs, M, force,
+                                   None if dag is None else dag.lookup)
+
+    written = dict((out, False) for out in outputs)
+    if len(stale) == 0:
+        return written
+
+    if coop is not None:
+        from .coop import cooperate
+        await cooperate(M, coop, urls)
+    if dag is None:
+        lookup = await M.fetch_all(urls)
+    else:
+        lookup = await dag.resolve_all(urls)
+    changed = await asyncio.gather(*[
+                    loop.run_in_executor(None, _render, tf, out, digest, lookup)
+                    for out, (digest, tf) in stale.items() ])
+    written.update(zip(stale, changed))
+    return written
+
 @app.command(help="Fetch and substitute URLs into a template.")
 def subst(templates  : List[Path] = typer.Argument(..., help="File(s) to substitute."),
           results    : bool = typer.Option(False, help="Don't substitute, but list required results."),
           mirror     : Optional[Path] = typer.Option(None, help="directory holding downloaded files"),
+          peer       : Optional[List[str]] = typer.Option(None, help="peer mirror (aurl.serve) to try before the origin, nearest first"),
+          force      : bool = typer.Option(False, help="re-write outputs even if they are up-to-date"),
+          recursive  : bool = typer.Option(False, help="render fetched *.tpl files as templates too"),
+          progress   : Display = typer.Option(Display.none, help="show download progress on stderr"),
+          daemon     : bool = typer.Option(True, help="use a running `aurl daemon` for this mirror"),
+          plan       : bool = typer.Option(False, help="only report what would be downloaded (sizes, hosts, estimated time)"),
+          coop       : Optional[str] = typer.Option(None, help="share the downloads with other processes joining this named queue in the mirror"),
           v     : bool = typer.Option(False, "-v", help="show info-level logs"),
           vv    : bool = typer.Option(False, "-vv", help="show debug-level logs"),
          ):
@@ -33,18 +262,10 @@ def subst(templates  : List[Path] = typer.Argument(..., help="File(s) to substit
     if mirror is None:
         mirror = Path()
 
-    urls : Set[URL] = set()
-    outputs = {}
-    for fname in templates:
-        # remove last suffix
-        out = fname.parent / fname.stem
-        if out in outputs:
-            continue
-        tf = TemplateFile(fname)
-        urls |= set(tf.uris)
-        outputs[out] = tf
-
     if results:
+        urls : Set[URL] = set()
+        for fname in output_names(templates).values():
+            urls |= set(TemplateFile(fname).uris)
         for url in urls:
             if url.scheme == 'result':
                 assert url.s[:9] == 'result://'
@@ -52,12 +273,20 @@ def subst(templates  : List[Path] = typer.Argument(..., help="File(s) to substit
                 #print('git' + url.s[6:])
         return 0
 
-    M = Mirror( mirror )
-    lookup = arun(M.fetch_all(urls))
-    for out, tf in outputs.items():
-        tf.write(out, lookup)
+    M = Mirror( mirror, peers=peer,
+                progress=None if progress == Display.none else Progress(),
+                use_daemon=daemon )
+    if plan:
+        from .plan import show_plan
+        async def plan_all():
+            stale, urls = await load_stale(output_names(templates), M, force)
+            return await show_plan(M, urls)
+        arun(plan_all())
+        return 0
+    arun(with_progress(subst_all(templates, M, force, recursive, coop),
+                       M.progress, progress))
 
     return 0
 
 if __name__ == "__main__":
-    subst()
+    app()
@@ -4,18 +4,24 @@ Defines template strings and files for URL substitution.
 See subst.py for code that performs the actual
 substitution.
 """
-from typing import Mapping, Sequence, Union, Tuple
+from typing import Mapping, Sequence, Union, Tuple, Dict, List, Optional
 from pathlib import Path
 
 from .urls import URL
 
-def parse_template(t : str) -> Tuple[Sequence[str], Sequence[URL]]:
+def parse_template(t : str, alternates : Optional[Dict[URL, List[URL]]] = None
+                  ) -> Tuple[Sequence[str], Sequence[URL]]:
     # Return a parsed form of the template string
     # as a sequence of strings, in-between which 
     # the URL-s should be inserted.
     #
     # The intended output starts and ends with a str
     # so that len(texts) == len(uris)+1
+    #
+    # A splice may list several whitespace-separated URLs,
+    # ${{ url alt1 alt2 }}, naming equivalent sources.
+    # The first is substituted, and the rest are added
+    # to `alternates[url]` (if provided).
     start = '${{'
     end = '}}'
     ls = len(start)
@@ -34,22 +40,39 @@ def parse_template(t : str) -> Tuple[Sequence[str], Sequence[URL]]:
             raise SyntaxError(f"Missing '{end}' in '{t}'")
 
         texts.append( t[:i] )
-        uris.append( URL(t[i+ls:j].strip()) )
+        srcs = [URL(u) for u in t[i+ls:j].split()]
+        if len(srcs) == 0:
+            raise SyntaxError(f"Empty '{start} {end}' in '{t}'")
+        uris.append( srcs[0] )
+        if alternates is not None and len(srcs) > 1:
+            alts = alternates.setdefault(srcs[0], [])
+            alts.extend(a for a in srcs[1:] if a not in alts)
         t = t[j+le:]
 
     texts.append(t)
 
     return texts, uris
 
+#: suffixes marking fetched files as (nested) templates
+template_suffixes = (".tpl",)
+
+def is_template(url : URL, suffixes : Sequence[str] = template_suffixes) -> bool:
+    # Does the url name a template, to be rendered after fetching?
+    return any(url.path.endswith(s) for s in suffixes)
+
 class Template:
     """ Class encapsulating a string to be templated.
 
         Segments the input string (t) into
         self.texts and self.urls
         with len(self.texts) == len(self.urls)+1
+
+        Alternate sources listed in a splice are
+        collected in self.alternates.
     """
     def __init__(self, t : str):
-        texts, uris = parse_template(t)
+        self.alternates : Dict[URL, List[URL]] = {}
+        texts, uris = parse_template(t, self.alternates)
         self.texts = texts
         self.uris = uris
 
@@ -66,7 +89,18 @@ class TemplateFile(Template):
         self.f = Path(f)
         super().__init__(self.f.read_text(encoding='utf-8'))
 
-    def write(self, out : Union[str, Path], cache : Mapping[URL, Path]) -> None:
-        # Over-write the input file with the mapped result.
+    def write(self, out : Union[str, Path], cache : Mapping[URL, Path]) -> bool:
+        # Over-write the output file with the mapped result.
+        # An output that already holds the same text is left
+        # untouched (preserving its mtime).
+        #
+        # Returns True if the file was written.
+        text = self.subst(cache)
+        try:
+            if Path(out).read_text(encoding='utf-8') == text:
+                return False
+        except (OSError, UnicodeDecodeError):
+            pass
         with open(out, 'w', encoding='utf-8') as f:
-            f.write(self.subst(cache))
+            f.write(text)
+        return True
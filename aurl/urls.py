@@ -1,31 +1,66 @@
-from typing import Optional, Union
+from typing import Optional, Union, Dict, List
+from weakref import WeakValueDictionary
 from pathlib import Path
 import os, logging
 
-from urllib.parse import urlparse, parse_qs, quote, unquote
+from urllib.parse import urlparse, urlsplit, parse_qs, quote, unquote
 
 class URL:
     """Parsed URL object.
 
     Fully parse a string into URL components
     and validate against valid URL formats.
+
+    URLs are immutable and interned: constructing a URL
+    from a string that is already in use returns the existing
+    instance, and the hash is computed once on creation.
    
     Attributes:
 
     * scheme   : str
     * netloc   : str
     * path     : str
-    * query    : {key:val}
+    * query    : {key:val} (parsed on access)
     * fragment : str
 
     """
-    def __init__(self, s1 : Union[str, 'URL'], validate=True):
-        if isinstance(s1, str):
-            s = s1
+    __slots__ = ("s", "scheme", "netloc", "path", "fragment",
+                 "meta", "_query", "_hash", "_valid", "__weakref__")
+
+    #: string -> live URL instance
+    _interned : "WeakValueDictionary[str, URL]" = WeakValueDictionary()
+
+    s        : str
+    scheme   : str
+    netloc   : str
+    path     : str
+    fragment : str
+    meta     : str
+    _query   : str
+    _hash    : int
+    _valid   : bool
+
+    def __new__(cls, s1 : Union[str, 'URL'], validate=True):
+        if isinstance(s1, URL):
+            self = s1
         else:
-            s = s.s # type: ignore[attr-defined]
-        ans = urlparse(s, scheme='', allow_fragments=True)
-        
+            self = cls._interned.get(s1) # type: ignore[assignment]
+            if self is None or type(self) is not cls:
+                self = object.__new__(cls)
+                self._parse(s1)
+                cls._interned[s1] = self
+
+        if validate and not self._valid:
+            try:
+                self.validate()
+            except AssertionError as e:
+                raise AssertionError(f"Invalid URL format: {self.s} -- {e}")
+            self._valid = True
+        return self
+
+    def _parse(self, s : str) -> None:
+        ans = urlsplit(s, scheme='', allow_fragments=True)
+
         # store metadata
         if ans.query != "":
             self.meta = f"?{ans.query}"
@@ -41,21 +76,24 @@ class URL:
         if self.scheme != "file": # remove leading '/' in paths
             if self.path.startswith("/"):
                 self.path = self.path[1:]
-        if len(ans.query) > 0:
-            self.query = parse_qs(ans.query,
-                              keep_blank_values=True,
-                              strict_parsing=True,
-                              errors="strict")
-        else:
-            self.query = {}
+        if len(ans.query) > 0: # raises ValueError if malformed
+            parse_qs(ans.query, keep_blank_values=True,
+                     strict_parsing=True, errors="strict")
+        self._query = ans.query
         self.fragment = unquote(ans.fragment)
         self.s = ans.geturl()
-        if not validate:
-            return
-        try:
-            self.validate()
-        except AssertionError as e:
-            raise AssertionError(f"Invalid URL format: {self.s} -- {e}")
+        self._hash = hash(self.s)
+        self._valid = False
+
+    @property
+    def query(self) -> Dict[str, List[str]]:
+        if len(self._query) == 0:
+            return {}
+        return parse_qs(self._query, keep_blank_values=True,
+                        strict_parsing=True, errors="strict")
+
+    def __reduce__(self):
+        return (self.__class__, (self.s, self._valid))
 
     def with_scheme(self, scheme):
         return urlparse(self.s, scheme="", allow_fragments=True) \
@@ -67,9 +105,13 @@ class URL:
     def __str__(self):
         return self.s
     def __hash__(self):
-        return hash(repr(self))
+        return self._hash
     def __eq__(a, b):
-        return repr(a) == repr(b)
+        if a is b:
+            return True
+        if isinstance(b, URL):
+            return a._hash == b._hash and a.s == b.s
+        return NotImplemented
     def fullpath(self):
         if self.scheme == "file":
             return self.path
@@ -78,15 +120,14 @@ class URL:
             s += '/' + self.path
         return s
     def validate(url):
-        absent = lambda x: len(getattr(url, x)) == 0
         # netloc, path, query, fragment
         if url.scheme in ["file", "git", "git+file", "git+http",
                           "git+https", "git+ssh", "ftp"]:
-            assert absent("query") and absent("fragment")
+            assert len(url._query) == 0 and len(url.fragment) == 0
         elif url.scheme in ["result"]:
-            assert absent("query")
+            assert len(url._query) == 0
         elif url.scheme == "https" or url.scheme == "http":
-            assert absent("fragment")
+            # the only fragments are aurl.extract's flags
+            assert url.fragment in ("", "extract", "extract=keep")
         else:
             raise AssertionError(f"Unknown URL scheme: {url.scheme}")
-
@@ -0,0 +1,204 @@
+"""
+Positional-write backend for downloads.
+
+Each destination file is opened once (`FileWriter`), and
+every range download writing into it gets a `RangeWriter`
+that collects contiguous chunks and hands them to a small
+dedicated thread pool in batches, written with
+`os.pwritev`/`os.pwrite` at explicit offsets (no seek, and no
+shared file position).  Optionally, the file can instead be
+memory-mapped and chunks copied straight into the map.
+"""
+from typing import Optional, List, Union, Set
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from pathlib import Path
+import asyncio
+import mmap
+import os
+import shutil
+import logging
+_logger = logging.getLogger(__name__)
+
+from .exceptions import DownloadException
+from . import progress
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+#: number of threads used to write downloaded data
+writer_threads = 4
+_pool : Optional[ThreadPoolExecutor] = None
+
+def writer_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(writer_threads,
+                                   thread_name_prefix="aurl-writer")
+    return _pool
+
+def iov_max() -> int:
+    # Most buffers a single pwritev may be given.
+    try:
+        n = os.sysconf("SC_IOV_MAX")
+    except (AttributeError, ValueError, OSError):
+        n = -1
+    return n if n > 0 else 1024
+
+def pwrite_all(fd : int, bufs : List[Buffer], offset : int) -> None:
+    # Write all bufs contiguously at offset.
+    k = iov_max()
+    while len(bufs) > k:
+        pwrite_all(fd, bufs[:k], offset)
+        offset += sum(len(b) for b in bufs[:k])
+        bufs = bufs[k:]
+    if hasattr(os, "pwritev"):
+        total = sum(len(b) for b in bufs)
+        n = os.pwritev(fd, bufs, offset)
+        if n == total:
+            return
+        data = memoryview(b"".join(bufs))[n:]
+        offset += n
+    else:
+        data = memoryview(b"".join(bufs))
+    while len(data) > 0:
+        n = os.pwrite(fd, data, offset)
+        data = data[n:]
+        offset += n
+
+def check_space(path : Path, size : int) -> None:
+    """ Raise a DownloadException unless the filesystem
+        holding `path` has at least `size` bytes free.
+    """
+    free = shutil.disk_usage(path.parent).free
+    if free < size:
+        raise DownloadException("Not enough space for %s: need %d bytes, %d free"%(
+                                path, size, free))
+
+class FileWriter:
+    """ A download destination, opened once for all ranges.
+
+        Args:
+           path: destination file (created or truncated)
+           size: final size to preallocate, if known
+           use_mmap: copy chunks into a memory map of the
+                     file instead of calling pwrite
+                     (requires a known, non-zero size)
+           batch_size: bytes collected by each RangeWriter
+                       before it issues a write
+    """
+    def __init__(self, path : Path, size : Optional[int] = None,
+                 use_mmap : bool = False, batch_size : int = 4*1024**2):
+        self.path = path
+        self.batch_size = batch_size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.mm : Optional[mmap.mmap] = None
+        self.inflight : Set[Future] = set() # writes running on the pool
+        self.progress = progress.current.get() #: where to count bytes
+        self.received = 0 # bytes counted there
+        try:
+            if size is not None and size > 0:
+                self.preallocate(size)
+                if use_mmap:
+                    self.mm = mmap.mmap(self.fd, size)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        if self.progress is not None:
+            self.progress.expect(size)
+
+    def preallocate(self, size : int) -> None:
+        # Reserve the file's blocks up-front (where supported).
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+                return
+            except OSError as e: # e.g. unsupported by the filesystem
+                _logger.debug("%s: posix_fallocate failed (%s)", self.path, e)
+        os.ftruncate(self.fd, size)
+
+    def restart(self) -> None:
+        # Un-count the bytes received, before writing the file again.
+        if self.progress is not None:
+            self.progress.add(-self.received)
+        self.received = 0
+
+    def truncate(self, size : int) -> None:
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        os.ftruncate(self.fd, size)
+
+    async def write_at(self, offset : int, bufs : List[Buffer]) -> None:
+        if self.mm is not None:
+            for b in bufs:
+                self.mm[offset:offset+len(b)] = b
+                offset += len(b)
+            return
+        fut = writer_pool().submit(pwrite_all, self.fd, bufs, offset)
+        self.inflight.add(fut)
+        try:
+            await asyncio.wrap_future(fut)
+        finally:
+            if fut.done():
+                self.inflight.discard(fut)
+
+    def part(self, offset : int) -> "RangeWriter":
+        # Writer for a range starting at offset.
+        return RangeWriter(self, offset)
+
+    def close(self) -> None:
+        # A cancelled writer may leave its write running,
+        # so wait for those before closing the fd.
+        wait(list(self.inflight))
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self) -> "FileWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+        return False # continue to raise the exception
+
+class RangeWriter:
+    """ Sequential writer for one byte range of a FileWriter.
+
+        Chunks are buffered until `batch_size` bytes have
+        accumulated, then written together.  `written` counts
+        the bytes that have reached the file.
+    """
+    def __init__(self, f : FileWriter, offset : int):
+        self.f = f
+        self.start = offset
+        self.written = 0
+        self.bufs : List[Buffer] = []
+        self.pending = 0
+
+    @property
+    def pos(self) -> int:
+        # offset of the next byte to be written
+        return self.start + self.written + self.pending
+
+    async def write(self, chunk : Buffer) -> None:
+        if self.f.progress is not None:
+            self.f.progress.add(len(chunk))
+            self.f.received += len(chunk)
+        if self.f.mm is not None:
+            await self.f.write_at(self.pos, [chunk])
+            self.written += len(chunk)
+            return
+        self.bufs.append(chunk)
+        self.pending += len(chunk)
+        if self.pending >= self.f.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.pending == 0:
+            return
+        bufs, n = self.bufs, self.pending
+        self.bufs, self.pending = [], 0
+        await self.f.write_at(self.start + self.written, bufs)
+        self.written += n
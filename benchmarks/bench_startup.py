@@ -0,0 +1,51 @@
+"""Startup-time benchmark for the command-line tools.
+
+Times `subst` on a template whose output is already up-to-date
+(the all-cache-hit path), along with bare imports, and
+checks that aiohttp is not imported on that path.
+
+Usage::
+
+    python benchmarks/bench_startup.py [repeats]
+"""
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+def timed(args, n):
+    dt = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        subprocess.run(args, check=True, stdout=subprocess.DEVNULL)
+        dt.append(time.perf_counter() - t0)
+    return statistics.median(dt)
+
+def main(n : int = 10) -> None:
+    py = sys.executable
+    print(f"{'python (baseline)':<28} {timed([py, '-c', 'pass'], n)*1e3:8.1f} ms")
+    for mod in ["aurl", "aurl.subst", "aurl.fetch"]:
+        t = timed([py, "-c", f"import {mod}"], n)
+        print(f"{'import '+mod:<28} {t*1e3:8.1f} ms")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp)
+        (base/"mirror").mkdir()
+        (base/"data").write_text("data")
+        tpl = base/"out.txt.tpl"
+        tpl.write_text("x = ${{ file://%s/data }}\n" % base)
+        args = [py, "-m", "aurl.subst", "--mirror", str(base/"mirror"),
+                str(tpl)]
+        subprocess.run(args, check=True)
+        print(f"{'subst (up-to-date)':<28} {timed(args, n)*1e3:8.1f} ms")
+
+    code = ("import sys, aurl.subst, aurl.get, aurl.get_dir; "
+            "print('aiohttp' in sys.modules)")
+    out = subprocess.run([py, "-c", code], check=True,
+                         capture_output=True, text=True).stdout.strip()
+    print(f"{'aiohttp imported by CLIs':<28} {out:>8}")
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,49 @@
+"""Microbenchmark for URL parse / hash / Mirror.encode throughput.
+
+Usage::
+
+    python benchmarks/bench_urls.py [N]
+"""
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+from aurl.urls import URL
+from aurl.mirror import Mirror
+
+def report(name, n, dt):
+    print(f"{name:<24} {n/dt/1e3:10.1f} kops/s")
+
+def main(n : int = 200000) -> None:
+    strs = [f"https://data.example.org/set{i%100}/file{i}.h5"
+            for i in range(n)]
+
+    t0 = timeit.default_timer()
+    urls = [URL(s) for s in strs]
+    report("parse (new)", n, timeit.default_timer()-t0)
+
+    t0 = timeit.default_timer()
+    again = [URL(s) for s in strs]
+    report("parse (interned)", n, timeit.default_timer()-t0)
+
+    t0 = timeit.default_timer()
+    seen = set(urls)
+    seen.update(again)
+    report("hash + set insert", 2*n, timeit.default_timer()-t0)
+
+    t0 = timeit.default_timer()
+    d = dict.fromkeys(urls)
+    hits = sum(1 for u in again if u in d)
+    report("dict lookup", n, timeit.default_timer()-t0)
+    assert hits == n
+
+    with tempfile.TemporaryDirectory() as base:
+        M = Mirror(Path(base))
+        t0 = timeit.default_timer()
+        for u in urls:
+            M.encode(u)
+        report("Mirror.encode", n, timeit.default_timer()-t0)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,48 @@
+"""Helpers shared by the tests.
+"""
+import asyncio
+import threading
+
+import pytest # type: ignore[import]
+from aiohttp import web
+
+def arun(coro):
+    # run on a private loop (leaving the default loop alone)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+async def serve(app: web.Application):
+    # Start app on a free local port, returning (runner, base url).
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1] # type: ignore[union-attr]
+    return runner, f"http://127.0.0.1:{port}"
+
+@pytest.fixture
+def http_server():
+    """ Serve aiohttp applications from a loop on a background
+        thread (for clients running in other processes).
+
+        Yields a function starting an app and returning its base url.
+    """
+    loop = asyncio.new_event_loop()
+    t = threading.Thread(target=loop.run_forever, daemon=True)
+    t.start()
+    runners = []
+    def start(app: web.Application) -> str:
+        runner, base = asyncio.run_coroutine_threadsafe(serve(app), loop).result()
+        runners.append(runner)
+        return base
+    try:
+        yield start
+    finally:
+        for runner in runners:
+            asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        t.join()
+        loop.close()
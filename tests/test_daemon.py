@@ -0,0 +1,62 @@
+from pathlib import Path
+import asyncio
+import os
+
+import pytest # type: ignore[import]
+from aiohttp import web
+
+from aurl.urls import URL
+from aurl.mirror import Mirror
+from aurl.daemon import Daemon, socket_path, ping, request
+from aurl.exceptions import DownloadException
+
+from .conftest import arun, serve
+
+def test_daemon(tmp_path):
+    payload = os.urandom(10000)
+    hits = []
+
+    async def handler(request: web.Request):
+        hits.append(request.path)
+        await asyncio.sleep(0.2)
+        if request.path == "/gone":
+            return web.Response(status=404)
+        return web.Response(body=payload)
+
+    D = Daemon(Mirror(tmp_path)) # before the loop exists, as in `aurl daemon`
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", handler)
+        runner, base = await serve(app)
+        url = URL(f"{base}/data.bin")
+
+        server = asyncio.ensure_future(D.run())
+        try:
+            path = socket_path(D.M)
+            while await ping(path) is None:
+                await asyncio.sleep(0.01)
+            with pytest.raises(DownloadException):
+                await Daemon(Mirror(tmp_path)).run() # only one per mirror
+
+            clients = [Mirror(tmp_path, use_daemon=True) for i in range(4)]
+            ans = await asyncio.gather(*[C.fetch_all([url]) for C in clients])
+            with pytest.raises(DownloadException):
+                await clients[0].fetch(URL(f"{base}/gone"))
+            resolved = await request(path, {"op": "resolve", "id": 7,
+                                            "urls": [url.s, url.s+"x"]})
+            stats = await ping(path)
+        finally:
+            D.stop()
+            await server
+            await runner.cleanup()
+        assert not path.exists()
+        return url, ans, resolved, stats
+
+    url, ans, resolved, stats = arun(run())
+    for a in ans:
+        assert a[url].read_bytes() == payload
+    assert hits.count("/data.bin") == 1
+    assert resolved["id"] == 7
+    assert resolved["paths"][url.s] == str(ans[0][url])
+    assert resolved["paths"][url.s+"x"] is None
+    assert stats is not None and stats["coalesced"] == 3
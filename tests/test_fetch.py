@@ -0,0 +1,627 @@
+from pathlib import Path
+import asyncio
+import os
+
+import pytest # type: ignore[import]
+from aiohttp import web
+
+from aurl.urls import URL
+from aurl.multisource import download_multi
+
+from .conftest import arun, serve
+
+data = os.urandom(3*1024**2 + 17)
+
+def ranged(payload: bytes, fail_after=None):
+    # Handler serving payload with Range support.
+    # If fail_after is set, the connection is dropped
+    # after that many bytes of each response.
+    async def handler(request: web.Request):
+        hdr = {"Accept-Ranges": "bytes"}
+        if request.method == "HEAD":
+            hdr["Content-Length"] = str(len(payload))
+            return web.Response(headers=hdr)
+        rng = request.http_range
+        start = rng.start or 0
+        stop = len(payload) if rng.stop is None else min(rng.stop, len(payload))
+        if start >= len(payload):
+            hdr["Content-Range"] = f"bytes */{len(payload)}"
+            return web.Response(status=416, headers=hdr)
+        body = payload[start:stop]
+        hdr["Content-Range"] = f"bytes {start}-{stop-1}/{len(payload)}"
+        resp = web.StreamResponse(status=206, headers=hdr)
+        resp.content_length = len(body)
+        await resp.prepare(request)
+        if fail_after is not None:
+            await resp.write(body[:fail_after])
+            request.transport.close() # type: ignore[union-attr]
+            return resp
+        await resp.write(body)
+        return resp
+    return handler
+
+async def unavailable(request: web.Request):
+    return web.Response(status=503)
+
+def test_download_multi(tmp_path):
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/good", ranged(data))
+        app.router.add_route("*", "/flaky", ranged(data, fail_after=1000))
+        app.router.add_route("*", "/gone", unavailable)
+        runner, base = await serve(app)
+        try:
+            urls = [URL(f"{base}/flaky"), URL(f"{base}/gone"),
+                    URL(f"{base}/good")]
+            return await download_multi(tmp_path/"out", urls,
+                                        chunk_size=64*1024,
+                                        max_connections=2)
+        finally:
+            await runner.cleanup()
+
+    sz = arun(run())
+    assert sz == len(data)
+    assert (tmp_path/"out").read_bytes() == data
+
+def mirror_server(root: Path) -> web.Application:
+    # Stand-in for aurl.serve running inside a peer mirror.
+    from dataclasses import asdict
+    from aurl.serve import stat_dir
+
+    async def handler(request: web.Request):
+        p = root / request.match_info["path"]
+        if not p.exists():
+            return web.Response(status=404)
+        if request.method == "HEAD":
+            return web.Response(headers={
+                "Content-Length": str(p.stat().st_size),
+                "x-aurl-type": "directory" if p.is_dir() else "file"})
+        if p.is_dir():
+            depth = int(request.query.get("max_depth", 0))
+            return web.json_response(dict((k, asdict(v)) for k, v in
+                                          stat_dir(p, depth).items()))
+        return web.FileResponse(p)
+
+    app = web.Application()
+    app.router.add_route("*", "/{path:.*}", handler)
+    return app
+
+def test_peer_fetch(tmp_path):
+    from aurl.mirror import Mirror
+
+    (tmp_path/"peer").mkdir()
+    (tmp_path/"local").mkdir()
+    P = Mirror(tmp_path/"peer")
+    files = {"https://example.invalid/data/x.txt": b"x"*1000,
+             "result://job/42": b"result"}
+    for u, v in files.items():
+        p = P.encode(URL(u))
+        p.parent.mkdir(parents=True)
+        p.write_bytes(v)
+    clone = P.encode(URL("git+https://example.invalid/a/b"))
+    (clone/".git"/"refs").mkdir(parents=True)
+    (clone/".git"/"HEAD").write_text("ref: refs/heads/main\n")
+    (clone/"README.md").write_text("readme")
+
+    async def run():
+        runner, base = await serve(mirror_server(P.base))
+        try:
+            M = Mirror(tmp_path/"local", peers=[base])
+            return M, await M.fetch_all([URL(u) for u in files]
+                               + [URL("git+https://example.invalid/a/b")])
+        finally:
+            await runner.cleanup()
+
+    M, paths = arun(run())
+    for u, v in files.items():
+        assert paths[URL(u)].read_bytes() == v
+        assert paths[URL(u)] == M.encode(URL(u))
+    out = paths[URL("git+https://example.invalid/a/b")]
+    assert (out/".git"/"HEAD").read_text() == "ref: refs/heads/main\n"
+    assert (out/".git"/"refs").is_dir()
+    assert (out/"README.md").read_text() == "readme"
+
+@pytest.mark.parametrize("use_mmap,probe", [(False, False), (True, False),
+                                            (False, True), (True, True)])
+def test_download_url(tmp_path, use_mmap, probe):
+    from aurl.fetch import download_url
+
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/good", ranged(data))
+        runner, base = await serve(app)
+        try:
+            return await download_url(tmp_path/"out", f"{base}/good",
+                                      chunk_size=64*1024,
+                                      use_mmap=use_mmap, probe=probe)
+        finally:
+            await runner.cleanup()
+
+    assert arun(run()) == len(data)
+    assert (tmp_path/"out").read_bytes() == data
+
+def test_probe(tmp_path):
+    from aurl.fetch import download_url
+
+    files = {"small": data[:2000], "empty": b"", "large": data}
+    requests = []
+    async def run():
+        @web.middleware
+        async def count(request, handler):
+            requests.append((request.method, request.path))
+            return await handler(request)
+        app = web.Application(middlewares=[count])
+        for name, v in files.items():
+            app.router.add_route("*", f"/{name}", ranged(v))
+        runner, base = await serve(app)
+        try:
+            for name in files:
+                await download_url(tmp_path/name, f"{base}/{name}",
+                                   chunk_size=64*1024)
+        finally:
+            await runner.cleanup()
+
+    arun(run())
+    for name, v in files.items():
+        assert (tmp_path/name).read_bytes() == v
+    # one round-trip for small files, and no HEAD requests
+    assert requests.count(("GET", "/small")) == 1
+    assert requests.count(("GET", "/empty")) == 1
+    assert requests.count(("GET", "/large")) > 1
+    assert all(m == "GET" for m, p in requests)
+
+def test_no_ranges(tmp_path):
+    # servers refusing ranges get a plain GET
+    from aurl.fetch import download_url
+
+    async def refuse(request: web.Request):
+        if "Range" in request.headers:
+            return web.Response(status=501)
+        return web.Response(body=data)
+    async def no_size(request: web.Request):
+        if "Range" in request.headers:
+            return web.Response(status=206, body=data[:1000])
+        return web.Response(body=data)
+
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/refuse", refuse)
+        app.router.add_route("*", "/no_size", no_size)
+        runner, base = await serve(app)
+        try:
+            for name in ["refuse", "no_size"]:
+                await download_url(tmp_path/name, f"{base}/{name}",
+                                   chunk_size=64*1024)
+        finally:
+            await runner.cleanup()
+
+    arun(run())
+    assert (tmp_path/"refuse").read_bytes() == data
+    assert (tmp_path/"no_size").read_bytes() == data
+
+def test_writer(tmp_path):
+    from aurl.writer import FileWriter, check_space
+    from aurl.exceptions import DownloadException
+
+    async def run():
+        with FileWriter(tmp_path/"out", len(data), batch_size=1000) as w:
+            parts = [(i, min(i+100000, len(data)))
+                     for i in range(0, len(data), 100000)]
+            async def put(start, end):
+                f = w.part(start)
+                for i in range(start, end, 777):
+                    await f.write(data[i:min(i+777, end)])
+                await f.flush()
+                assert f.written == end-start
+            await asyncio.gather(*[put(*p) for p in reversed(parts)])
+    arun(run())
+    assert (tmp_path/"out").read_bytes() == data
+
+    async def small():
+        # more chunks in one batch than pwritev accepts at once
+        with FileWriter(tmp_path/"small") as w:
+            f = w.part(0)
+            for i in range(0, 2000*1024, 1024):
+                await f.write(data[i:i+1024])
+            await f.flush()
+    arun(small())
+    assert (tmp_path/"small").read_bytes() == data[:2000*1024]
+
+    with pytest.raises(DownloadException):
+        check_space(tmp_path/"huge", 1<<62)
+
+def test_retry(tmp_path):
+    from aurl.fetch import download_url, RetryPolicy
+
+    good = ranged(data)
+    short = ranged(data, fail_after=5000)
+    calls : dict = {}
+    async def handler(request: web.Request):
+        # each range is first refused, then dropped part-way, then served
+        if request.method == "HEAD":
+            return await good(request)
+        n = calls[request.http_range.stop] = calls.get(request.http_range.stop, 0) + 1
+        if n == 1:
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        if n == 2:
+            return await short(request)
+        return await good(request)
+
+    retry = RetryPolicy(backoff=0.01)
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/flaky", handler)
+        runner, base = await serve(app)
+        try:
+            return await download_url(tmp_path/"out", f"{base}/flaky",
+                                      chunk_size=64*1024, retry=retry)
+        finally:
+            await runner.cleanup()
+
+    assert arun(run()) == len(data)
+    assert (tmp_path/"out").read_bytes() == data
+    assert retry.stats.retries > 0 and retry.stats.failures == 0
+    assert retry.stats.reasons["status 503"] > 0
+
+def test_range_failure(tmp_path):
+    # a failing range is not retried by restarting the whole file
+    from aurl.fetch import download_url, RetryPolicy
+    from aurl.exceptions import DownloadException
+
+    good = ranged(data)
+    gets = []
+    async def handler(request: web.Request):
+        gets.append(request.http_range.start)
+        if request.http_range.start == 0:
+            return await good(request)
+        return web.Response(status=503, headers={"Retry-After": "0"})
+
+    retry = RetryPolicy(attempts=2, backoff=0.01)
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/bad", handler)
+        runner, base = await serve(app)
+        try:
+            with pytest.raises(DownloadException):
+                await download_url(tmp_path/"out", f"{base}/bad",
+                                   chunk_size=64*1024, retry=retry)
+        finally:
+            await runner.cleanup()
+
+    arun(run())
+    assert gets.count(0) == 1
+    assert len(gets) <= 1 + 3*2 # each of 3 ranges tried at most twice
+
+def test_slow_progress(tmp_path):
+    # every response is cut short, but each attempt advances
+    from aurl.fetch import download_url, RetryPolicy
+
+    retry = RetryPolicy(attempts=2, backoff=0.01)
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/slow", ranged(data, fail_after=200000))
+        runner, base = await serve(app)
+        try:
+            return await download_url(tmp_path/"out", f"{base}/slow",
+                                      chunk_size=64*1024, retry=retry)
+        finally:
+            await runner.cleanup()
+
+    assert arun(run()) == len(data)
+    assert (tmp_path/"out").read_bytes() == data
+    assert retry.stats.failures == 0
+
+def test_unreachable(tmp_path):
+    import socket
+    from aurl.mirror import Mirror
+    from aurl.fetch import RetryPolicy
+    from aurl.exceptions import DownloadException
+
+    with socket.socket() as sock: # a port nothing listens on
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    retry = RetryPolicy(attempts=3, backoff=0.01)
+    M = Mirror(tmp_path, retry=retry)
+    bad = URL(f"http://127.0.0.1:{port}/x")
+    bad_x = URL(f"http://127.0.0.1:{port}/x.tar.gz#extract")
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/good", ranged(data[:1000]))
+        runner, base = await serve(app)
+        good = URL(f"{base}/good")
+        try:
+            with pytest.raises(DownloadException) as e:
+                await M.fetch_all([bad, bad_x, good])
+            return good, str(e.value)
+        finally:
+            await runner.cleanup()
+
+    good, err = arun(run())
+    assert bad.s in err and bad_x.s in err and good.s not in err
+    assert M.encode(good).read_bytes() == data[:1000] # siblings finish
+    assert retry.stats.retries == 4 and retry.stats.failures == 2
+
+def test_progress(tmp_path):
+    from aurl.mirror import Mirror
+    from aurl.progress import Progress, status_line
+    from aurl.fetch import RetryPolicy
+    from aurl.exceptions import DownloadException
+
+    events = []
+    progress = Progress()
+    progress.subscribe(events.append)
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/good", ranged(data))
+        app.router.add_route("*", "/gone", unavailable)
+        runner, base = await serve(app)
+        try:
+            M = Mirror(tmp_path, progress=progress,
+                       retry=RetryPolicy(attempts=1))
+            await M.fetch(URL(f"{base}/good"))
+            with pytest.raises(DownloadException):
+                await M.fetch(URL(f"{base}/gone"))
+        finally:
+            await runner.cleanup()
+
+    arun(run())
+    kinds = [e["event"] for e in events]
+    assert kinds == ["start", "done", "start", "error"]
+    assert events[1]["bytes"] == len(data)
+    ev = progress.sample()
+    assert ev["bytes_done"] == ev["bytes_total"] == len(data)
+    assert ev["files_done"] == 1 and ev["files_failed"] == 1
+    assert ev["files_active"] == 0
+    assert "1 done" in status_line(ev)
+
+def test_plan(tmp_path):
+    from aurl.mirror import Mirror
+    from aurl.plan import make_plan, record_throughput
+
+    async def no_head(request: web.Request):
+        if request.method == "HEAD":
+            return web.Response(status=405)
+        return await ranged(data[:1000])(request)
+
+    M = Mirror(tmp_path)
+    cached = URL("https://example.invalid/cached.txt")
+    M.encode(cached).parent.mkdir(parents=True)
+    M.encode(cached).write_bytes(b"x"*10)
+
+    async def run():
+        app = web.Application()
+        app.router.add_route("*", "/good", ranged(data))
+        app.router.add_route("*", "/nohead", no_head)
+        app.router.add_route("*", "/gone", unavailable)
+        runner, base = await serve(app)
+        try:
+            record_throughput(M, URL(f"{base}/x"), len(data), 2.0)
+            urls = [URL(f"{base}/good"), URL(f"{base}/nohead"),
+                    URL(f"{base}/gone"), cached,
+                    URL("git+https://example.invalid/a/b"),
+                    URL("file:///nonexistent/file")]
+            return base, await make_plan(M, urls)
+        finally:
+            await runner.cleanup()
+
+    base, plan = arun(run())
+    ans = plan.summary()
+    assert (ans["cached"], ans["missing"], ans["unavailable"]) == (1, 3, 2)
+    assert ans["bytes_cached"] == 10
+    assert ans["bytes_missing"] == len(data) + 1000
+    assert ans["unknown_size"] == 1
+    h = ans["hosts"][base]
+    assert h["missing"] == 2 and h["seconds"] == round((len(data)+1000)/(len(data)/2), 1)
+    assert ans["seconds"] is None # no rate for the git host
+    assert plan.summary(rate=1e9)["seconds"] == h["seconds"]
+    assert f"{base}/gone" in ans["unavailable_urls"]
+    assert [e.url for e in M.scan()] == [cached] # nothing was downloaded
+
+def test_stream_list(tmp_path):
+    import json
+    from aurl.mirror import Mirror
+    from aurl.serve import walk_dir
+    from aurl.get_dir import stream_list, fetch_listed
+    from aurl.fetch import RetryPolicy
+
+    root = tmp_path/"served"
+    files = ["a/x", "a/b/y", "a0", "c/d/e/z"]
+    for rel in files + [".hidden/w"]:
+        (root/rel).parent.mkdir(parents=True, exist_ok=True)
+        (root/rel).write_bytes(rel.encode())
+    pages = []
+
+    async def handler(request: web.Request):
+        # an ndjson listing with 2-record pages, dropping
+        # the connection after the first record of each page
+        p = root/request.match_info["path"]
+        if p.is_file():
+            return web.Response(body=p.read_bytes())
+        q = request.query
+        pages.append(q.get("after", ""))
+        recs = list(walk_dir(p, int(q["max_depth"]), q.get("after", ""),
+                             q["hidden"] == "true"))
+        resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(request)
+        for r in recs[:2]:
+            await resp.write(json.dumps(r).encode() + b"\n")
+            if len(pages) % 2 == 1:
+                request.transport.close() # type: ignore[union-attr]
+                return resp
+        if len(recs) > 2:
+            await resp.write(json.dumps({"cursor": recs[1]["path"]}).encode() + b"\n")
+        return resp
+
+    (tmp_path/"mirror").mkdir()
+    M = Mirror(tmp_path/"mirror", retry=RetryPolicy(backoff=0.01))
+    async def run():
+        app = web.Application()
+        app.router.add_route("GET", "/{path:.*}", handler)
+        runner, base = await serve(app)
+        try:
+            urls = stream_list(f"{base}/", M, max_depth=1)
+            return base, await fetch_listed(M, urls, window=2)
+        finally:
+            await runner.cleanup()
+
+    base, paths = arun(run())
+    assert set(paths) == set(URL(f"{base}/{rel}") for rel in files)
+    for rel in files:
+        assert paths[URL(f"{base}/{rel}")].read_bytes() == rel.encode()
+    assert pages[:4] == ["", "a", "a/x", "a0"] # resumed after each drop
+
+def test_stream_list_errors(tmp_path):
+    import json
+    import socket
+    from aurl.mirror import Mirror
+    from aurl.get_dir import stream_list, fetch_listed
+    from aurl.fetch import RetryPolicy, TransferError
+
+    calls = []
+    async def handler(request: web.Request):
+        # the first listing is cut off mid-line
+        calls.append(request.query.get("after", ""))
+        resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(request)
+        line = json.dumps({"path": "a", "type": "file", "size": 1}).encode()
+        if len(calls) == 1:
+            await resp.write(line[:7])
+            request.transport.close() # type: ignore[union-attr]
+            return resp
+        await resp.write(line + b"\n")
+        return resp
+
+    (tmp_path/"mirror").mkdir()
+    M = Mirror(tmp_path/"mirror", retry=RetryPolicy(backoff=0.01, attempts=2))
+    async def run():
+        app = web.Application()
+        app.router.add_route("GET", "/{path:.*}", handler)
+        runner, base = await serve(app)
+        try:
+            return base, [u async for u in stream_list(f"{base}/", M)]
+        finally:
+            await runner.cleanup()
+
+    base, urls = arun(run())
+    assert urls == [URL(f"{base}/a")]
+    assert calls == ["", ""]
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    async def unreachable():
+        return await fetch_listed(M, stream_list(f"http://127.0.0.1:{port}/", M))
+    with pytest.raises(TransferError):
+        arun(unreachable())
+
+def test_extract(tmp_path):
+    import io
+    import tarfile
+    import zipfile
+    from aurl.mirror import Mirror
+    from aurl.fetch import RetryPolicy
+    from aurl.exceptions import DownloadException
+
+    big = os.urandom(3*1024**2) # spans several chunks
+    tgz = io.BytesIO()
+    with tarfile.open(fileobj=tgz, mode="w:gz") as tar:
+        for name, data in [("pkg/big.bin", big), ("pkg/sub/a.txt", b"a")]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    zipped = io.BytesIO()
+    with zipfile.ZipFile(zipped, "w") as z:
+        z.writestr("z/b.txt", "b")
+    requests = []
+
+    async def handler(request: web.Request):
+        name = request.match_info["name"]
+        requests.append(name)
+        if name == "bad.tar.gz":
+            return web.Response(body=b"not an archive")
+        if name == "slow.tar.gz": # every response is cut short
+            return await ranged(tgz.getvalue(), 500000)(request)
+        payload = {"pkg.tar.gz": tgz.getvalue(), "pkg.zip": zipped.getvalue()}[name]
+        if requests.count(name) == 1: # drop the first response midway
+            return await ranged(payload, len(payload)//2)(request)
+        return await ranged(payload)(request)
+
+    M = Mirror(tmp_path, retry=RetryPolicy(attempts=2, backoff=0.01))
+    async def run():
+        app = web.Application()
+        app.router.add_route("GET", "/{name}", handler)
+        runner, base = await serve(app)
+        try:
+            tree = await M.fetch(URL(f"{base}/pkg.tar.gz#extract"))
+            zdir = await M.fetch(URL(f"{base}/pkg.zip#extract=keep"))
+            slow = await M.fetch(URL(f"{base}/slow.tar.gz#extract"))
+            assert (slow/"pkg"/"big.bin").read_bytes() == big
+            with pytest.raises(DownloadException):
+                await M.fetch(URL(f"{base}/bad.tar.gz#extract"))
+            return base, tree, zdir
+        finally:
+            await runner.cleanup()
+
+    base, tree, zdir = arun(run())
+    assert tree == M.encode(URL(f"{base}/pkg.tar.gz#extract")) and tree.is_dir()
+    assert (tree/"pkg"/"big.bin").read_bytes() == big
+    assert (tree/"pkg"/"sub"/"a.txt").read_bytes() == b"a"
+    assert not M.encode(URL(f"{base}/pkg.tar.gz")).exists() # dropped
+    assert requests.count("pkg.tar.gz") == 2 # resumed once
+    assert (zdir/"z"/"b.txt").read_text() == "b"
+    assert M.encode(URL(f"{base}/pkg.zip")).read_bytes() == zipped.getvalue()
+    assert not M.encode(URL(f"{base}/bad.tar.gz#extract")).exists()
+    assert list((M.state/"tmp").iterdir()) == []
+
+def test_runcmd_stream():
+    import sys
+    from aurl.runcmd import runcmd_stream
+    lines = []
+    prog = ("import sys\n"
+            "for i in range(3): sys.stderr.write(f'step {i}\\r')\n"
+            "sys.stderr.write('done\\nfailing')\n"
+            "sys.exit(3)")
+    ret, err = arun(runcmd_stream(sys.executable, "-c", prog,
+                                  on_line=lines.append, keep=2))
+    assert ret == 3 and lines == ["step 0", "step 1", "step 2", "done"]
+    assert err == "done\nfailing"
+
+    with pytest.raises(asyncio.TimeoutError):
+        arun(runcmd_stream(sys.executable, "-c", "import time; time.sleep(30)",
+                           stall=0.2))
+
+def test_git_clone(tmp_path):
+    import subprocess
+    from aurl.mirror import Mirror
+    from aurl.fetch import git_received
+    from aurl.progress import Progress
+    from aurl.exceptions import DownloadException
+
+    assert git_received("Receiving objects:  45% (450/1000), 1.50 MiB | 2.00 MiB/s") \
+            == int(1.5*1024**2)
+    assert git_received("Resolving deltas: 100% (3/3), done.") is None
+
+    repo = tmp_path/"repo"
+    repo.mkdir()
+    (repo/"README.md").write_text("readme")
+    git = ["git", "-C", str(repo), "-c", "user.name=t", "-c", "user.email=t@t"]
+    subprocess.run(git + ["init", "-q"], check=True)
+    subprocess.run(git + ["add", "README.md"], check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "init"], check=True)
+
+    (tmp_path/"mirror").mkdir()
+    M = Mirror(tmp_path/"mirror", nparallel=1, nsubprocess=1, progress=Progress())
+    url = URL(f"git+file://{repo}")
+    missing = URL(f"git+file://{tmp_path}/missing")
+    assert M.slots(url) is M.sq and M.slots(URL("https://x.org/y")) is M.cq
+    async def run():
+        from aurl.taskmgr import ResourceContext
+        async with ResourceContext(M.cq): # http slots are all taken
+            out = await M.fetch(url)
+            with pytest.raises(DownloadException):
+                await M.fetch(missing)
+            return out
+    out = arun(run())
+    assert (out/"README.md").read_text() == "readme"
+    assert not M.encode(missing).exists()
+    assert M.progress is not None and M.progress.files_done == 1
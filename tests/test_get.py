@@ -27,3 +27,29 @@ def test_get_file(tmp_path):
     assert result.exit_code == 0
     ret = json.loads(result.stdout)
     assert len(ret) == 2
+
+def test_get_stream(tmp_path):
+    (tmp_path/"mirror").mkdir()
+    names = [f"f{i}" for i in range(20)]
+    for n in names:
+        (tmp_path/n).write_text(n)
+    lines = [f"file://{tmp_path}/{n}" for n in names]
+    (tmp_path/"urls.txt").write_text("\n".join(lines[:10]) + "\n\n")
+    result = runner.invoke(get, ["--mirror", str(tmp_path/"mirror"),
+                                 "-i", str(tmp_path/"urls.txt")])
+    assert result.exit_code == 0
+    recs = [json.loads(l) for l in result.stdout.splitlines()]
+    assert sorted(r["url"] for r in recs) == sorted(lines[:10])
+
+    stdin = "\n".join(lines[10:] + [f"file://{tmp_path}/missing", "bogus://x"])
+    result = runner.invoke(get, ["--mirror", str(tmp_path/"mirror"), "-i", "-"],
+                           input=stdin)
+    assert result.exit_code == 1
+    recs = dict((r["url"], r) for r in map(json.loads, result.stdout.splitlines()))
+    assert len(recs) == 12
+    assert recs[lines[15]]["path"] == str(tmp_path/"f15")
+    assert "error" in recs[f"file://{tmp_path}/missing"] and "error" in recs["bogus://x"]
+
+    result = runner.invoke(get, ["--mirror", str(tmp_path/"mirror"), "--coop", "job",
+                                 "-i", str(tmp_path/"urls.txt")])
+    assert result.exit_code == 2 # not a cooperative fetch
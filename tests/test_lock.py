@@ -0,0 +1,154 @@
+from pathlib import Path
+import asyncio
+import multiprocessing
+import os
+import socket
+import time
+
+import pytest # type: ignore[import]
+from aiohttp import web
+
+from aurl.lock import LockFile
+from aurl.mirror import Mirror
+from aurl.urls import URL
+
+from .conftest import arun
+
+def test_stale_lock(tmp_path):
+    path = tmp_path / "x.lock"
+
+    async def run():
+        # an expired lease is broken
+        path.write_text("otherhost 1 abc")
+        old = time.time() - 100
+        os.utime(path, (old, old))
+        async with LockFile(path, lease=10, poll=0.01) as lk:
+            assert path.read_text() == lk.token
+        assert not path.exists()
+
+        # so is a lock held by a dead process on this host
+        p = multiprocessing.Process(target=int)
+        p.start()
+        p.join()
+        path.write_text(f"{socket.gethostname()} {p.pid} abc")
+        async with LockFile(path, lease=10, poll=0.01):
+            pass
+
+        # but not a live one
+        path.write_text(f"{socket.gethostname()} {os.getpid()} abc")
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(LockFile(path, poll=0.01).acquire(), 0.2)
+
+        # a lock re-taken after it was seen to be stale is left alone
+        path.write_text("otherhost 1 abc")
+        os.utime(path, (old, old))
+        a, b = LockFile(path, lease=10), LockFile(path, lease=10)
+        seen = a.stale()
+        assert seen is not None
+        assert b.claim()
+        assert not a.break_stale(seen)
+        assert path.read_text() == b.token
+        assert a.observe(path / "x") is None # stat fails (ENOTDIR)
+        await b.release()
+        assert list(tmp_path.iterdir()) == []
+    arun(run())
+
+def fetch_one(base: str, url: str):
+    M = Mirror(base, lease=5)
+    p = arun(M.fetch(URL(url)))
+    assert p is not None
+    return p.read_bytes()
+
+def test_shared_download(tmp_path, http_server):
+    # Several processes fetching one URL download it only once.
+    payload = os.urandom(100000)
+    hits = []
+
+    async def handler(request: web.Request):
+        # ignores Range, so each download is a single request
+        hits.append(request.method)
+        await asyncio.sleep(0.5)
+        if request.method == "HEAD":
+            return web.Response(headers={"Content-Length": str(len(payload))})
+        return web.Response(body=payload)
+
+    app = web.Application()
+    app.router.add_route("*", "/{path:.*}", handler)
+    url = http_server(app) + "/data.bin"
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(4) as pool:
+        ans = pool.starmap(fetch_one, [(str(tmp_path), url)]*4)
+    assert all(a == payload for a in ans)
+    assert len(hits) == 1
+    assert list((tmp_path/".aurl"/"locks").iterdir()) == []
+    assert list((tmp_path/".aurl"/"tmp").iterdir()) == []
+
+def cooperate_one(base: str, urls):
+    from aurl.coop import WorkQueue
+    from aurl.exceptions import DownloadException
+    M = Mirror(base, lease=5)
+    q = WorkQueue(M, "job", poll=0.05)
+    try:
+        arun(q.run([URL(u) for u in urls]))
+        err = None
+    except DownloadException as e:
+        err = str(e)
+    return q.claimed, err
+
+def test_cooperate(tmp_path, http_server):
+    # Processes sharing a queue split the downloads between them.
+    hits = []
+
+    async def handler(request: web.Request):
+        name = request.match_info["path"]
+        hits.append(name)
+        await asyncio.sleep(0.3)
+        if name == "missing":
+            return web.Response(status=404)
+        return web.Response(body=name.encode())
+
+    app = web.Application()
+    app.router.add_route("GET", "/{path:.*}", handler)
+    base = http_server(app)
+    urls = [f"{base}/f{i}" for i in range(40)]
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(3) as pool:
+        ans = pool.starmap(cooperate_one,
+                           [(str(tmp_path), urls),
+                            (str(tmp_path), urls[:20]),
+                            (str(tmp_path), urls[20:] + [f"{base}/missing"])])
+    assert sorted(hits) == sorted([f"f{i}" for i in range(40)] + ["missing"])
+    M = Mirror(tmp_path)
+    for u in urls:
+        assert M.encode(URL(u)).read_bytes() == u.rsplit("/", 1)[1].encode()
+    assert sum(c for c, e in ans) == 40
+    assert sum(c > 0 for c, e in ans) > 1 # the work was shared
+    assert ans[0][1] is None and ans[1][1] is None
+    assert "missing" in ans[2][1]
+    assert not (tmp_path/".aurl"/"queues"/"job").exists()
+    assert list((tmp_path/".aurl"/"locks").iterdir()) == []
+
+def test_queue_state(tmp_path, monkeypatch):
+    import aurl.coop as coop
+    M = Mirror(tmp_path, lease=5)
+    url = URL("https://example.invalid/x")
+    a, b = coop.WorkQueue(M, "job"), coop.WorkQueue(M, "job")
+    a.publish([url])
+    b.publish([url])
+    a.mark_failed(url, "boom")
+    assert b.failure(url) == "boom"
+
+    # failures are forgotten once their participant
+    # has left (or died) and failed_ttl has passed
+    monkeypatch.setattr(coop, "failed_ttl", 0.0)
+    assert b.failure(url) == "boom" # a is live
+    old = time.time() - 100
+    os.utime(a.mine, (old, old))
+    assert b.failure(url) is None
+
+    # the queue is removed by the last one out
+    os.utime(a.mine)
+    b.withdraw()
+    assert a.path.exists()
+    a.withdraw()
+    assert list((M.state/"queues").iterdir()) == []
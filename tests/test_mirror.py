@@ -0,0 +1,181 @@
+from pathlib import Path
+import json
+import os
+
+import pytest # type: ignore[import]
+from typer.testing import CliRunner
+
+from aurl.mirror import Mirror
+from aurl.urls import URL
+from aurl.cli import app
+
+runner = CliRunner()
+
+def make_mirror(base: Path) -> Mirror:
+    M = Mirror(base)
+    for u in ["https://www.example.com/index.html",
+              "https://www.example.com/a/b/c.txt",
+              "http://nevada/user?tango=alpha"]:
+        p = M.encode(URL(u))
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text(u)
+    clone = M.encode(URL("git+https://github.com/frobnitzem/aurl"))
+    (clone / ".git").mkdir(parents=True)
+    (clone / "README.md").write_text("readme")
+    tree = M.encode(URL("https://h.org/src/pkg.tar.gz#extract"))
+    (tree / "pkg" / "lib").mkdir(parents=True)
+    (tree / "pkg" / "a.txt").write_text("a")
+    (base / ".aurl").mkdir()
+    (base / ".aurl" / "internal").write_text("not an entry")
+    return M
+
+def test_scan(tmp_path):
+    M = make_mirror(tmp_path)
+    found = dict((e.url.s, e) for e in M.scan(sizes=True, nthreads=3))
+    assert set(found) == {
+              "https://www.example.com/index.html",
+              "https://www.example.com/a/b/c.txt",
+              "http://nevada/user?tango=alpha",
+              "git+https://github.com/frobnitzem/aurl",
+              "https://h.org/src/pkg.tar.gz#extract"}
+    e = found["https://www.example.com/a/b/c.txt"]
+    assert e.size == len(e.url.s)
+    assert e.path == M.encode(e.url)
+
+def test_encode_decode_many(tmp_path):
+    M = Mirror(tmp_path)
+    urls = [URL("https://www.example.com/index.html"),
+            URL("http://nevada/user?tango=alpha"),
+            URL("git+https://github.com/frobnitzem/aurl")]
+    paths = M.encode_many(urls)
+    assert paths == [M.encode(u) for u in urls]
+    assert M.decode_many(paths) == urls
+    assert M.decode_many([tmp_path, "/elsewhere/https/x"]) == [None, None]
+
+def test_ls(tmp_path):
+    make_mirror(tmp_path)
+    result = runner.invoke(app, ["ls", "--mirror", str(tmp_path), "--ndjson"])
+    assert result.exit_code == 0
+    lines = [json.loads(l) for l in result.stdout.splitlines()]
+    assert len(lines) == 5
+
+    result = runner.invoke(app, ["ls", "--mirror", str(tmp_path), "--summary"])
+    assert result.exit_code == 0
+    ans = json.loads(result.stdout)
+    assert ans["entries"] == 5
+    assert ans["hosts"]["https://www.example.com"]["entries"] == 2
+
+def test_bundle(tmp_path):
+    (tmp_path/"src").mkdir()
+    (tmp_path/"dst").mkdir()
+    M = make_mirror(tmp_path/"src")
+    clone = URL("git+https://github.com/frobnitzem/aurl")
+    (M.encode(clone)/"link").symlink_to("README.md")
+    urls = [e.url for e in M.scan()]
+
+    bundle = tmp_path/"seed.tar"
+    result = runner.invoke(app, ["export", "--mirror", str(M.base),
+                                 "-o", str(bundle)])
+    assert result.exit_code == 0
+    records = dict((r["url"], r) for r in M.manifest(urls))
+    assert records[clone.s]["type"] == "dir"
+    assert records[urls[0].s]["sha256"] is not None
+
+    D = Mirror(tmp_path/"dst")
+    pre = URL("https://www.example.com/index.html")
+    D.encode(pre).parent.mkdir(parents=True)
+    D.encode(pre).write_text(pre.s)
+
+    result = runner.invoke(app, ["import", str(bundle), "--mirror", str(D.base)])
+    assert result.exit_code == 0
+    status = json.loads(result.stdout)
+    assert status.pop(pre.s) == "present"
+    assert set(status.values()) == {"imported"}
+    assert dict((r["url"], r) for r in D.manifest(urls)) == records
+    assert os.readlink(D.encode(clone)/"link") == "README.md"
+    assert list((D.state/"tmp").iterdir()) == []
+
+    # a corrupted entry is not imported
+    data = bundle.read_bytes()
+    i = data.index(b"https://www.example.com/a/b/c.txt", 1024)
+    bundle.write_bytes(data[:i] + b"X" + data[i+1:])
+    (tmp_path/"dst2").mkdir()
+    E = Mirror(tmp_path/"dst2")
+    result = runner.invoke(app, ["import", str(bundle), "--mirror", str(E.base)])
+    assert result.exit_code == 1
+    assert "digest mismatch" in result.output
+    assert not E.encode(URL("https://www.example.com/a/b/c.txt")).exists()
+    assert E.encode(pre).exists()
+
+def test_import_off_loop(tmp_path):
+    # importing a (slowly read) bundle leaves the event loop free
+    import asyncio
+    import io
+    import time
+    (tmp_path/"src").mkdir()
+    (tmp_path/"dst").mkdir()
+    M = make_mirror(tmp_path/"src")
+    buf = io.BytesIO()
+    M.export_bundle([e.url for e in M.scan()], buf)
+
+    class Slow(io.BytesIO):
+        def read(self, n=-1): # type: ignore[override]
+            time.sleep(0.01)
+            return super().read(n)
+
+    D = Mirror(tmp_path/"dst")
+    ticks = 0
+    async def run():
+        nonlocal ticks
+        task = asyncio.create_task(D.import_bundle(Slow(buf.getvalue())))
+        while not task.done():
+            ticks += 1
+            await asyncio.sleep(0.005)
+        return await task
+
+    status = asyncio.run(run())
+    assert set(status.values()) == {"imported"}
+    assert ticks > 5
+
+def test_fetch_each(tmp_path):
+    import asyncio
+    from aurl.exceptions import DownloadException
+    M = Mirror(tmp_path)
+    read = 0
+    active = 0
+    peak = 0
+
+    async def fetch(url):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.001 * (hash(url) % 5))
+        active -= 1
+        if url.path.endswith("7"):
+            raise DownloadException("unlucky")
+        return Path(url.path)
+    M.fetch = fetch # type: ignore[method-assign]
+
+    async def urls():
+        nonlocal read
+        for i in range(200):
+            read += 1
+            assert read - done <= 8 + 1 # never reads far ahead
+            yield URL(f"https://example.org/{i}")
+
+    done = 0
+    async def run():
+        nonlocal done
+        ans = {}
+        async for url, path, err in M.fetch_each(urls(), window=8):
+            done += 1
+            ans[url] = (path, err)
+        return ans
+    loop = asyncio.new_event_loop()
+    try:
+        ans = loop.run_until_complete(run())
+    finally:
+        loop.close()
+    assert len(ans) == 200 and peak <= 8
+    assert ans[URL("https://example.org/17")] == (None, "unlucky")
+    assert ans[URL("https://example.org/18")] == (Path("18"), None)
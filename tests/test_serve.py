@@ -31,3 +31,162 @@ def test_safe_path(tmp_path: Path):
         except HTTPException as e:
             print(f"Unsafe path {fname}: {e}")
             assert not ok
+
+def test_byte_range():
+    import pytest # type: ignore[import]
+    from aurl.serve import byte_range
+    assert byte_range(None, 10) is None
+    assert byte_range("bytes=0-1,4-5", 10) is None
+    assert byte_range("bytes=2-4", 10) == (2, 5)
+    assert byte_range("bytes=2-", 10) == (2, 10)
+    assert byte_range("bytes=5-100", 10) == (5, 10)
+    assert byte_range("bytes=-3", 10) == (7, 10)
+    for bad in ["bytes=10-", "bytes=4-2", "bytes=x-"]:
+        with pytest.raises(ValueError):
+            byte_range(bad, 10)
+
+def asgi_get(app, path, headers={}):
+    # Minimal ASGI client: returns (status, headers, body).
+    import asyncio
+    path, _, query = path.partition("?")
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"},
+             "http_version": "1.1",
+             "method": "GET", "scheme": "http", "path": path,
+             "raw_path": path.encode(), "root_path": "", "query_string": query.encode(),
+             "headers": [(k.lower().encode(), v.encode())
+                         for k, v in headers.items()],
+             "client": ("127.0.0.1", 1), "server": ("127.0.0.1", 80)}
+    sent = []
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+    async def send(msg):
+        sent.append(msg)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(app(scope, receive, send))
+    finally:
+        loop.close()
+    start = sent[0]
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return start["status"], dict((k.decode(), v.decode())
+                                 for k, v in start["headers"]), body
+
+def test_serve_cache(tmp_path: Path, monkeypatch):
+    import os
+    import aurl.serve as serve
+    monkeypatch.setattr(serve, "file_root", tmp_path)
+    monkeypatch.setattr(serve, "stat_cache", serve.StatCache(ttl=0))
+    monkeypatch.setattr(serve, "hot_files", serve.HotFiles(max_file=1000))
+    monkeypatch.setattr(serve, "read_size", 1000)
+    small = os.urandom(500)
+    large = os.urandom(10000)
+    (tmp_path/"small").write_bytes(small)
+    (tmp_path/"large").write_bytes(large)
+
+    assert asgi_get(serve.app, "/small")[2] == small
+    assert asgi_get(serve.app, "/small")[2] == small
+    assert serve.hot_files.hits == 1 and serve.hot_files.misses == 1
+
+    status, hdr, body = asgi_get(serve.app, "/small", {"Range": "bytes=10-19"})
+    assert status == 206 and body == small[10:20]
+    assert hdr["content-range"] == "bytes 10-19/500"
+
+    (tmp_path/"small").write_bytes(small[:100]) # changed file is re-read
+    assert asgi_get(serve.app, "/small")[2] == small[:100]
+    assert serve.hot_files.misses == 2 and serve.hot_files.nbytes == 100
+
+    status, hdr, body = asgi_get(serve.app, "/large", {"Range": "bytes=1500-8499"})
+    assert status == 206 and body == large[1500:8500]
+    assert asgi_get(serve.app, "/large")[2] == large
+    assert asgi_get(serve.app, "/large", {"Range": "bytes=20000-"})[0] == 416
+    assert asgi_get(serve.app, "/missing")[0] == 404
+    assert serve.hot_files.nbytes == 100
+    assert serve.limits.active == 0
+
+def test_serve_stale_stat(tmp_path: Path, monkeypatch):
+    # files changed while their stat is cached are sized as opened
+    import os
+    import aurl.serve as serve
+    monkeypatch.setattr(serve, "file_root", tmp_path)
+    monkeypatch.setattr(serve, "stat_cache", serve.StatCache(ttl=3600))
+    monkeypatch.setattr(serve, "hot_files", serve.HotFiles(max_file=1000))
+    monkeypatch.setattr(serve, "read_size", 1000)
+    small = os.urandom(500)
+    large = os.urandom(10000)
+    (tmp_path/"small").write_bytes(small)
+    (tmp_path/"large").write_bytes(large)
+    assert asgi_get(serve.app, "/small")[2] == small
+    assert asgi_get(serve.app, "/large")[2] == large
+
+    (tmp_path/"small").write_bytes(small[:100])
+    (tmp_path/"large").write_bytes(large[:5000])
+    for name, data in [("small", small[:100]), ("large", large[:5000])]:
+        status, hdr, body = asgi_get(serve.app, "/"+name)
+        assert status == 200 and body == data
+        assert hdr["content-length"] == str(len(data))
+        status, hdr, body = asgi_get(serve.app, "/"+name, {"Range": "bytes=50-"})
+        assert status == 206 and body == data[50:]
+        assert hdr["content-range"] == f"bytes 50-{len(data)-1}/{len(data)}"
+    assert serve.limits.active == 0
+
+def test_serve_limits(tmp_path: Path, monkeypatch):
+    import json
+    import aurl.serve as serve
+    monkeypatch.setattr(serve, "file_root", tmp_path)
+    monkeypatch.setattr(serve, "hot_files", serve.HotFiles())
+    limits = serve.Limits(total=2, per_client=1, retry_after=3)
+    monkeypatch.setattr(serve, "limits", limits)
+    (tmp_path/"sub").mkdir()
+    (tmp_path/"sub"/"f").write_bytes(b"x"*100)
+
+    assert limits.acquire("127.0.0.1") is None
+    status, hdr, body = asgi_get(serve.app, "/sub/f")
+    assert status == 429 and hdr["retry-after"] == "3"
+    limits.release("127.0.0.1")
+
+    assert limits.acquire("10.0.0.1") is None
+    assert limits.acquire("10.0.0.2") is None
+    assert asgi_get(serve.app, "/sub/f")[0] == 503
+    limits.release("10.0.0.2")
+
+    status, hdr, body = asgi_get(serve.app, "/sub/f")
+    assert status == 200 and body == b"x"*100
+    assert limits.active == 1 and limits.clients == {"10.0.0.1": 1}
+    assert serve.hot_files.entries # cached files take slots too
+
+    status, hdr, body = asgi_get(serve.app, "/sub")
+    assert status == 200 and json.loads(body)["f"]["size"] == 100
+    assert limits.listing == 0
+
+def test_walk_dir(tmp_path: Path, monkeypatch):
+    import json
+    import aurl.serve as serve
+    from aurl.serve import walk_dir
+    for rel in ["a/x", "a/b/y", "a0", "c/d/e/z", ".hidden/w"]:
+        (tmp_path/rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path/rel).write_bytes(b"1"*len(rel))
+
+    paths = [r["path"] for r in walk_dir(tmp_path, hidden=False)]
+    assert paths == ["a", "a/b", "a/b/y", "a/x", "a0",
+                     "c", "c/d", "c/d/e", "c/d/e/z"]
+    recs = list(walk_dir(tmp_path, max_depth=1, hidden=False))
+    assert [r["path"] for r in recs] == ["a", "a/b", "a/x", "a0", "c", "c/d"]
+    assert recs[1]["more"] and "more" not in recs[0]
+    assert recs[2] == {"path": "a/x", "size": 3, "atime": recs[2]["atime"],
+                       "mtime": recs[2]["mtime"]}
+    assert ".hidden/w" in [r["path"] for r in walk_dir(tmp_path)]
+    # resuming after a path
+    assert [r["path"] for r in walk_dir(tmp_path, after="a/b", hidden=False)] \
+            == paths[2:]
+    assert [r["path"] for r in walk_dir(tmp_path, after="a/x", hidden=False)] \
+            == paths[4:]
+
+    monkeypatch.setattr(serve, "file_root", tmp_path)
+    status, hdr, body = asgi_get(serve.app, "/?format=ndjson&limit=4&hidden=false")
+    assert status == 200 and hdr["content-type"] == "application/x-ndjson"
+    lines = [json.loads(l) for l in body.splitlines()]
+    assert [r["path"] for r in lines[:4]] == paths[:4]
+    assert lines[4] == {"cursor": "a/x"}
+    status, hdr, body = asgi_get(serve.app, "/?format=ndjson&after=a/x&hidden=false")
+    assert [json.loads(l)["path"] for l in body.splitlines()] == paths[4:]
+    assert serve.limits.active == 0
@@ -48,3 +48,80 @@ def test_subst(tmp_path):
     assert out == ans.format(mirror = str(tmp_path / "mirror"))
     out = (tmp_path / "template.txt1").read_text()
     assert out == ans.format(mirror = str(tmp_path / "mirror"))
+
+def test_subst_incremental(tmp_path):
+    (tmp_path/"mirror").mkdir()
+    (tmp_path/"data").write_text("v1")
+    tpl_file = tmp_path/"local.txt.tpl"
+    tpl_file.write_text("data = ${{ file://%s/data }}\n" % tmp_path)
+    args = ["--mirror", str(tmp_path/"mirror"), str(tpl_file)]
+    out = tmp_path/"local.txt"
+
+    result = runner.invoke(subst, args)
+    assert result.exit_code == 0
+    assert out.read_text() == "data = %s/data\n" % tmp_path
+    assert (tmp_path/".local.txt.deps.json").exists()
+    mtime = out.stat().st_mtime_ns
+
+    # unchanged inputs leave the output alone
+    result = runner.invoke(subst, args)
+    assert result.exit_code == 0
+    assert out.stat().st_mtime_ns == mtime
+
+    # a changed template is re-rendered
+    tpl_file.write_text("data := ${{ file://%s/data }}\n" % tmp_path)
+    result = runner.invoke(subst, args)
+    assert result.exit_code == 0
+    assert out.read_text() == "data := %s/data\n" % tmp_path
+
+def test_alternates():
+    from aurl.template import Template
+    from aurl.urls import URL
+    t = Template("x = ${{ https://a.org/x.h5  https://b.org/x.h5 }}\n"
+                 "y = ${{ https://a.org/x.h5 }}")
+    assert t.uris == [URL("https://a.org/x.h5")]*2
+    assert t.alternates == {URL("https://a.org/x.h5"):
+                                [URL("https://b.org/x.h5")]}
+
+def test_recursive(tmp_path):
+    (tmp_path/"mirror").mkdir()
+    (tmp_path/"data").write_text("v1")
+    (tmp_path/"b.conf.tpl").write_text("data = ${{ file://%s/data }}\n" % tmp_path)
+    (tmp_path/"a.conf.tpl").write_text("b = ${{ file://%s/b.conf.tpl }}\n"
+                                       "data = ${{ file://%s/data }}\n"
+                                       % (tmp_path, tmp_path))
+    top = tmp_path/"top.txt.in"
+    top.write_text("a = ${{ file://%s/a.conf.tpl }}\n" % tmp_path)
+    args = ["--mirror", str(tmp_path/"mirror"), "--recursive", str(top)]
+
+    result = runner.invoke(subst, args)
+    assert result.exit_code == 0
+    a = Path((tmp_path/"top.txt").read_text().split(" = ")[1].strip())
+    assert a.name == "a.conf" and ".aurl" in a.parts
+    b = Path(a.read_text().splitlines()[0].split(" = ")[1])
+    assert b.name == "b.conf"
+    assert b.read_text() == "data = %s/data\n" % tmp_path
+
+    # up-to-date on a second run
+    mtime = (tmp_path/"top.txt").stat().st_mtime_ns
+    result = runner.invoke(subst, args)
+    assert result.exit_code == 0
+    assert (tmp_path/"top.txt").stat().st_mtime_ns == mtime
+
+    # an edit to a nested template reaches the output
+    (tmp_path/"b.conf.tpl").write_text("data := ${{ file://%s/data }}\n" % tmp_path)
+    result = runner.invoke(subst, args)
+    assert result.exit_code == 0
+    assert b.read_text() == "data := %s/data\n" % tmp_path
+    mtime = (tmp_path/"top.txt").stat().st_mtime_ns
+    result = runner.invoke(subst, args)
+    assert result.exit_code == 0
+    assert (tmp_path/"top.txt").stat().st_mtime_ns == mtime
+
+    # cycles are reported
+    (tmp_path/"c.tpl").write_text("d = ${{ file://%s/d.tpl }}\n" % tmp_path)
+    (tmp_path/"d.tpl").write_text("c = ${{ file://%s/c.tpl }}\n" % tmp_path)
+    top.write_text("c = ${{ file://%s/c.tpl }}\n" % tmp_path)
+    result = runner.invoke(subst, args)
+    assert result.exit_code != 0
+    assert "cycle" in str(result.exception)
@@ -0,0 +1,33 @@
+import pickle
+
+import pytest # type: ignore[import]
+
+from aurl.urls import URL
+
+def test_url_interning():
+    a = URL("https://www.example.com/index.html?x=1")
+    b = URL("https://www.example.com/index.html?x=1")
+    assert a is b
+    assert URL(a) is a
+    assert hash(a) == hash(b)
+    assert len({a, b, URL("https://www.example.com/other")}) == 2
+    assert a != "https://www.example.com/index.html?x=1"
+    assert a.query == {"x": ["1"]}
+    assert not hasattr(a, "__dict__")
+
+def test_url_validation():
+    u = URL("git+https://github.com/frobnitzem/aurl")
+    assert u.scheme == "git+https"
+    assert u.path == "frobnitzem/aurl"
+
+    # an unvalidated instance is validated when re-requested
+    URL("zzz://host/path", False)
+    with pytest.raises(AssertionError):
+        URL("zzz://host/path")
+    with pytest.raises(AssertionError):
+        URL("file:///tmp/x#frag")
+
+def test_url_pickle():
+    u = URL("git://spool/frobnitzem/dwork/README.md#v1", False)
+    v = pickle.loads(pickle.dumps(u))
+    assert v == u and v.meta == "#v1"